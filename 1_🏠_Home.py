@@ -1,7 +1,5 @@
 import streamlit as st
 from utils import init_session_state, signup, login, logout
-from sqlalchemy.orm import Session
-from utils import get_db
 
 st.set_page_config(page_title="Image Generation App", layout="wide")
 
@@ -30,14 +28,14 @@ def login_signup():
         username = st.text_input("Username", key="login_username")
         password = st.text_input("Password", type="password", key="login_password")
         if st.button("Login"):
-            db: Session = get_db().__next__()
-            user = login(username, password, db)
+            user = login(username, password)
             if user:
                 st.session_state.logged_in = True
                 st.session_state.current_user = {
-                    "id": user.id,
-                    "username": user.username,
+                    "id": user["id"],
+                    "username": user["username"],
                 }
+                st.session_state.access_token = user["access_token"]
                 st.success("Logged in successfully!")
                 st.rerun()
             else:
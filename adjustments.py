@@ -0,0 +1,58 @@
+import numpy as np
+from PIL import Image as PILImage
+
+PREVIEW_MAX_SIDE = 512
+
+# ITU-R 601-2 luma, as used by PIL's convert("L")
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _luma(rgb):
+    # Rounded like PIL's fixed-point conversion, so the grey references match exactly
+    gray = rgb @ LUMA_WEIGHTS
+    np.add(gray, 0.5, out=gray)
+    return np.floor(gray, out=gray)
+
+
+def _blend(buf, degenerate, factor):
+    # Image.blend(degenerate, image, factor) in place: clipped and truncated to 8 bits
+    buf -= degenerate
+    buf *= factor
+    buf += degenerate
+    np.clip(buf, 0, 255, out=buf)
+    np.floor(buf, out=buf)
+
+
+def adjust(image, brightness=1.0, contrast=1.0, saturation=1.0):
+    """Apply ImageEnhance Brightness, Contrast and Color, in that order, in one buffer.
+
+    Matches the chained PIL enhancers to within one level per channel while
+    allocating a single float32 working copy instead of an image per step.
+    """
+    if brightness == 1.0 and contrast == 1.0 and saturation == 1.0:
+        return image
+
+    alpha = image.getchannel("A") if "A" in image.getbands() else None
+    buf = np.asarray(image.convert("RGB"), dtype=np.float32)
+
+    if brightness != 1.0:
+        _blend(buf, 0.0, brightness)
+    if contrast != 1.0:
+        mean = int(_luma(buf).mean() + 0.5)
+        _blend(buf, float(mean), contrast)
+    if saturation != 1.0:
+        _blend(buf, _luma(buf)[..., None], saturation)
+
+    adjusted = PILImage.fromarray(buf.astype(np.uint8), "RGB")
+    if alpha is not None:
+        adjusted.putalpha(alpha)
+    return adjusted
+
+
+def make_preview(image, max_side=PREVIEW_MAX_SIDE):
+    """Downscaled copy to run the adjustments on while sliders move."""
+    if max(image.size) <= max_side:
+        return image
+    preview = image.copy()
+    preview.thumbnail((max_side, max_side), PILImage.BILINEAR)
+    return preview
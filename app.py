@@ -1,25 +1,88 @@
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Form
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, literal, tuple_
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from typing import List
-import bcrypt
-from utils import User, Image, get_db, create_tables
-from fastapi.responses import StreamingResponse
-import io
-from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+import base64
+import datetime as dt
+import itertools
+import zipfile
+from PIL import UnidentifiedImageError
+from PIL.Image import DecompressionBombError
+import config
+import metrics
+from db import (
+    User,
+    Image,
+    ImageRendition,
+    GenerationJob,
+    get_db,
+    SessionLocal,
+    create_tables,
+    blob_store,
+    pool_monitor,
+)
+from storage import BlobTooLarge
+from auth import (
+    TokenUser,
+    current_user,
+    require_user,
+    hash_password,
+    check_password,
+    issue_token,
+)
+from images import build_image
+from generation_request import GenerateRequest
+from bundle import pack_header, CONTENT_TYPE as BUNDLE_CONTENT_TYPE
+from http_cache import blob_etag, blob_response
+from search import search_images
+from blob_gc import BlobCollector, GC_INTERVAL_SECONDS
+import job_queue
+from archive import (
+    ArchiveWriter,
+    member_name,
+    read_manifest,
+    CONTENT_TYPE as ARCHIVE_CONTENT_TYPE,
+)
+from fastapi.responses import Response, StreamingResponse
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+from datetime import date, datetime
+
+MAX_UPLOAD_BYTES = config.get_int("MAX_UPLOAD_MB", 20) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_IMPORT_BYTES = config.get_int("MAX_IMPORT_MB", 2048) * 1024 * 1024
+EXPORT_CHUNK_ROWS = config.get_int("EXPORT_CHUNK_ROWS", 500)
+IMPORT_BATCH_SIZE = config.get_int("IMPORT_BATCH_SIZE", 100)
+DEBUG_DB_STATS = config.get_bool("DEBUG_DB_STATS", False)
 
 # Create tables when the application starts
 create_tables()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Deleted images are reclaimed in the background (BLOB_GC_INTERVAL_SECONDS = 0 turns it off)
+    collector = BlobCollector() if GC_INTERVAL_SECONDS else None
+    if collector:
+        collector.start()
+    yield
+    if collector:
+        collector.stop(timeout=5)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.RequestMetricsMiddleware)
 
 
 class UserCreate(BaseModel):
     username: str
     password: str
     email: str
-    date_of_birth: str
+    date_of_birth: date
 
 
 class UserResponse(BaseModel):
@@ -35,6 +98,14 @@ class UserLogin(BaseModel):
     password: str
 
 
+class TokenResponse(BaseModel):
+    id: int
+    username: str
+    access_token: str
+    token_type: str = "bearer"
+    expires_at: int
+
+
 class ImageResponse(BaseModel):
     id: int
     filename: str
@@ -45,84 +116,786 @@ class ImageResponse(BaseModel):
         orm_mode = True
 
 
+class ImagePage(BaseModel):
+    items: List[ImageResponse]
+    total: int
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+
+class SearchResult(ImageResponse):
+    rank: float
+
+
+class SearchPage(BaseModel):
+    items: List[SearchResult]
+    total: int
+    next_offset: Optional[int] = None
+
+
+class BulkDelete(BaseModel):
+    # Either or both; with both, only the listed images older than the date go
+    ids: Optional[List[int]] = Field(None, max_length=1000)
+    older_than: Optional[datetime] = None
+
+
+class DeleteResult(BaseModel):
+    deleted: int
+
+
+class JobResponse(BaseModel):
+    id: int
+    status: str
+    model_name: str
+    prompt: str
+    height: int
+    width: int
+    seeds: List[int]
+    sampler: str
+    steps: int
+    guidance_scale: float
+    attempts: int
+    step: int
+    total_steps: Optional[int] = None
+    error: Optional[str] = None
+    # The gallery images of a done job, in seed order
+    image_ids: Optional[List[int]] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+        protected_namespaces = ()
+
+
+class ImportResult(BaseModel):
+    imported: int
+    skipped: int
+    # Archive members that were missing, too large or not images
+    failed: List[str]
+
+
+def encode_cursor(created_at: datetime, image_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{image_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, image_id = (
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        )
+        return datetime.fromisoformat(created_at), int(image_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def query_image_page(
+        db: Session,
+        user_id: int,
+        limit: int,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        order: str = "newest",
+):
+    # Keyset pagination over (created_at, id), selecting metadata columns only
+    key = tuple_(Image.created_at, Image.id)
+    ascending = order == "oldest"
+    backwards = before is not None
+    if backwards == ascending:
+        sort = (Image.created_at.desc(), Image.id.desc())
+    else:
+        sort = (Image.created_at.asc(), Image.id.asc())
+
+    query = db.query(
+        Image.id, Image.filename, Image.prompt, Image.created_at
+    ).filter(Image.owner_id == user_id, Image.deleted_at.is_(None))
+    cursor = before if backwards else after
+    if cursor is not None:
+        created_at, image_id = decode_cursor(cursor)
+        position = tuple_(literal(created_at, Image.created_at.type), literal(image_id))
+        query = query.filter(key < position if backwards == ascending else key > position)
+    rows = query.order_by(*sort).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    page = ImagePage(
+        items=[ImageResponse(**row._asdict()) for row in rows],
+        total=db.query(func.count(Image.id))
+        .filter(Image.owner_id == user_id, Image.deleted_at.is_(None))
+        .scalar(),
+    )
+    if backwards:
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, after is not None
+    if rows and has_next:
+        page.next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    if rows and has_prev:
+        page.prev_cursor = encode_cursor(rows[0].created_at, rows[0].id)
+    return page
+
+
+def resolve_blobs(db: Session, images, size: Optional[int] = None):
+    # Map image id -> (sha256, content_type, length) of the blob to serve
+    blobs = {
+        image.id: (image.sha256, image.content_type or "image/png", image.size)
+        for image in images
+    }
+    if size and blobs:
+        # Largest first, so the smallest rendition covering the size wins
+        renditions = (
+            db.query(ImageRendition)
+            .filter(
+                ImageRendition.image_id.in_(list(blobs)),
+                ImageRendition.max_side >= size,
+            )
+            .order_by(ImageRendition.max_side.desc())
+        )
+        for rendition in renditions:
+            blobs[rendition.image_id] = (
+                rendition.sha256,
+                rendition.content_type,
+                rendition.size,
+            )
+    return blobs
+
+
+def stream_bundle(page: dict, entries, have=frozenset()):
+    yield pack_header({"type": "page", **page})
+    for meta, (digest, content_type, length) in entries:
+        etag = blob_etag(digest)
+        header = {"type": "image", **meta, "content_type": content_type, "etag": etag}
+        if etag in have:
+            # The client holds these bytes already, send the header alone
+            yield pack_header({**header, "not_modified": True})
+            continue
+        yield pack_header({**header, "length": length})
+        with blob_store.open(digest) as f:
+            while chunk := f.read(64 * 1024):
+                yield chunk
+
+
+def soft_delete(db: Session, user_id: int, ids=None, older_than=None) -> int:
+    # One UPDATE in a short transaction; blob_gc removes the rows and blobs later
+    query = db.query(Image).filter(Image.owner_id == user_id, Image.deleted_at.is_(None))
+    if ids is not None:
+        query = query.filter(Image.id.in_(ids))
+    if older_than is not None:
+        if older_than.tzinfo is not None:
+            # Stored times are naive UTC
+            older_than = older_than.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        query = query.filter(Image.created_at < older_than)
+    deleted = query.update(
+        {Image.deleted_at: datetime.utcnow()}, synchronize_session=False
+    )
+    db.commit()
+    return deleted
+
+
+def find_user_by_name(db: Session, username: str):
+    return db.query(User).filter(User.username == username).first()
+
+
+def add_user(db: Session, db_user: User):
+    db.add(db_user)
+    db.commit()
+    db.refresh(db_user)
+    return db_user
+
+
 @app.post("/users/", response_model=UserResponse)
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
+async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+    db_user = await run_in_threadpool(find_user_by_name, db, user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = bcrypt.hashpw(user.password.encode("utf-8"), bcrypt.gensalt())
     db_user = User(
         username=user.username,
-        hashed_password=hashed_password.decode("utf-8"),
+        hashed_password=await hash_password(user.password),
         email=user.email,
         date_of_birth=user.date_of_birth,
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+    return await run_in_threadpool(add_user, db, db_user)
 
 
-@app.post("/login", response_model=UserResponse)
-def login(user: UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
+@app.post("/login", response_model=TokenResponse)
+async def login(user: UserLogin, db: Session = Depends(get_db)):
+    db_user = await run_in_threadpool(find_user_by_name, db, user.username)
     if not db_user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    if not bcrypt.checkpw(
-            user.password.encode("utf-8"), db_user.hashed_password.encode("utf-8")
-    ):
+    if not await check_password(user.password, db_user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    return db_user
+    access_token, expires_at = issue_token(db_user.id, db_user.username)
+    return TokenResponse(
+        id=db_user.id,
+        username=db_user.username,
+        access_token=access_token,
+        expires_at=expires_at,
+    )
 
 
-@app.post("/images/{user_id}")
-async def upload_image(
-        user_id: int,
-        file: UploadFile = File(...),
-        prompt: str = Form(...),
-        db: Session = Depends(get_db),
-):
+def get_user(db: Session, user_id: int):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    return user
 
-    contents = await file.read()
-    db_image = Image(
-        filename=file.filename, data=contents, prompt=prompt, owner_id=user_id
-    )
+
+def parse_content_length(request: Request) -> Optional[int]:
+    value = request.headers.get("content-length")
+    if value is None:
+        return None
+    # int() would also take "+5", " 5" or "5_0"
+    if not value.isascii() or not value.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    return int(value)
+
+
+async def iter_upload_file(file: UploadFile):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+async def receive_blob(chunks):
+    # Stream the body to the blob store chunk by chunk, file I/O stays off the event loop
+    writer = await run_in_threadpool(blob_store.open_writer, MAX_UPLOAD_BYTES)
+    try:
+        async for chunk in chunks:
+            await run_in_threadpool(writer.write, chunk)
+    except BlobTooLarge:
+        await run_in_threadpool(writer.abort)
+        raise HTTPException(status_code=413, detail="Upload too large")
+    except BaseException:
+        await run_in_threadpool(writer.abort)
+        raise
+    return await run_in_threadpool(writer.commit)
+
+
+async def receive_form(request: Request, max_bytes: int, too_large: str):
+    # Counted while the body streams in, so an oversized upload is never spooled whole
+    content_length = parse_content_length(request)
+    if content_length is not None and content_length > max_bytes:
+        raise HTTPException(status_code=413, detail=too_large)
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Send the upload as multipart/form-data")
+
+    async def limited_stream():
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes:
+                raise HTTPException(status_code=413, detail=too_large)
+            yield chunk
+
+    try:
+        return await MultiPartParser(request.headers, limited_stream()).parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+
+def multipart_body(**fields) -> dict:
+    # Documents a body that the endpoint parses itself with receive_form
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": fields,
+                        "required": list(fields),
+                    }
+                }
+            },
+        }
+    }
+
+
+def save_image(
+        db: Session, user_id: int, filename: str, prompt: str, sha256: str, size: int
+):
+    try:
+        db_image = build_image(user_id, filename, prompt, sha256, size)
+    except (UnidentifiedImageError, OSError, DecompressionBombError):
+        # Not an image, truncated or too large to decode. The blob is left to
+        # blob_gc, another upload may be deduplicating against it
+        raise HTTPException(status_code=400, detail="Not a readable image")
     db.add(db_image)
     db.commit()
     db.refresh(db_image)
+    return db_image
+
+
+def iter_export_rows(user_id: int):
+    # A short session per chunk of rows, so a slow download does not hold a pooled connection
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(
+                    Image.id,
+                    Image.filename,
+                    Image.prompt,
+                    Image.created_at,
+                    Image.content_type,
+                    Image.sha256,
+                    Image.size,
+                )
+                .filter(
+                    Image.owner_id == user_id, Image.id > last_id, Image.deleted_at.is_(None)
+                )
+                .order_by(Image.id)
+                .limit(EXPORT_CHUNK_ROWS)
+                .all()
+            )
+        finally:
+            db.close()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def stream_export(user_id: int):
+    archive = ArchiveWriter()
+    for row in iter_export_rows(user_id):
+        name = member_name(row.id, row.content_type)
+        try:
+            blob = blob_store.open(row.sha256)
+        except FileNotFoundError:
+            # Deleted since its chunk of rows was read
+            continue
+        with blob:
+            yield from archive.add_file(name, blob, row.size, row.created_at)
+        archive.add_manifest_entry(
+            {
+                "file": name,
+                "filename": row.filename,
+                "prompt": row.prompt,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "content_type": row.content_type,
+                "sha256": row.sha256,
+                "size": row.size,
+            }
+        )
+    yield from archive.close()
+
+
+def owned_digests(db: Session, user_id: int, digests):
+    if not digests:
+        return set()
+    return {
+        digest
+        for (digest,) in db.query(Image.sha256).filter(
+            Image.owner_id == user_id,
+            Image.sha256.in_(list(digests)),
+            Image.deleted_at.is_(None),
+        )
+    }
+
+
+def store_member(archive: zipfile.ZipFile, name: str):
+    writer = blob_store.open_writer(MAX_UPLOAD_BYTES)
+    try:
+        with archive.open(name) as member:
+            while chunk := member.read(UPLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def parse_created_at(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def valid_record(record) -> bool:
+    # A manifest line has to be an object naming its member, every other field is optional text
+    return (
+        isinstance(record, dict)
+        and isinstance(record.get("file"), str)
+        and all(
+            isinstance(record.get(field), (str, type(None)))
+            for field in ("sha256", "filename", "prompt", "created_at")
+        )
+    )
+
+
+def import_archive(db: Session, user_id: int, archive: zipfile.ZipFile) -> ImportResult:
+    """Add the images of an export archive, a batch of manifest records per transaction.
+
+    Images the user already has (same content) are skipped, so re-running an
+    interrupted import picks up where it stopped.
+    """
+    result = ImportResult(imported=0, skipped=0, failed=[])
+    records = read_manifest(archive)
+    while batch := list(itertools.islice(records, IMPORT_BATCH_SIZE)):
+        for record in batch:
+            if not valid_record(record):
+                name = record.get("file") if isinstance(record, dict) else None
+                result.failed.append(name if isinstance(name, str) else "<invalid manifest record>")
+        batch = [record for record in batch if valid_record(record)]
+        # The manifest's digests skip known images without reading them...
+        known = owned_digests(db, user_id, {r.get("sha256") for r in batch} - {None})
+        stored = []
+        for record in batch:
+            if record.get("sha256") in known:
+                result.skipped += 1
+                continue
+            try:
+                stored.append((record, *store_member(archive, record["file"])))
+            except (KeyError, BlobTooLarge, zipfile.BadZipFile):
+                result.failed.append(record["file"])
+
+        # ...and the actual ones catch the rest, including repeats within the archive
+        known |= owned_digests(db, user_id, {digest for _, digest, _ in stored})
+        images = []
+        for record, digest, size in stored:
+            if digest in known:
+                result.skipped += 1
+                continue
+            try:
+                images.append(
+                    build_image(
+                        user_id,
+                        record.get("filename") or record["file"].rsplit("/", 1)[-1],
+                        record.get("prompt") or "",
+                        digest,
+                        size,
+                        parse_created_at(record.get("created_at")),
+                    )
+                )
+                known.add(digest)
+            except (UnidentifiedImageError, OSError, DecompressionBombError):
+                result.failed.append(record["file"])
+        db.add_all(images)
+        db.commit()
+        result.imported += len(images)
+    return result
+
+
+@app.post(
+    "/images/{user_id}",
+    openapi_extra=multipart_body(
+        file={"type": "string", "format": "binary"}, prompt={"type": "string"}
+    ),
+)
+async def upload_image(
+        user_id: int,
+        request: Request,
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # The sync session and image decoding run on the worker pool, never on the loop
+    await run_in_threadpool(get_user, db, user_id)
+    form = await receive_form(request, MAX_UPLOAD_BYTES, "Upload too large")
+    try:
+        file, prompt = form.get("file"), form.get("prompt")
+        if not isinstance(file, UploadFile) or not isinstance(prompt, str):
+            raise HTTPException(status_code=400, detail="Send a file and a prompt")
+        sha256, size = await receive_blob(iter_upload_file(file))
+    finally:
+        await form.close()
+    await run_in_threadpool(
+        save_image, db, user_id, file.filename, prompt, sha256, size
+    )
     return {"message": "Image uploaded successfully"}
 
 
-@app.get("/images/{user_id}", response_model=List[ImageResponse])
-def get_user_images(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user.images
+@app.put("/images/{user_id}/raw")
+async def upload_image_raw(
+        user_id: int,
+        request: Request,
+        prompt: str,
+        filename: str = "image.png",
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # Body is the image itself, streamed to storage without multipart spooling
+    content_length = parse_content_length(request)
+    if content_length is not None and content_length > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+    await run_in_threadpool(get_user, db, user_id)
+    sha256, size = await receive_blob(request.stream())
+    await run_in_threadpool(save_image, db, user_id, filename, prompt, sha256, size)
+    return {"message": "Image uploaded successfully"}
+
+
+@app.get("/images/{user_id}", response_model=ImagePage)
+def get_user_images(
+        user_id: int,
+        limit: int = Query(20, ge=1, le=100),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        order: Literal["newest", "oldest"] = "newest",
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Use either before or after")
+    get_user(db, user_id)
+    return query_image_page(db, user_id, limit, before, after, order)
+
+
+@app.get("/images/{user_id}/search", response_model=SearchPage)
+def search_user_images(
+        user_id: int,
+        q: str = Query(..., min_length=1, max_length=200),
+        limit: int = Query(20, ge=1, le=100),
+        offset: int = Query(0, ge=0),
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # Ranked by prompt relevance; page through with offset, as ranks have no stable cursor
+    get_user(db, user_id)
+    rows, total = search_images(db, user_id, q, limit, offset)
+    return SearchPage(
+        items=[SearchResult(**row._asdict()) for row in rows],
+        total=total,
+        next_offset=offset + limit if offset + limit < total else None,
+    )
+
+
+@app.post("/images/{user_id}/delete", response_model=DeleteResult)
+def delete_images(
+        user_id: int,
+        request: BulkDelete,
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    if request.ids is None and request.older_than is None:
+        raise HTTPException(status_code=400, detail="Give ids, older_than or both")
+    get_user(db, user_id)
+    return DeleteResult(
+        deleted=soft_delete(db, user_id, request.ids, request.older_than)
+    )
+
+
+@app.get("/images/{user_id}/export")
+def export_images(
+        user_id: int,
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # A zip of every image plus manifest.jsonl, written as it is sent
+    get_user(db, user_id)
+    return StreamingResponse(
+        stream_export(user_id),
+        media_type=ARCHIVE_CONTENT_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="gallery-{user_id}.zip"'},
+    )
+
+
+async def receive_archive(request: Request) -> UploadFile:
+    form = await receive_form(request, MAX_IMPORT_BYTES, "Archive too large")
+    file = form.get("file")
+    if not isinstance(file, UploadFile):
+        await form.close()
+        raise HTTPException(status_code=400, detail="No file in the upload")
+    return file
+
+
+def import_upload(db: Session, user_id: int, file) -> ImportResult:
+    # The upload is spooled to disk, so the archive is read member by member from there
+    try:
+        with zipfile.ZipFile(file) as archive:
+            return import_archive(db, user_id, archive)
+    except (zipfile.BadZipFile, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Not a gallery archive: {e}")
+
+
+@app.post(
+    "/images/{user_id}/import",
+    response_model=ImportResult,
+    openapi_extra=multipart_body(file={"type": "string", "format": "binary"}),
+)
+async def import_images(
+        user_id: int,
+        request: Request,
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    await run_in_threadpool(get_user, db, user_id)
+    file = await receive_archive(request)
+    try:
+        return await run_in_threadpool(import_upload, db, user_id, file.file)
+    finally:
+        await file.close()
+
+
+@app.get("/images/{user_id}/bundle")
+def get_image_bundle(
+        user_id: int,
+        ids: Optional[List[int]] = Query(None, max_length=100),
+        limit: int = Query(20, ge=1, le=100),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        order: Literal["newest", "oldest"] = "newest",
+        size: Optional[int] = Query(None, ge=1),
+        have: Optional[List[str]] = Query(None, max_length=100),
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # have: ETags of images the client has cached; those come without payload
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Use either before or after")
+    get_user(db, user_id)
+
+    if ids:
+        items = [
+            ImageResponse(**row._asdict())
+            for row in db.query(
+                Image.id, Image.filename, Image.prompt, Image.created_at
+            ).filter(
+                Image.owner_id == user_id, Image.id.in_(ids), Image.deleted_at.is_(None)
+            )
+        ]
+        items.sort(key=lambda item: ids.index(item.id))
+        page = {"total": len(items), "next_cursor": None, "prev_cursor": None}
+    else:
+        result = query_image_page(db, user_id, limit, before, after, order)
+        items = result.items
+        page = result.model_dump(exclude={"items"})
+
+    digests = db.query(Image.id, Image.sha256, Image.size, Image.content_type).filter(
+        Image.id.in_([item.id for item in items])
+    )
+    blobs = resolve_blobs(db, digests, size)
+    entries = [(item.model_dump(mode="json"), blobs[item.id]) for item in items]
+    return StreamingResponse(
+        stream_bundle(page, entries, frozenset(have or ())),
+        media_type=BUNDLE_CONTENT_TYPE,
+    )
+
+
+def get_owned_image(db: Session, image_id: int, user: TokenUser):
+    # Other users' images are reported as missing rather than forbidden
+    return (
+        db.query(Image)
+        .filter(
+            Image.id == image_id, Image.owner_id == user.id, Image.deleted_at.is_(None)
+        )
+        .first()
+    )
 
 
-@app.get("/image/{image_id}")
-def get_image(image_id: int, db: Session = Depends(get_db)):
-    image = db.query(Image).filter(Image.id == image_id).first()
+@app.api_route("/image/{image_id}", methods=["GET", "HEAD"])
+def get_image(
+        image_id: int,
+        request: Request,
+        size: Optional[int] = Query(None, ge=1),
+        db: Session = Depends(get_db),
+        user: TokenUser = Depends(current_user),
+):
+    image = get_owned_image(db, image_id, user)
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
-    return StreamingResponse(io.BytesIO(image.data), media_type="image/png")
+    digest, content_type, length = resolve_blobs(db, [image], size)[image.id]
+    # Blobs never change, so the digest is the ETag and clients may cache for good
+    return blob_response(request, blob_store, digest, content_type, length)
 
 
 @app.delete("/image/{image_id}")
-def delete_image(image_id: int, db: Session = Depends(get_db)):
-    image = db.query(Image).filter(Image.id == image_id).first()
-    if not image:
+def delete_image(
+        image_id: int,
+        db: Session = Depends(get_db),
+        user: TokenUser = Depends(current_user),
+):
+    if not soft_delete(db, user.id, ids=[image_id]):
         raise HTTPException(status_code=404, detail="Image not found")
-    db.delete(image)
-    db.commit()
     return {"message": "Image deleted successfully"}
 
 
+@app.post("/images/{user_id}/jobs", response_model=JobResponse)
+def submit_job(
+        user_id: int,
+        request: GenerateRequest,
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    # Queued for worker.py; the images end up in the user's gallery
+    from generation import variant_seeds, sampler_settings
+
+    try:
+        seeds = variant_seeds(request.num_images, request.seeds)
+        settings = sampler_settings(
+            request.model_name, request.sampler, request.steps, request.guidance_scale
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return job_queue.submit(
+        db, user_id, request.model_name, request.prompt, request.height, request.width,
+        seeds, settings,
+    )
+
+
+@app.get("/images/{user_id}/jobs", response_model=List[JobResponse])
+def list_jobs(
+        user_id: int,
+        limit: int = Query(20, ge=1, le=100),
+        db: Session = Depends(get_db),
+        _: TokenUser = Depends(require_user),
+):
+    return (
+        db.query(GenerationJob)
+        .filter(GenerationJob.owner_id == user_id)
+        .order_by(GenerationJob.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def get_owned_job(db: Session, job_id: int, user: TokenUser):
+    job = db.get(GenerationJob, job_id)
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/job/{job_id}", response_model=JobResponse)
+def get_job(
+        job_id: int,
+        db: Session = Depends(get_db),
+        user: TokenUser = Depends(current_user),
+):
+    return get_owned_job(db, job_id, user)
+
+
+@app.delete("/job/{job_id}", response_model=JobResponse)
+def cancel_job(
+        job_id: int,
+        db: Session = Depends(get_db),
+        user: TokenUser = Depends(current_user),
+):
+    job = get_owned_job(db, job_id, user)
+    if not job_queue.cancel(db, job_id, user.id):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    db.refresh(job)
+    return job
+
+
+if DEBUG_DB_STATS:
+    # Shows statement text and call sites, so only when asked for and only to logged in users
+    @app.get("/debug/db")
+    def get_db_stats(_: TokenUser = Depends(current_user)):
+        # Pool occupancy, connection waits, who holds connections now and the slowest statements
+        return pool_monitor.stats()
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     uvicorn.run(app)
@@ -0,0 +1,96 @@
+"""Gallery archives: a zip of the images plus ``manifest.jsonl``, one JSON line per image.
+
+Archives are written as a stream, with each entry's sizes in a data descriptor
+after its bytes, so an export holds one chunk of one image in memory however
+large the gallery is. Images are stored uncompressed (they are compressed
+already), the manifest is deflated and comes last.
+"""
+import datetime
+import io
+import json
+import mimetypes
+import tempfile
+import zipfile
+
+MANIFEST_NAME = "manifest.jsonl"
+CONTENT_TYPE = "application/zip"
+CHUNK_SIZE = 64 * 1024
+# Manifest lines stay in memory up to this size, then move to a temporary file
+MANIFEST_SPOOL_BYTES = 1024 * 1024
+
+
+class _Sink(io.RawIOBase):
+    # A write-only, unseekable file collecting what the zip writer produces
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_time(value) -> tuple:
+    value = value or datetime.datetime.utcnow()
+    # Zip timestamps start in 1980
+    return max(value.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def member_name(image_id: int, content_type: str) -> str:
+    extension = mimetypes.guess_extension(content_type or "") or ".bin"
+    return f"images/{image_id}{extension}"
+
+
+class ArchiveWriter:
+    """Builds a zip archive incrementally; the generators yield its bytes as they are produced."""
+
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, "w", compression=zipfile.ZIP_STORED)
+        self._manifest = tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_BYTES)
+
+    def add_file(self, name: str, file, size: int, modified=None):
+        info = zipfile.ZipInfo(name, date_time=_zip_time(modified))
+        info.compress_type = zipfile.ZIP_STORED
+        # The size up front lets the writer pick zip64 headers for huge entries
+        info.file_size = size
+        with self._zip.open(info, "w") as entry:
+            while chunk := file.read(CHUNK_SIZE):
+                entry.write(chunk)
+                yield self._sink.drain()
+        yield self._sink.drain()
+
+    def add_manifest_entry(self, record: dict):
+        self._manifest.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+
+    def close(self):
+        info = zipfile.ZipInfo(MANIFEST_NAME, date_time=_zip_time(None))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self._manifest.seek(0)
+        with self._zip.open(info, "w") as entry:
+            while chunk := self._manifest.read(CHUNK_SIZE):
+                entry.write(chunk)
+                yield self._sink.drain()
+        self._manifest.close()
+        # Writes the central directory
+        self._zip.close()
+        yield self._sink.drain()
+
+
+def read_manifest(archive: zipfile.ZipFile):
+    """Yield the manifest records of an archive; ValueError when it has no manifest."""
+    try:
+        manifest = archive.open(MANIFEST_NAME)
+    except KeyError:
+        raise ValueError(f"The archive has no {MANIFEST_NAME}")
+    with manifest, io.TextIOWrapper(manifest, encoding="utf-8") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
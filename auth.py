@@ -0,0 +1,107 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import BaseModel
+
+import config
+import metrics
+
+# Tokens are signed with AUTH_SECRET; without one they only survive until a restart
+AUTH_SECRET = config.get("AUTH_SECRET") or secrets.token_hex(32)
+AUTH_TOKEN_TTL = config.get_int("AUTH_TOKEN_TTL", 12 * 60 * 60)
+BCRYPT_ROUNDS = config.get_int("BCRYPT_ROUNDS", 12)
+BCRYPT_WORKERS = config.get_int("BCRYPT_WORKERS", 2)
+BCRYPT_MAX_PENDING = config.get_int("BCRYPT_MAX_PENDING", 64)
+
+# bcrypt is deliberately slow; a small dedicated pool keeps login bursts from
+# starving the event loop and the default threadpool that serves everything else
+bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+bcrypt_slots = asyncio.Semaphore(BCRYPT_WORKERS + BCRYPT_MAX_PENDING)
+
+
+class TokenUser(BaseModel):
+    id: int
+    username: str
+
+
+async def run_bcrypt(fn, *args):
+    if bcrypt_slots.locked():
+        raise HTTPException(status_code=503, detail="Too many login attempts, retry shortly")
+    async with bcrypt_slots:
+        # Includes the wait for a free worker, which is what a login burst costs
+        with metrics.stage("bcrypt"):
+            return await asyncio.get_running_loop().run_in_executor(bcrypt_pool, fn, *args)
+
+
+async def hash_password(password: str) -> str:
+    hashed = await run_bcrypt(
+        bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(BCRYPT_ROUNDS)
+    )
+    return hashed.decode("utf-8")
+
+
+async def check_password(password: str, hashed_password: str) -> bool:
+    return await run_bcrypt(
+        bcrypt.checkpw, password.encode("utf-8"), hashed_password.encode("utf-8")
+    )
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(
+        hmac.new(AUTH_SECRET.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest()
+    )
+
+
+def issue_token(user_id: int, username: str):
+    expires_at = int(time.time()) + AUTH_TOKEN_TTL
+    payload = _b64encode(
+        json.dumps({"sub": user_id, "name": username, "exp": expires_at}).encode("utf-8")
+    )
+    return f"{payload}.{_sign(payload)}", expires_at
+
+
+def verify_token(token: str) -> TokenUser:
+    # Stateless: the signature and expiry are all that is checked, no DB round trip
+    try:
+        payload, signature = token.split(".")
+        # As bytes, compare_digest raises TypeError on non-ASCII str
+        if not hmac.compare_digest(signature.encode("utf-8"), _sign(payload).encode("ascii")):
+            raise ValueError("Bad signature")
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if claims["exp"] < time.time():
+        raise HTTPException(status_code=401, detail="Token expired")
+    return TokenUser(id=claims["sub"], username=claims["name"])
+
+
+bearer = HTTPBearer()
+
+
+def current_user(
+        credentials: HTTPAuthorizationCredentials = Depends(bearer),
+) -> TokenUser:
+    return verify_token(credentials.credentials)
+
+
+def require_user(user_id: int, user: TokenUser = Depends(current_user)) -> TokenUser:
+    if user.id != user_id:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    return user
@@ -0,0 +1,237 @@
+import collections
+import itertools
+import threading
+import time
+import uuid
+
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class BatchCancelled(Exception):
+    pass
+
+
+class GenerationJob:
+    def __init__(self, model_name: str, prompt: str, height: int, width: int, seeds, options=None):
+        self.id = uuid.uuid4().hex
+        self.model_name = model_name
+        self.prompt = prompt
+        self.height = height
+        self.width = width
+        # One image per seed
+        self.seeds = list(seeds)
+        # Settings that apply to the whole pipeline call, such as the sampler
+        self.options = dict(options or {})
+        self.status = "queued"
+        # The images in seed order, once done
+        self.result = None
+        self.error = None
+        self.batch_size = None
+        self.step = 0
+        self.total_steps = None
+        self.preview = None
+        self.cancel_requested = False
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def key(self):
+        # Only jobs sharing a model, an output size and the options can run as one batch
+        return self.model_name, self.height, self.width, tuple(sorted(self.options.items()))
+
+
+class MicroBatcher:
+    """Collect generation jobs for a short window and run them through one pipeline call.
+
+    A job asks for one image per seed, and a batch holds up to ``max_batch_size``
+    images (or a single larger job). ``run_batch(model_name, prompts, seeds, height,
+    width, progress, **options)`` gets one prompt and seed per image and must return
+    one image for each. It should call ``progress(step, total, previews)`` as it goes;
+    ``previews`` maps image index to a preview image. ``progress`` raises
+    ``BatchCancelled`` once every job in the batch has been cancelled.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05, max_finished_jobs=1000):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_finished_jobs = max_finished_jobs
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._jobs = collections.OrderedDict()
+        self._finished = collections.deque()
+        self._running = False
+        self._thread = None
+
+        self._batches = 0
+        self._jobs_done = 0
+        self._images_done = 0
+        self._batch_sizes = collections.Counter()
+        self._busy_seconds = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(
+            self, model_name: str, prompt: str, height: int, width: int, seeds, options=None
+    ) -> GenerationJob:
+        job = GenerationJob(model_name, prompt, height, width, seeds, options)
+        with self._cond:
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job_id: str):
+        """Drop a queued job, or flag a running one; its batch stops once all are flagged."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_requested = True
+            if job.status == "queued":
+                self._pending.remove(job)
+                self._finish(job, "cancelled", None, None, time.monotonic())
+                # Wake the batching loop so it stops counting on the job
+                self._cond.notify_all()
+            return job
+
+    def get(self, job_id: str):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._cond:
+            sizes = dict(sorted(self._batch_sizes.items()))
+            return {
+                "queue_depth": len(self._pending),
+                "max_batch_size": self.max_batch_size,
+                "max_wait": self.max_wait,
+                "batches": self._batches,
+                "jobs": self._jobs_done,
+                "images": self._images_done,
+                "avg_batch_size": self._images_done / self._batches if self._batches else 0.0,
+                "batch_sizes": sizes,
+                "busy_seconds": self._busy_seconds,
+            }
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._running:
+                    return None
+
+                # The oldest job decides the batch key and the deadline, so nothing starves.
+                # Both are read again after every wait, as the oldest job may have been cancelled.
+                key = self._pending[0].key
+                deadline = self._pending[0].submitted_at + self.max_wait
+                batch, images = [], 0
+                for job in self._pending:
+                    if job.key != key:
+                        continue
+                    if batch and images + len(job.seeds) > self.max_batch_size:
+                        break
+                    batch.append(job)
+                    images += len(job.seeds)
+                remaining = deadline - time.monotonic()
+                if images >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            for job in batch:
+                self._pending.remove(job)
+                job.status = "running"
+                job.batch_size = images
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            model_name, height, width, _ = batch[0].key
+            # Where each job's images start in the flat list sent to the pipeline
+            offsets = list(itertools.accumulate((len(job.seeds) for job in batch), initial=0))
+            started = time.monotonic()
+            try:
+                images = self.run_batch(
+                    model_name,
+                    [job.prompt for job in batch for _ in job.seeds],
+                    [seed for job in batch for seed in job.seeds],
+                    height,
+                    width,
+                    self._progress(batch, offsets),
+                    **batch[0].options,
+                )
+                if len(images) != offsets[-1]:
+                    raise RuntimeError(
+                        f"Expected {offsets[-1]} images from the pipeline, got {len(images)}"
+                    )
+                outcomes = [
+                    (job, images[start:end], None)
+                    for job, start, end in zip(batch, offsets, offsets[1:])
+                ]
+            except BatchCancelled:
+                outcomes = [(job, None, None) for job in batch]
+            except Exception as e:
+                outcomes = [(job, None, repr(e)) for job in batch]
+            finished = time.monotonic()
+
+            with self._cond:
+                self._batches += 1
+                self._jobs_done += len(batch)
+                self._images_done += offsets[-1]
+                self._batch_sizes[offsets[-1]] += 1
+                self._busy_seconds += finished - started
+                for job, result, error in outcomes:
+                    if job.cancel_requested:
+                        self._finish(job, "cancelled", None, None, finished)
+                    else:
+                        self._finish(job, "failed" if error else "done", result, error, finished)
+
+    def _progress(self, batch, offsets):
+        def progress(step, total, previews=None):
+            with self._cond:
+                if all(job.cancel_requested for job in batch):
+                    raise BatchCancelled()
+                for job, start, end in zip(batch, offsets, offsets[1:]):
+                    job.step = step
+                    job.total_steps = total
+                    for i in range(start, end):
+                        if previews and i in previews:
+                            job.preview = previews[i]
+                            break
+
+        return progress
+
+    def _finish(self, job, status, result, error, finished):
+        # Called with self._cond held
+        job.result = result
+        job.error = error
+        job.status = status
+        job.finished_at = finished
+        job.preview = None
+        job.done.set()
+        self._finished.append(job.id)
+        # Forget the oldest finished jobs once their results pile up
+        while len(self._finished) > self.max_finished_jobs:
+            self._jobs.pop(self._finished.popleft(), None)
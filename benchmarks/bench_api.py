@@ -0,0 +1,272 @@
+"""Throughput and p50/p99 latency of the API endpoints at growing gallery sizes.
+
+Starts app.py under uvicorn against a throwaway SQLite database (or
+``--database-url``, e.g. a local Postgres) and blob directory. One user's gallery
+is grown to each of ``--sizes`` by inserting rows that share one uploaded image,
+then every endpoint is driven by ``--concurrency`` client threads.
+
+    python benchmarks/bench_api.py [--sizes 0 1000 10000] [--json results.json]
+                                   [--baseline old.json --tolerance 0.2]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import io
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from PIL import Image as PILImage
+
+from results import summarize, format_summary, write_results, compare
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    "create_user", "login", "upload_image", "get_user_images", "get_image", "search_images"
+]
+# create_user and login are bound by bcrypt, they get --auth-requests calls
+AUTH_ENDPOINTS = {"create_user", "login"}
+PASSWORD = "benchmark-password"
+# Seeded prompts combine these, so a search matches a predictable share of the gallery
+SUBJECTS = ["dog", "cat", "pikachu", "husky", "fox", "owl", "horse", "dragon"]
+PLACES = ["park", "beach", "forest", "city", "desert", "snow", "space", "garden"]
+SEARCH_QUERY = "husky snow"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(env, port, log_path):
+    log = open(log_path, "w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"the API exited with {server.returncode}, see {log_path}")
+        try:
+            requests.get(f"{url}/docs", timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"the API did not start within 60s, see {log_path}")
+
+
+def png_bytes(side=256):
+    # Noise, so that every upload is a new blob with its own renditions
+    image = PILImage.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class Client:
+    """A requests session per thread, as a Streamlit server process would hold."""
+
+    def __init__(self, url):
+        self.url = url
+        self.local = threading.local()
+        self.token = None
+        self.user_id = None
+        self.counter = iter(range(10 ** 9))
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def unique(self, prefix):
+        with self.lock:
+            return f"{prefix}-{os.getpid()}-{next(self.counter)}"
+
+    def create_user(self, username=None):
+        return self.session.post(
+            f"{self.url}/users/",
+            json={
+                "username": username or self.unique("user"),
+                "password": PASSWORD,
+                "email": "bench@example.com",
+                "date_of_birth": "2000-01-01",
+            },
+        )
+
+    def login(self, username):
+        return self.session.post(
+            f"{self.url}/login", json={"username": username, "password": PASSWORD}
+        )
+
+    def upload_image(self):
+        return self.session.post(
+            f"{self.url}/images/{self.user_id}",
+            files={"file": ("image.png", png_bytes(), "image/png")},
+            data={"prompt": "A playful dog running in a park"},
+            headers=self.headers(),
+        )
+
+    def get_user_images(self):
+        return self.session.get(
+            f"{self.url}/images/{self.user_id}", params={"limit": 20}, headers=self.headers()
+        )
+
+    def search_images(self):
+        return self.session.get(
+            f"{self.url}/images/{self.user_id}/search",
+            params={"q": SEARCH_QUERY, "limit": 20},
+            headers=self.headers(),
+        )
+
+    def get_image(self, image_id):
+        return self.session.get(f"{self.url}/image/{image_id}", headers=self.headers())
+
+
+def drive(call, count, concurrency):
+    """Run ``call`` ``count`` times on ``concurrency`` threads, return its summary."""
+
+    def timed(_):
+        started = time.perf_counter()
+        try:
+            ok = call().ok
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        outcomes = list(pool.map(timed, range(count)))
+    wall = time.perf_counter() - started
+    seconds = [elapsed for ok, elapsed in outcomes if ok]
+    return summarize(seconds, wall, errors=count - len(seconds))
+
+
+def grow_gallery(db, user_id, template, count):
+    """Insert ``count`` rows pointing at the blob of ``template``, newest last."""
+    start = datetime.datetime.utcnow()
+    rows = [
+        {
+            "filename": "image.png",
+            "sha256": template.sha256,
+            "size": template.size,
+            "content_type": template.content_type,
+            "prompt": f"A {SUBJECTS[i % 8]} in the {PLACES[i // 8 % 8]}, seeded image {i}",
+            "owner_id": user_id,
+            "created_at": start + datetime.timedelta(microseconds=i),
+        }
+        for i in range(count)
+    ]
+    with db.SessionLocal() as session:
+        for i in range(0, len(rows), 5000):
+            session.execute(db.Image.__table__.insert(), rows[i:i + 5000])
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 1000, 10000])
+    parser.add_argument("--requests", type=int, default=200, help="calls per endpoint and size")
+    parser.add_argument("--auth-requests", type=int, default=20, help="calls to create_user and login")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--database-url", help="defaults to a new SQLite file")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a results file written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_api_")
+    env = dict(
+        os.environ,
+        CONFIG_FILE=os.path.join(workdir, "none.toml"),
+        DATABASE_URL=args.database_url or f"sqlite:///{workdir}/bench.sqlite",
+        BLOB_STORE_PATH=os.path.join(workdir, "blobs"),
+        BCRYPT_ROUNDS=str(args.bcrypt_rounds),
+    )
+    # The benchmark seeds the same database the server uses
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import db
+
+    server, url = start_server(env, free_port(), os.path.join(workdir, "server.log"))
+    try:
+        client = Client(url)
+        username = client.unique("owner")
+        client.create_user(username).raise_for_status()
+        token = client.login(username)
+        token.raise_for_status()
+        client.token, client.user_id = token.json()["access_token"], token.json()["id"]
+        client.upload_image().raise_for_status()
+        with db.SessionLocal() as session:
+            template = session.query(db.Image).filter(db.Image.owner_id == client.user_id).one()
+            session.expunge(template)
+
+        calls = {
+            "create_user": client.create_user,
+            "login": lambda: client.login(username),
+            "upload_image": client.upload_image,
+            "get_user_images": client.get_user_images,
+            "search_images": client.search_images,
+            "get_image": None,
+        }
+        results = {}
+        for size in sorted(args.sizes):
+            # Earlier uploads count towards the gallery size
+            with db.SessionLocal() as session:
+                gallery = session.query(db.Image).filter(db.Image.owner_id == client.user_id).count()
+            if size > gallery:
+                grow_gallery(db, client.user_id, template, size - gallery)
+            with db.SessionLocal() as session:
+                image_ids = [
+                    row.id
+                    for row in session.query(db.Image.id).filter(db.Image.owner_id == client.user_id)
+                ]
+            calls["get_image"] = lambda: client.get_image(random.choice(image_ids))
+
+            for endpoint in args.endpoints:
+                count = args.auth_requests if endpoint in AUTH_ENDPOINTS else args.requests
+                summary = drive(calls[endpoint], count, args.concurrency)
+                results[f"{size}/{endpoint}"] = summary
+                print(f"{size:7d} {endpoint:16s} {format_summary(summary)}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        write_results(
+            args.json,
+            results,
+            benchmark="api",
+            database=env["DATABASE_URL"].split(":")[0],
+            concurrency=args.concurrency,
+            bcrypt_rounds=args.bcrypt_rounds,
+        )
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
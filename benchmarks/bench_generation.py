@@ -0,0 +1,193 @@
+"""Time generate_image, apply_adjustments and image_to_bytes on a CPU box.
+
+Generation runs the real code path (model manager, prompt embeddings, result
+cache) around a tiny randomly initialised Stable Diffusion
+pipeline, so it measures the overhead of our code rather than of the model.
+Adjustments and encoding run on synthetic photo-like images.
+
+    python benchmarks/bench_generation.py [--repeat 20] [--json results.json]
+                                          [--baseline old.json --tolerance 0.2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from results import summarize, format_summary, write_results, compare
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A character-level vocabulary is enough for the tokenizer to accept any prompt
+VOCAB_CHARS = "abcdefghijklmnopqrstuvwxyz,.'"
+
+
+def tiny_pipeline(directory):
+    """A StableDiffusionPipeline with the real architecture at toy sizes and random weights."""
+    import torch
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, PNDMScheduler
+    from transformers import CLIPTextModel, CLIPTextConfig, CLIPTokenizer
+
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for char in VOCAB_CHARS:
+        vocab[char] = len(vocab)
+        vocab[char + "</w>"] = len(vocab)
+    with open(os.path.join(directory, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(directory, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+    torch.manual_seed(0)
+    pipeline = StableDiffusionPipeline(
+        unet=UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            sample_size=32,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+        ),
+        vae=AutoencoderKL(
+            block_out_channels=[32, 64],
+            down_block_types=["DownEncoderBlock2D"] * 2,
+            up_block_types=["UpDecoderBlock2D"] * 2,
+            latent_channels=4,
+        ),
+        text_encoder=CLIPTextModel(CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=1,
+            pad_token_id=1,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            vocab_size=len(vocab),
+        )),
+        tokenizer=CLIPTokenizer(
+            os.path.join(directory, "vocab.json"),
+            os.path.join(directory, "merges.txt"),
+            model_max_length=77,
+        ),
+        scheduler=PNDMScheduler(skip_prk_steps=True, steps_offset=1),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def sample_image(side):
+    # Smooth gradients with some grain, closer to a generated image than pure noise
+    from PIL import Image, ImageChops
+
+    gradient = Image.radial_gradient("L").resize((side, side))
+    grain = Image.effect_noise((side, side), 24)
+    return Image.merge(
+        "RGB",
+        (
+            gradient,
+            Image.linear_gradient("L").resize((side, side)),
+            ImageChops.add(gradient.transpose(Image.Transpose.ROTATE_90), grain, scale=1.5),
+        ),
+    )
+
+
+def timed(call, repeat):
+    seconds = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        call(i)
+        seconds.append(time.perf_counter() - started)
+    return summarize(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--generate-repeat", type=int, default=5)
+    parser.add_argument("--generate-sizes", type=int, nargs="+", default=[64, 128])
+    parser.add_argument("--image-sizes", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a results file written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_generation_")
+    os.environ.update(
+        CONFIG_FILE=os.path.join(workdir, "none.toml"),
+        API_URL="http://127.0.0.1:9",
+        RESULT_CACHE_PATH=os.path.join(workdir, "result_cache"),
+    )
+    sys.path.insert(0, ROOT)
+    import generation
+    import utils
+
+    generation.load_pipeline = lambda model_name: tiny_pipeline(workdir)
+    model = generation.MODEL_NAMES[0]
+    results = {}
+
+    def record(case, summary):
+        results[case] = summary
+        print(f"{case:36s} {format_summary(summary)}")
+
+    # Loading includes encoding the preset prompts and a warm-up step
+    record(
+        "load_model",
+        timed(lambda i: generation.get_model_manager().preload([model], generation.warmup_pipeline), 1),
+    )
+    for side in args.generate_sizes:
+        # A new prompt every call misses both the embedding and the result cache
+        record(
+            f"generate_image/{side}/uncached",
+            timed(
+                lambda i: generation.generate_image(model, f"a dog number {side} {i}", side, side),
+                args.generate_repeat,
+            ),
+        )
+        record(
+            f"generate_image/{side}/cached",
+            timed(
+                lambda i: generation.generate_image(model, f"a dog number {side} 0", side, side),
+                args.generate_repeat,
+            ),
+        )
+        # Four seeds of one prompt in one batched run, against four generate_image calls
+        seeds = generation.variant_seeds(4)
+        record(
+            f"generate_variants/{side}/4",
+            timed(
+                lambda i: generation.generate_variants(
+                    model, f"a cat number {side} {i}", side, side, seeds
+                ),
+                args.generate_repeat,
+            ),
+        )
+
+    for side in args.image_sizes:
+        image = sample_image(side)
+        record(
+            f"apply_adjustments/{side}",
+            timed(lambda i: utils.apply_adjustments(image, 1.2, 0.9, 1.1), args.repeat),
+        )
+        for label in utils.OUTPUT_FORMATS:
+            options = utils.output_options(label)
+            size = len(utils.image_to_bytes(image, options))
+            summary = timed(lambda i: utils.image_to_bytes(image, options), args.repeat)
+            summary["bytes"] = size
+            record(f"image_to_bytes/{side}/{label}", summary)
+
+    if args.json:
+        write_results(args.json, results, benchmark="generation", device=generation.get_device())
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Measure cold import time and peak RSS of the service entry points.
+
+Each module is imported in a fresh interpreter, so nothing is shared between
+runs. Exits non-zero when a module goes over its budget or pulls in a module it
+must not load (the API has no business importing torch).
+
+    python benchmarks/bench_import.py [--repeat 3] [--json results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module: (max seconds, max RSS in MB, modules that must not be imported)
+BUDGETS = {
+    "db": (1.5, 120, ["torch", "diffusers", "streamlit"]),
+    "app": (3.0, 200, ["torch", "diffusers", "streamlit"]),
+    "generation": (1.5, 150, ["torch", "diffusers"]),
+    "generation_service": (3.0, 200, ["torch", "diffusers", "streamlit"]),
+}
+
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    "seconds": seconds,
+    "max_rss_mb": rss_kb / 1024 if sys.platform != "darwin" else rss_kb / 1024 / 1024,
+    "loaded": sorted(name for name in {forbidden!r} if name in sys.modules),
+}}))
+"""
+
+
+def measure(module: str, forbidden):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, forbidden=forbidden)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    args = parser.parse_args()
+
+    results, failed = {}, False
+    for module in args.modules:
+        max_seconds, max_rss_mb, forbidden = BUDGETS[module]
+        runs = [measure(module, forbidden) for _ in range(args.repeat)]
+        result = {
+            "seconds": statistics.median(r["seconds"] for r in runs),
+            "max_rss_mb": max(r["max_rss_mb"] for r in runs),
+            "loaded": sorted({name for r in runs for name in r["loaded"]}),
+        }
+        problems = []
+        if result["seconds"] > max_seconds:
+            problems.append(f"import took {result['seconds']:.2f}s > {max_seconds}s")
+        if result["max_rss_mb"] > max_rss_mb:
+            problems.append(f"RSS {result['max_rss_mb']:.0f}MB > {max_rss_mb}MB")
+        if result["loaded"]:
+            problems.append(f"imported {', '.join(result['loaded'])}")
+        result["ok"] = not problems
+        results[module] = result
+        failed |= bool(problems)
+        print(
+            f"{module:20s} {result['seconds']:6.2f}s {result['max_rss_mb']:7.1f}MB  "
+            + ("ok" if not problems else "FAIL: " + "; ".join(problems))
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
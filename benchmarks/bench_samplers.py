@@ -0,0 +1,150 @@
+"""Wall-clock time against fidelity for each sampler and step count, on CPU.
+
+Runs the denoising loop of a Stable Diffusion pipeline (SD 1.x noise schedule,
+classifier-free guidance) around a small randomly initialised sd_scratch UNet,
+and compares the final latents of every sampler and step count with those of a
+high-step DPM-Solver++ run from the same noise. With random weights the numbers
+show how quickly each sampler converges, not how good the images look; the
+ancestral samplers (Euler a, LCM) add fresh noise and never converge to the
+reference. For each sampler it prints the fewest steps within ``--max-error``.
+
+    python benchmarks/bench_samplers.py [--steps 4 8 12 20 30] [--reference-steps 100]
+                                        [--max-error 0.05] [--json results.json]
+                                        [--baseline old.json --tolerance 0.2]
+"""
+import argparse
+import inspect
+import os
+import sys
+import tempfile
+import time
+
+from results import summarize, format_summary, write_results, compare
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The scheduler config shipped with SD 1.x checkpoints
+SD_SCHEDULER_CONFIG = {
+    "num_train_timesteps": 1000,
+    "beta_start": 0.00085,
+    "beta_end": 0.012,
+    "beta_schedule": "scaled_linear",
+    "prediction_type": "epsilon",
+    "set_alpha_to_one": False,
+    "skip_prk_steps": True,
+    "steps_offset": 1,
+    "clip_sample": False,
+}
+REFERENCE_SAMPLER = "DPM-Solver++"
+
+
+def make_scheduler(name):
+    import diffusers
+    from generation import SAMPLERS
+
+    scheduler, overrides = SAMPLERS[name]
+    return getattr(diffusers, scheduler).from_config(SD_SCHEDULER_CONFIG, **overrides)
+
+
+def sample(unet, scheduler, context, noise, steps, guidance_scale, seed):
+    """The pipeline's denoising loop: final latents for ``noise`` after ``steps`` steps."""
+    import torch
+
+    # Only the stochastic samplers take a generator, as in the pipeline's prepare_extra_step_kwargs
+    extra = {}
+    if "generator" in inspect.signature(scheduler.step).parameters:
+        extra["generator"] = torch.Generator().manual_seed(seed)
+    scheduler.set_timesteps(steps)
+    latents = noise * scheduler.init_noise_sigma
+    for t in scheduler.timesteps:
+        model_input = scheduler.scale_model_input(torch.cat([latents] * 2), t)
+        uncond, cond = unet(model_input, context, t).chunk(2)
+        noise_pred = uncond + guidance_scale * (cond - uncond)
+        latents = scheduler.step(noise_pred, t, latents, **extra).prev_sample
+    return latents
+
+
+def relative_error(latents, reference):
+    return float((latents - reference).norm() / reference.norm())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, nargs="+", default=[4, 8, 12, 20, 30])
+    parser.add_argument("--reference-steps", type=int, default=100)
+    parser.add_argument("--samplers", nargs="+", help="default: all of generation.SAMPLERS")
+    parser.add_argument("--size", type=int, default=256, help="image side in pixels")
+    parser.add_argument("--guidance-scale", type=float, default=7.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-error", type=float, default=0.05)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a results file written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_samplers_")
+    os.environ.update(
+        CONFIG_FILE=os.path.join(workdir, "none.toml"), RESULT_CACHE_MB="0"
+    )
+    sys.path.insert(0, ROOT)
+    import torch
+    from generation import SAMPLERS
+    from sd_scratch import UNet
+
+    torch.set_grad_enabled(False)
+    torch.manual_seed(0)
+    unet = UNet(dims=(32, 64, 64), dim_kv=64, dim_time=128, heads=2).eval()
+    # Unconditional and conditional text embeddings, as classifier-free guidance batches them
+    context = torch.randn(2, 77, 64)
+    noise = torch.randn(1, 4, args.size // 8, args.size // 8)
+
+    reference = sample(
+        unet, make_scheduler(REFERENCE_SAMPLER), context, noise,
+        args.reference_steps, args.guidance_scale, seed=0,
+    )
+    print(f"reference: {REFERENCE_SAMPLER}, {args.reference_steps} steps\n")
+
+    results = {}
+    fastest = {}
+    for name in args.samplers or SAMPLERS:
+        scheduler = make_scheduler(name)
+        for steps in args.steps:
+            seconds = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                latents = sample(
+                    unet, scheduler, context, noise, steps, args.guidance_scale, seed=0
+                )
+                seconds.append(time.perf_counter() - started)
+            summary = summarize(seconds)
+            summary["rel_error"] = relative_error(latents, reference)
+            results[f"{name}/{steps}"] = summary
+            print(
+                f"{name + '/' + str(steps):28s} {format_summary(summary)}"
+                f"  error {summary['rel_error']:7.2%}"
+            )
+            if name not in fastest and summary["rel_error"] <= args.max_error:
+                fastest[name] = (steps, summary["mean_ms"])
+
+    print(f"\nfewest steps within {args.max_error:.0%} of the reference:")
+    for name in args.samplers or SAMPLERS:
+        if name in fastest:
+            steps, mean_ms = fastest[name]
+            print(f"  {name:24s} {steps:3d} steps  {mean_ms:8.1f} ms")
+        else:
+            print(f"  {name:24s}   none of {args.steps}")
+
+    if args.json:
+        write_results(
+            args.json, results, benchmark="samplers",
+            reference=f"{REFERENCE_SAMPLER}/{args.reference_steps}", size=args.size,
+        )
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
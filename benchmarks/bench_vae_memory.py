@@ -0,0 +1,87 @@
+"""Peak memory of a VAE decode at 512 and 1024 on CPU, full-frame vs tiled.
+
+Uses the sd_scratch VAE with random weights (memory does not depend on them).
+Each case runs in a fresh interpreter and reports the growth of its peak RSS
+over the model's own footprint, so the cases do not pollute each other.
+
+    python benchmarks/bench_vae_memory.py [--sizes 512 1024] [--json results.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, resource, time, torch
+from sd_scratch import VAE, set_attention_backend
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+torch.set_grad_enabled(False)
+set_attention_backend({backend!r})
+vae = VAE().eval()
+z = torch.randn(1, 4, {size} // 8, {size} // 8)
+baseline = peak_mb()
+started = time.perf_counter()
+image = vae.decode(z, tile_size={tile!r}, overlap={overlap})
+print(json.dumps({{
+    "seconds": time.perf_counter() - started,
+    "peak_mb": peak_mb(),
+    "delta_mb": peak_mb() - baseline,
+    "shape": list(image.shape),
+}}))
+"""
+
+CASES = [
+    # name, attention backend, tile size in latent pixels
+    ("full/naive", "naive", None),
+    ("full/sdpa", "sdpa", None),
+    ("tiled/sdpa", "sdpa", 72),
+]
+
+
+def run_case(size, backend, tile, overlap):
+    code = PROBE.format(size=size, backend=backend, tile=tile, overlap=overlap)
+    process = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        # Killed by the OOM killer (-9) or a MemoryError are both results worth reporting
+        return {"error": process.stderr.strip().splitlines()[-1:] or [f"exit {process.returncode}"]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--overlap", type=int, default=16)
+    parser.add_argument("--cases", nargs="+", default=[name for name, _, _ in CASES])
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        for name, backend, tile in CASES:
+            if name not in args.cases:
+                continue
+            result = run_case(size, backend, tile, args.overlap)
+            results[f"{size}/{name}"] = result
+            if "error" in result:
+                print(f"{size:5d} {name:12s} failed: {result['error']}")
+            else:
+                print(
+                    f"{size:5d} {name:12s} {result['seconds']:7.1f}s "
+                    f"peak {result['peak_mb']:7.0f}MB (+{result['delta_mb']:.0f}MB)"
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
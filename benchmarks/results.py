@@ -0,0 +1,86 @@
+"""Shared helpers for the benchmarks: latency summaries and baseline comparison.
+
+Results files are JSON ``{"meta": {...}, "results": {case: {metric: value}}}``.
+Passing one as ``--baseline`` prints the change of every metric and fails the
+run when a metric regresses by more than the tolerance.
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+# Metrics where a larger value is the better one; every other metric is a cost
+HIGHER_IS_BETTER = {"rps"}
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(seconds, wall_seconds=None, errors=0):
+    """Latency summary in milliseconds of a list of per-call durations in seconds."""
+    if not seconds:
+        return {"requests": 0, "errors": errors}
+    summary = {
+        "requests": len(seconds),
+        "errors": errors,
+        "p50_ms": percentile(seconds, 50) * 1000,
+        "p99_ms": percentile(seconds, 99) * 1000,
+        "mean_ms": statistics.fmean(seconds) * 1000,
+    }
+    if wall_seconds:
+        summary["rps"] = len(seconds) / wall_seconds
+    return summary
+
+
+def format_summary(summary):
+    if not summary["requests"]:
+        return f"no successful calls, {summary['errors']} errors"
+    line = f"p50 {summary['p50_ms']:8.2f}ms  p99 {summary['p99_ms']:8.2f}ms"
+    if "rps" in summary:
+        line += f"  {summary['rps']:8.1f} req/s"
+    if summary.get("errors"):
+        line += f"  {summary['errors']} errors"
+    return line
+
+
+def write_results(path, results, **meta):
+    meta.update(
+        created_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=sys.version.split()[0],
+        machine=platform.machine(),
+        cpu_count=os.cpu_count(),
+    )
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+def compare(results, baseline_path, tolerance):
+    """Print each metric against the baseline; return the regressions beyond ``tolerance``."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    for case, metrics in results.items():
+        before = baseline.get(case)
+        if not before:
+            print(f"{case:32s} not in the baseline")
+            continue
+        changes = []
+        for metric, value in metrics.items():
+            old = before.get(metric)
+            if metric in ("requests", "errors") or not isinstance(value, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            changes.append(f"{metric} {change:+.0%}")
+            if worse > tolerance:
+                regressions.append(f"{case} {metric}: {old:.2f} -> {value:.2f}")
+        print(f"{case:32s} " + "  ".join(changes))
+    return regressions
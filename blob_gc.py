@@ -0,0 +1,170 @@
+"""Reclaim deleted images: their rows, renditions and the blobs nothing refers to any more.
+
+Deleting an image only sets ``deleted_at`` in one short UPDATE, so listings drop
+it at once. The API then runs a background thread that removes such rows in
+batches, once they are ``DELETE_GRACE_SECONDS`` old (responses still streaming
+their blobs get to finish), and deletes every blob left without a reference.
+
+Nothing else deletes blobs. Uploads, imports and workers store a blob before
+the row referring to it is committed, and deduplicate against blobs that are
+already there, so a blob is only deleted once it has not been written for
+``DELETE_GRACE_SECONDS`` (a deduplicated write renews it). Blobs whose row never
+got committed, such as uploads that turned out not to be images, are found by
+a sweep over the whole store every ``BLOB_SWEEP_INTERVAL_SECONDS``.
+
+    python blob_gc.py   # collect and sweep everything that is due now, then exit
+"""
+import datetime
+import itertools
+import logging
+import threading
+import time
+
+import config
+import metrics
+from db import Image, ImageRendition, SessionLocal, blob_store
+
+GC_INTERVAL_SECONDS = config.get_float("BLOB_GC_INTERVAL_SECONDS", 60)
+GC_BATCH_SIZE = config.get_int("BLOB_GC_BATCH_SIZE", 200)
+DELETE_GRACE_SECONDS = config.get_float("DELETE_GRACE_SECONDS", 300)
+SWEEP_INTERVAL_SECONDS = config.get_float("BLOB_SWEEP_INTERVAL_SECONDS", 3600)
+# Digests checked for references per query
+SWEEP_CHUNK = 500
+
+logger = logging.getLogger(__name__)
+
+
+def unreferenced(db, digests):
+    digests = list(digests)
+    if not digests:
+        return set()
+    referenced = {
+        digest for (digest,) in db.query(Image.sha256).filter(Image.sha256.in_(digests))
+    }
+    referenced |= {
+        digest
+        for (digest,) in db.query(ImageRendition.sha256).filter(
+            ImageRendition.sha256.in_(digests)
+        )
+    }
+    return set(digests) - referenced
+
+
+def delete_unreferenced(db, digests, grace_seconds=DELETE_GRACE_SECONDS) -> int:
+    # Blobs are shared between identical images, only the last reference frees one
+    return sum(
+        blob_store.delete(digest, min_age=grace_seconds)
+        for digest in unreferenced(db, digests)
+    )
+
+
+def collect_batch(db, batch_size=GC_BATCH_SIZE, grace_seconds=DELETE_GRACE_SECONDS):
+    """Remove one batch of deleted images that are due; returns (images, blobs) removed."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_seconds)
+    # SKIP LOCKED lets several API processes collect side by side (ignored on SQLite)
+    ids = [
+        image_id
+        for (image_id,) in db.query(Image.id)
+        .filter(Image.deleted_at.isnot(None), Image.deleted_at <= cutoff)
+        .order_by(Image.deleted_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ]
+    if not ids:
+        db.rollback()
+        return 0, 0
+
+    digests = {digest for (digest,) in db.query(Image.sha256).filter(Image.id.in_(ids))}
+    digests |= {
+        digest
+        for (digest,) in db.query(ImageRendition.sha256).filter(
+            ImageRendition.image_id.in_(ids)
+        )
+    }
+    digests.discard(None)
+    db.query(ImageRendition).filter(ImageRendition.image_id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    db.query(Image).filter(Image.id.in_(ids)).delete(synchronize_session=False)
+    db.commit()
+
+    # Only after the commit, so a failed transaction never leaves rows without blobs
+    blobs = delete_unreferenced(db, digests, grace_seconds)
+    metrics.gc_reclaimed.inc(len(ids), kind="images")
+    metrics.gc_reclaimed.inc(blobs, kind="blobs")
+    return len(ids), blobs
+
+
+def collect(batch_size=GC_BATCH_SIZE, grace_seconds=DELETE_GRACE_SECONDS):
+    """Collect batches until none is due; returns the totals of (images, blobs) removed."""
+    images = blobs = 0
+    while True:
+        db = SessionLocal()
+        try:
+            with metrics.stage("blob_gc"):
+                batch_images, batch_blobs = collect_batch(db, batch_size, grace_seconds)
+        finally:
+            db.close()
+        images += batch_images
+        blobs += batch_blobs
+        if batch_images < batch_size:
+            return images, blobs
+
+
+def sweep(grace_seconds=DELETE_GRACE_SECONDS):
+    """Delete every blob of the store that nothing refers to; returns how many went."""
+    deleted = 0
+    digests = blob_store.iter_digests(min_age=grace_seconds)
+    while chunk := list(itertools.islice(digests, SWEEP_CHUNK)):
+        db = SessionLocal()
+        try:
+            with metrics.stage("blob_sweep"):
+                deleted += delete_unreferenced(db, chunk, grace_seconds)
+        finally:
+            db.close()
+    metrics.gc_reclaimed.inc(deleted, kind="blobs")
+    return deleted
+
+
+class BlobCollector:
+    """Runs :func:`collect` every ``interval`` seconds and :func:`sweep` every
+    ``sweep_interval`` seconds on a daemon thread."""
+
+    def __init__(self, interval=GC_INTERVAL_SECONDS, batch_size=GC_BATCH_SIZE,
+                 grace_seconds=DELETE_GRACE_SECONDS, sweep_interval=SWEEP_INTERVAL_SECONDS):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace_seconds = grace_seconds
+        self.sweep_interval = sweep_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="blob-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        # The first sweep waits a full interval, so restarts do not walk the store each time
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                images, blobs = collect(self.batch_size, self.grace_seconds)
+                if images:
+                    logger.info("Reclaimed %d deleted images and %d blobs", images, blobs)
+                if self.sweep_interval and time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    blobs = sweep(self.grace_seconds)
+                    if blobs:
+                        logger.info("Swept %d unreferenced blobs", blobs)
+            except Exception:
+                logger.exception("Blob garbage collection failed")
+
+
+if __name__ == "__main__":
+    print("Reclaimed %d deleted images and %d blobs" % collect())
+    print("Swept %d unreferenced blobs" % sweep())
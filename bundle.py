@@ -0,0 +1,37 @@
+import json
+import struct
+
+# A bundle is a sequence of records: a 4-byte big-endian header length, a JSON
+# header, then header["length"] bytes of payload (0 when absent).
+HEADER_PREFIX = struct.Struct(">I")
+CONTENT_TYPE = "application/x-image-bundle"
+
+
+def pack_header(header: dict) -> bytes:
+    header = {"length": 0, **header}
+    encoded = json.dumps(header, default=str).encode("utf-8")
+    return HEADER_PREFIX.pack(len(encoded)) + encoded
+
+
+def _read_exactly(stream, n: int) -> bytes:
+    chunks = []
+    while n:
+        chunk = stream.read(n)
+        if not chunk:
+            raise EOFError("Truncated bundle")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def iter_records(stream):
+    """Yield (header, payload) pairs from a file-like object holding a bundle."""
+    while True:
+        prefix = stream.read(HEADER_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) < HEADER_PREFIX.size:
+            prefix += _read_exactly(stream, HEADER_PREFIX.size - len(prefix))
+        (header_length,) = HEADER_PREFIX.unpack(prefix)
+        header = json.loads(_read_exactly(stream, header_length))
+        yield header, _read_exactly(stream, header["length"])
@@ -0,0 +1,72 @@
+import json
+import os
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11; streamlit depends on toml
+    tomllib = None
+    import toml
+
+# Settings come from environment variables first, then from a TOML file
+# (.streamlit/secrets.toml unless CONFIG_FILE points elsewhere), then defaults.
+CONFIG_FILE = os.environ.get("CONFIG_FILE", os.path.join(".streamlit", "secrets.toml"))
+
+
+def _load_file(path: str) -> dict:
+    try:
+        if tomllib is None:
+            return toml.load(path)
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+_file_settings = _load_file(CONFIG_FILE)
+
+
+def get(name: str, default=None):
+    if name in os.environ:
+        return os.environ[name]
+    return _file_settings.get(name, default)
+
+
+def require(name: str):
+    value = get(name)
+    if value is None:
+        raise RuntimeError(f"{name} is not set in the environment or {CONFIG_FILE}")
+    return value
+
+
+def get_int(name: str, default=None):
+    value = get(name, default)
+    return None if value is None or value == "" else int(value)
+
+
+def get_float(name: str, default=None):
+    value = get(name, default)
+    return None if value is None or value == "" else float(value)
+
+
+def get_bool(name: str, default=False) -> bool:
+    value = get(name, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def get_list(name: str, default=()):
+    # Lists are TOML arrays in the file and comma-separated in the environment
+    value = get(name, default)
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return list(value)
+
+
+def get_table(name: str, default=None) -> dict:
+    # Tables are TOML tables in the file and JSON objects in the environment
+    value = get(name, default)
+    if isinstance(value, str):
+        return json.loads(value)
+    return dict(value or {})
@@ -0,0 +1,185 @@
+import datetime
+from sqlalchemy import (
+    create_engine,
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Date,
+    DateTime,
+    Float,
+    Index,
+    JSON,
+    inspect,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, relationship
+
+import config
+from db_stats import PoolMonitor
+from search import create_search_index
+from storage import create_blob_store
+
+DATABASE_URL = config.require("DATABASE_URL")
+
+pool_monitor = PoolMonitor(
+    slow_session_seconds=config.get_float("DB_SLOW_SESSION_SECONDS", 5),
+    slow_query_seconds=config.get_float("DB_SLOW_QUERY_SECONDS", 1),
+    max_statements=config.get_int("DB_STATS_MAX_STATEMENTS", 500),
+)
+
+
+def engine_options(url: str) -> dict:
+    url = make_url(url)
+    options = {
+        "pool_pre_ping": config.get_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": config.get_int("DB_POOL_RECYCLE", 1800),
+    }
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in a single connection, there is no pool to size
+        return options
+
+    options.update(
+        poolclass=pool_monitor.pool_class(),
+        pool_size=config.get_int("DB_POOL_SIZE", 5),
+        max_overflow=config.get_int("DB_MAX_OVERFLOW", 10),
+        pool_timeout=config.get_float("DB_POOL_TIMEOUT", 30),
+    )
+    statement_timeout_ms = config.get_int("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout_ms and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout_ms}"}
+    return options
+
+
+engine = pool_monitor.attach(create_engine(DATABASE_URL, **engine_options(DATABASE_URL)))
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+Base = declarative_base()
+
+blob_store = create_blob_store(
+    config.get("BLOB_STORE", "local"),
+    root=config.get("BLOB_STORE_PATH", "gallery/blobs"),
+)
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, unique=True, index=True)
+    hashed_password = Column(String)
+    email = Column(String)
+    date_of_birth = Column(Date)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    images = relationship("Image", back_populates="owner")
+
+
+class Image(Base):
+    __tablename__ = "images"
+
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String)
+    sha256 = Column(String(64), index=True)
+    size = Column(Integer)
+    content_type = Column(String, default="image/png")
+    prompt = Column(String)
+    owner_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Set on delete; the row and its blobs are reclaimed later by blob_gc
+    deleted_at = Column(DateTime, nullable=True, index=True)
+
+    owner = relationship("User", back_populates="images")
+
+    # Gallery listings are keyset-paginated per owner by (created_at, id)
+    __table_args__ = (
+        Index("ix_images_owner_id_created_at", "owner_id", "created_at", "id"),
+    )
+
+    renditions = relationship(
+        "ImageRendition", back_populates="image", cascade="all, delete-orphan"
+    )
+
+
+class ImageRendition(Base):
+    __tablename__ = "image_renditions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    image_id = Column(Integer, ForeignKey("images.id"), index=True)
+    max_side = Column(Integer)
+    content_type = Column(String)
+    sha256 = Column(String(64), index=True)
+    size = Column(Integer)
+
+    image = relationship("Image", back_populates="renditions")
+
+
+class GenerationJob(Base):
+    """A generation request in the job queue, run by worker.py (see job_queue)."""
+
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # queued -> running -> done, failed or cancelled; running goes back to queued on a retry
+    status = Column(String, default="queued")
+    model_name = Column(String)
+    prompt = Column(String)
+    height = Column(Integer)
+    width = Column(Integer)
+    # One image per seed
+    seeds = Column(JSON)
+    sampler = Column(String)
+    steps = Column(Integer)
+    guidance_scale = Column(Float)
+    # Claims so far; the worker holding the lease is identified by (worker, attempts)
+    attempts = Column(Integer, default=0)
+    worker = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    step = Column(Integer, default=0)
+    total_steps = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    # The gallery images written by the job, in seed order
+    image_ids = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    # Workers claim the oldest claimable job
+    __table_args__ = (
+        Index("ix_generation_jobs_status_created_at", "status", "created_at"),
+    )
+
+
+def stale_columns():
+    # Columns the models have but existing tables lack (create_all never alters a
+    # table), plus the image bytes column the blob store replaced
+    inspector = inspect(engine)
+    stale = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        stale += [f"{table.name}.{name}" for name in table.columns.keys() if name not in existing]
+        if table.name == "images" and "data" in existing:
+            stale.append("images.data")
+    return stale
+
+
+def create_tables():
+    stale = stale_columns()
+    if stale:
+        raise RuntimeError(
+            f"The database schema is out of date ({', '.join(stale)}), run python migrate.py"
+        )
+    Base.metadata.create_all(bind=engine)
+    create_search_index(engine)
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
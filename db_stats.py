@@ -0,0 +1,184 @@
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# The items of an IN list, however many there are
+_IN_LIST = re.compile(r"\bIN \((?!\s*SELECT\b)(?:[^()]|\([^()]*\))*\)", re.IGNORECASE)
+
+# Frames from these paths (the stdlib, installed packages and this module) are not callers
+_SKIP_PATHS = (os.path.dirname(threading.__file__), os.path.abspath(__file__))
+
+
+def _caller():
+    # The innermost application frame names the code path that took the connection
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        # "<string>" frames come from code SQLAlchemy generates at import time
+        if not path.startswith(_SKIP_PATHS + ("<",)) and "site-packages" not in path:
+            return f"{os.path.basename(path)}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def _statement_key(statement):
+    # Keyed by the text without parameters, like pg_stat_statements. IN lists of different
+    # lengths are one statement, otherwise every length would get an entry of its own.
+    return _IN_LIST.sub("IN (...)", " ".join(statement.split()))[:200]
+
+
+def _summary(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class PoolMonitor:
+    """Connection pool and query timings for one engine.
+
+    Tracks how long callers wait for a connection, who holds each checked-out
+    connection and for how long, and the latency of every statement. At most
+    ``max_statements`` statements are kept, the least recently run go first.
+    """
+
+    def __init__(
+            self, slow_session_seconds=5.0, slow_query_seconds=1.0, samples=1000, max_statements=500
+    ):
+        self.slow_session_seconds = slow_session_seconds
+        self.slow_query_seconds = slow_query_seconds
+        self._lock = threading.Lock()
+        self._waits = collections.deque(maxlen=samples)
+        self._held = collections.deque(maxlen=samples)
+        self._queries = collections.deque(maxlen=samples)
+        self._checked_out = {}
+        self._long_held = collections.deque(maxlen=50)
+        self.max_statements = max_statements
+        self._statements = collections.OrderedDict()
+        self._totals = collections.Counter()
+        self.engine = None
+
+    def pool_class(self, base=QueuePool):
+        # A subclass rather than an instance attribute, so it survives pool.recreate()
+        monitor = self
+
+        class TimedPool(base):
+            def _do_get(self):
+                started = time.perf_counter()
+                try:
+                    return super()._do_get()
+                except PoolTimeout:
+                    monitor._record_timeout()
+                    raise
+                finally:
+                    monitor._record_wait(time.perf_counter() - started)
+
+        return TimedPool
+
+    def attach(self, engine):
+        self.engine = engine
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._on_error)
+        return engine
+
+    def _record_wait(self, seconds):
+        with self._lock:
+            self._waits.append(seconds)
+            self._totals["checkouts"] += 1
+
+    def _record_timeout(self):
+        with self._lock:
+            self._totals["timeouts"] += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self._checked_out[id(connection_record)] = (time.monotonic(), _caller())
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            entry = self._checked_out.pop(id(connection_record), None)
+            if entry is None:
+                return
+            started, caller = entry
+            held = time.monotonic() - started
+            self._held.append(held)
+            if held < self.slow_session_seconds:
+                return
+            self._totals["long_held"] += 1
+            self._long_held.append(
+                {"caller": caller, "held_seconds": round(held, 3), "at": time.time()}
+            )
+        logger.warning("Connection held for %.1fs by %s", held, caller)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        key = _statement_key(statement)
+        with self._lock:
+            self._queries.append(seconds)
+            count, total, slowest = self._statements.pop(key, (0, 0.0, 0.0))
+            self._statements[key] = (count + 1, total + seconds, max(slowest, seconds))
+            if len(self._statements) > self.max_statements:
+                self._statements.popitem(last=False)
+            self._totals["queries"] += 1
+        if seconds >= self.slow_query_seconds:
+            logger.warning("Slow query (%.2fs): %s", seconds, key)
+
+    def _on_error(self, context):
+        # A failed statement never reaches after_cursor_execute; drop its start time, or it
+        # would stay on the pooled connection for good
+        connection = context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    def stats(self, top=10):
+        pool = self.engine.pool if self.engine is not None else None
+        now = time.monotonic()
+        with self._lock:
+            holders = sorted(
+                (
+                    {"caller": caller, "held_seconds": round(now - started, 3)}
+                    for started, caller in self._checked_out.values()
+                ),
+                key=lambda h: -h["held_seconds"],
+            )
+            statements = sorted(self._statements.items(), key=lambda s: -s[1][1])[:top]
+            return {
+                "pool": pool.status() if pool is not None else None,
+                "wait": _summary(self._waits),
+                "held": _summary(self._held),
+                "queries": _summary(self._queries),
+                "totals": dict(self._totals),
+                "checked_out": holders,
+                "long_held": list(self._long_held),
+                "slowest_statements": [
+                    {
+                        "statement": key,
+                        "count": count,
+                        "total_ms": round(total * 1000, 3),
+                        "mean_ms": round(total / count * 1000, 3),
+                        "max_ms": round(slowest * 1000, 3),
+                    }
+                    for key, (count, total, slowest) in statements
+                ],
+            }
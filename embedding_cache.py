@@ -0,0 +1,66 @@
+import collections
+import threading
+
+
+def tensors_nbytes(tensors) -> int:
+    return sum(t.element_size() * t.nelement() for t in tensors if t is not None)
+
+
+class EmbeddingCache:
+    """LRU cache of text-encoder outputs keyed by (model_name, prompt).
+
+    Bounded both by entry count and by the total size of the cached tensors.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_encode(self, model_name: str, prompt: str, encode):
+        key = (model_name, prompt)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # Encode outside the lock, a duplicate encode is cheaper than serialising callers
+        tensors = tuple(encode(prompt))
+        self.put(model_name, prompt, tensors)
+        return tensors
+
+    def put(self, model_name: str, prompt: str, tensors):
+        key = (model_name, prompt)
+        size = tensors_nbytes(tensors)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= tensors_nbytes(self._entries.pop(key))
+            self._entries[key] = tensors
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= tensors_nbytes(evicted)
+
+    def evict_model(self, model_name: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_name]:
+                self._bytes -= tensors_nbytes(self._entries.pop(key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,102 @@
+import collections
+import hashlib
+import io
+import threading
+
+import metrics
+
+# format name: (PIL format, content type, file extension)
+FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+def image_content_id(image) -> str:
+    """Digest of the decoded pixels, so equal images share cache entries."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode("ascii"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def encode_options(fmt="png", quality=90, lossless=False, compress_level=6):
+    """Normalised, hashable encoder settings; options a format ignores are dropped."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown image format: {fmt}")
+    if fmt == "png":
+        return ("png", None, True, compress_level)
+    if fmt == "webp" and lossless:
+        return ("webp", quality, True, None)
+    return (fmt, quality, False, None)
+
+
+def encode_image(image, options=encode_options()) -> bytes:
+    fmt, quality, lossless, compress_level = options
+    buffer = io.BytesIO()
+    with metrics.stage(f"{fmt}_encode"):
+        if fmt == "png":
+            image.save(buffer, format="PNG", compress_level=compress_level)
+        elif fmt == "webp":
+            # For lossless WebP, quality trades encode time for size instead of fidelity
+            image.save(buffer, format="WEBP", quality=quality, lossless=lossless, method=4)
+        else:
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+class EncodedImageCache:
+    """LRU of encoded image bytes, bounded by their total size.
+
+    Keys are chosen by the caller, typically (content id, adjustments, encode options),
+    so each variant of an image is encoded at most once.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def get_or_encode(self, key, encode):
+        data = self.get(key)
+        if data is not None:
+            with self._lock:
+                self.hits += 1
+            return data
+        data = encode()
+        with self._lock:
+            self.misses += 1
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = data
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,520 @@
+import functools
+import gc
+import os
+import queue
+import threading
+import time
+
+import config
+import metrics
+from embedding_cache import EmbeddingCache
+from result_cache import ResultCache, result_key
+from model_manager import ModelManager
+from generation_request import MAX_GUIDANCE_SCALE, MAX_STEPS, MAX_VARIANTS, MODEL_NAMES
+
+# torch and diffusers are imported inside the functions that need them, so that
+# importing this module (e.g. for PRESET_PROMPTS) stays cheap.
+
+NEGATIVE_PROMPT = (
+    "lowres, bad anatomy, extra digit, fewer digits, cropped, worst quality, low quality"
+)
+PRESET_PROMPTS = {
+    "Dog": "A playful dog running in a park",
+    "Cat": "A cat lounging in a sunbeam",
+    "Pokemon": "A Pikachu on the grass",
+}
+SDXL_MODELS = {"SD Dogs"}
+
+NUM_INFERENCE_STEPS = 20
+GUIDANCE_SCALE = 7.5
+SEED = 10
+
+# Sampler name -> diffusers scheduler class and the overrides of the model's scheduler config
+SAMPLERS = {
+    "PNDM": ("PNDMScheduler", {}),
+    "DPM-Solver++": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++"}),
+    "DPM-Solver++ Karras": (
+        "DPMSolverMultistepScheduler",
+        {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True},
+    ),
+    "Euler": ("EulerDiscreteScheduler", {}),
+    "Euler a": ("EulerAncestralDiscreteScheduler", {}),
+    "UniPC": ("UniPCMultistepScheduler", {}),
+    # Few-step sampling, only for consistency-distilled models (add it to their "samplers")
+    "LCM": ("LCMScheduler", {}),
+}
+
+# Per-model defaults and the samplers offered; override in the config file with e.g.
+# [MODEL_PRESETS."SD V1.5"] sampler = "DPM-Solver++", steps = 12
+DEFAULT_PRESET = {
+    "sampler": "PNDM",
+    "steps": NUM_INFERENCE_STEPS,
+    "guidance_scale": GUIDANCE_SCALE,
+    "samplers": [name for name in SAMPLERS if name != "LCM"],
+}
+MODEL_PRESETS = {
+    name: {**DEFAULT_PRESET, **config.get_table("MODEL_PRESETS").get(name, {})}
+    for name in MODEL_NAMES
+}
+
+# Decoding 1024px images in tiles keeps the VAE's peak memory near that of 512px ones;
+# on by default on CPU, where there is no separate device memory to fall back on
+VAE_TILING = config.get("VAE_TILING")
+
+# Variants of one prompt run as one batch, split into sub-batches that fit in memory.
+# SAMPLE_MB_PER_MEGAPIXEL is a deliberately high estimate of a sample's peak memory per
+# output megapixel (guidance doubles the batch); running out of memory halves the sub-batch.
+MAX_SUB_BATCH = config.get_int("GENERATION_MAX_SUB_BATCH", 8)
+SAMPLE_MB_PER_MEGAPIXEL = config.get_int("SAMPLE_MB_PER_MEGAPIXEL", 3000)
+
+# Streaming runs send a cheap latent preview every PREVIEW_EVERY steps (0 disables them)
+PREVIEW_EVERY = config.get_int("PREVIEW_EVERY", 5)
+
+# Linear maps from the 4 latent channels to RGB, a rough stand-in for a VAE decode
+LATENT_RGB_FACTORS = {
+    "sd": [
+        [0.3512, 0.2297, 0.3227],
+        [0.3250, 0.4974, 0.2350],
+        [-0.2829, 0.1762, 0.2721],
+        [-0.2120, -0.2616, -0.7177],
+    ],
+    "sdxl": [
+        [0.3920, 0.4054, 0.4549],
+        [-0.2634, -0.0196, 0.0653],
+        [0.0568, 0.1687, -0.0755],
+        [-0.3112, -0.2359, -0.2076],
+    ],
+}
+
+embedding_cache = EmbeddingCache(
+    max_entries=config.get_int("EMBEDDING_CACHE_ENTRIES", 256),
+    max_bytes=config.get_int("EMBEDDING_CACHE_MB", 256) * 1024 * 1024,
+)
+
+# Generation is deterministic, so identical requests are served from disk (0 MB disables it)
+RESULT_CACHE_MB = config.get_int("RESULT_CACHE_MB", 1024)
+result_cache = (
+    ResultCache(
+        config.get("RESULT_CACHE_PATH", "gallery/result_cache"),
+        max_bytes=RESULT_CACHE_MB * 1024 * 1024,
+    )
+    if RESULT_CACHE_MB
+    else None
+)
+
+
+@functools.cache
+def get_device():
+    import torch
+
+    return (
+        "cuda"
+        if torch.cuda.is_available()
+        else "mps" if torch.backends.mps.is_available() else "cpu"
+    )
+
+
+def load_pipeline(model_name: str):
+    import torch
+    from diffusers import StableDiffusionPipeline, DiffusionPipeline, AutoencoderKL
+
+    device = get_device()
+    if model_name == "SD V1.5":
+        return StableDiffusionPipeline.from_pretrained(
+            "runwayml/stable-diffusion-v1-5",
+            torch_dtype=torch.float16,
+            use_safetensors=False,
+        ).to(device)
+    elif model_name == "SD Pokemon":
+        return StableDiffusionPipeline.from_pretrained(
+            "lambdalabs/sd-pokemon-diffusers",
+            torch_dtype=torch.float16,
+            use_safetensors=False,
+        ).to(device)
+    elif model_name == "SD Dogs":
+        vae = AutoencoderKL.from_pretrained(
+            "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
+        )
+        pipe = DiffusionPipeline.from_pretrained(
+            "stabilityai/stable-diffusion-xl-base-1.0",
+            vae=vae,
+            torch_dtype=torch.float16,
+            variant="fp16",
+            use_safetensors=True,
+        )
+        pipe.load_lora_weights("whydelete/husky_lora")
+        return pipe.to(device)
+    else:
+        return None
+
+
+def vae_tiling_enabled():
+    if VAE_TILING is None:
+        return get_device() == "cpu"
+    return config.get_bool("VAE_TILING")
+
+
+def build_pipeline(model_name: str):
+    pipeline = load_pipeline(model_name)
+    if pipeline is not None:
+        if vae_tiling_enabled():
+            pipeline.enable_vae_tiling()
+        # The negative prompt and the presets cover most requests, encode them up front
+        for prompt in [NEGATIVE_PROMPT, *PRESET_PROMPTS.values()]:
+            encode_prompt(pipeline, model_name, prompt)
+    return pipeline
+
+
+def warmup_pipeline(model_name: str, pipeline):
+    # A single small step initialises kernels and allocator pools before real traffic
+    pipeline(
+        height=256,
+        width=256,
+        num_inference_steps=1,
+        **prompt_embedding_kwargs(pipeline, model_name, [PRESET_PROMPTS["Dog"]]),
+    )
+
+
+@functools.cache
+def get_model_manager():
+    budget_mb = config.get_int("MODEL_MEMORY_BUDGET_MB")
+    return ModelManager(
+        build_pipeline,
+        get_device(),
+        budget_bytes=budget_mb * 1024 * 1024 if budget_mb else None,
+        offload=config.get_bool("MODEL_OFFLOAD"),
+        on_evict=embedding_cache.evict_model,
+        # Sizes of models not loaded yet, so a first load evicts enough beforehand
+        size_estimates={
+            name: int(mb * 1024 * 1024)
+            for name, mb in config.get_table("MODEL_SIZES_MB").items()
+        },
+    )
+
+
+def preload_models():
+    # PRELOAD_MODELS is a list of model names to load and warm up at startup
+    get_model_manager().preload(
+        config.get_list("PRELOAD_MODELS"), warmup=warmup_pipeline
+    )
+
+
+def encode_prompt(pipeline, model_name: str, prompt: str):
+    """Return the cached text embeddings of a single prompt, without guidance."""
+    import torch
+    import diffusers
+
+    @torch.no_grad()
+    def encode(text):
+        if isinstance(pipeline, diffusers.StableDiffusionXLPipeline):
+            prompt_embeds, _, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+                prompt=text,
+                device=pipeline.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False,
+            )
+            return prompt_embeds, pooled_prompt_embeds
+        prompt_embeds, _ = pipeline.encode_prompt(
+            text, pipeline.device, 1, do_classifier_free_guidance=False
+        )
+        return (prompt_embeds,)
+
+    return embedding_cache.get_or_encode(model_name, prompt, encode)
+
+
+def prompt_embedding_kwargs(pipeline, model_name: str, prompts):
+    import torch
+
+    embeds = [encode_prompt(pipeline, model_name, prompt) for prompt in prompts]
+    negative = encode_prompt(pipeline, model_name, NEGATIVE_PROMPT)
+    kwargs = {
+        "prompt_embeds": torch.cat([e[0] for e in embeds]),
+        "negative_prompt_embeds": negative[0].repeat(len(prompts), 1, 1),
+    }
+    if len(negative) > 1:
+        kwargs["pooled_prompt_embeds"] = torch.cat([e[1] for e in embeds])
+        kwargs["negative_pooled_prompt_embeds"] = negative[1].repeat(len(prompts), 1)
+    return kwargs
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+def latent_to_image(latent, model_name: str):
+    """Project one (4, h, w) latent to a PIL image at latent resolution."""
+    import torch
+    from PIL import Image as PILImage
+
+    factors = torch.tensor(
+        LATENT_RGB_FACTORS["sdxl" if model_name in SDXL_MODELS else "sd"],
+        dtype=torch.float32,
+        device=latent.device,
+    )
+    rgb = torch.einsum("chw,cr->hwr", latent.float(), factors)
+    rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    return PILImage.fromarray(rgb)
+
+
+def variant_seeds(num_images: int = 1, seeds=None):
+    # Without explicit seeds the first variant is the image a plain request gives
+    seeds = list(seeds) if seeds else [SEED + i for i in range(num_images)]
+    if not 1 <= len(seeds) <= MAX_VARIANTS:
+        raise ValueError(f"Between 1 and {MAX_VARIANTS} variants can be generated at once")
+    return seeds
+
+
+def available_memory():
+    """Free memory on the generation device in bytes, or None when it cannot be told."""
+    device = get_device()
+    if device == "cuda":
+        import torch
+
+        return torch.cuda.mem_get_info()[0]
+    if device == "cpu" and hasattr(os, "sysconf"):
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError):
+            return None
+    return None
+
+
+# Sub-batch sizes that ran out of memory, keyed by (model, height, width); only ever lowered
+_sub_batch_limits = {}
+
+
+def sub_batch_size(model_name: str, height: int, width: int) -> int:
+    size = _sub_batch_limits.get((model_name, height, width), MAX_SUB_BATCH)
+    free = available_memory()
+    if free is not None:
+        sample_bytes = SAMPLE_MB_PER_MEGAPIXEL * 1024 * 1024 * height * width / 1e6
+        size = min(size, int(free * 0.8 // sample_bytes))
+    return max(1, size)
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    # CUDA raises OutOfMemoryError and MPS and the CPU allocator plain RuntimeErrors
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and (
+        "out of memory" in message or "can't allocate memory" in message
+    )
+
+
+def free_device_memory():
+    import torch
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def sampler_settings(model_name: str, sampler=None, steps=None, guidance_scale=None):
+    """The model's preset with the given settings applied; ValueError if they do not apply."""
+    preset = MODEL_PRESETS.get(model_name, DEFAULT_PRESET)
+    settings = {
+        "sampler": sampler or preset["sampler"],
+        "steps": preset["steps"] if steps is None else steps,
+        "guidance_scale": preset["guidance_scale"] if guidance_scale is None else guidance_scale,
+    }
+    if settings["sampler"] not in preset["samplers"] or settings["sampler"] not in SAMPLERS:
+        raise ValueError(f"Sampler {settings['sampler']!r} is not available for {model_name}")
+    if not 1 <= settings["steps"] <= MAX_STEPS:
+        raise ValueError(f"Steps must be between 1 and {MAX_STEPS}")
+    if not 0 <= settings["guidance_scale"] <= MAX_GUIDANCE_SCALE:
+        raise ValueError(f"Guidance scale must be between 0 and {MAX_GUIDANCE_SCALE}")
+    return settings
+
+
+def generation_params(
+        model_name: str, prompt: str, height: int, width: int, seed: int = SEED, settings=None
+):
+    # Everything that determines the output image, used as the result cache key
+    settings = settings or sampler_settings(model_name)
+    scheduler, overrides = SAMPLERS[settings["sampler"]]
+    params = {
+        "model_name": model_name,
+        "prompt": prompt,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "scheduler": scheduler,
+        "num_inference_steps": settings["steps"],
+        "guidance_scale": settings["guidance_scale"],
+        "seed": seed,
+        "vae_tiling": vae_tiling_enabled(),
+        "height": height,
+        "width": width,
+    }
+    if overrides:
+        params["scheduler_config"] = overrides
+    return params
+
+
+def generate_images(
+        model_name: str, prompts, height: int, width: int, on_step=None, seeds=None, **settings
+):
+    """Generate one image per prompt, serving repeats from the result cache.
+
+    ``seeds`` gives each prompt its own seed (default ``SEED``); repeating a prompt
+    with different seeds yields its variants. ``sampler``, ``steps`` and
+    ``guidance_scale`` default to the model's preset. Uncached images run as one batch,
+    split into sub-batches that fit in memory. ``on_step(step, total, latents)`` is
+    called after every denoising step, with ``latents`` mapping prompt index to its
+    current latent; raising from it aborts the run.
+    """
+    settings = sampler_settings(model_name, **settings)
+    seeds = list(seeds) if seeds else [SEED] * len(prompts)
+    keys = [
+        result_key(generation_params(model_name, prompt, height, width, seed, settings))
+        for prompt, seed in zip(prompts, seeds)
+    ]
+    images = [result_cache.get(key) if result_cache else None for key in keys]
+    missing = [i for i, image in enumerate(images) if image is None]
+    metrics.generated_images.inc(len(prompts) - len(missing), model=model_name, source="cache")
+    if not missing:
+        return images
+    metrics.generated_images.inc(len(missing), model=model_name, source="pipeline")
+
+    import diffusers
+
+    model_manager = get_model_manager()
+    started = time.perf_counter()
+    with model_manager.acquire(model_name) as pipeline:
+        metrics.observe_stage("pipeline_fetch", time.perf_counter() - started)
+        with metrics.stage("scheduler_setup"):
+            scheduler, overrides = SAMPLERS[settings["sampler"]]
+            pipeline.scheduler = model_manager.get_scheduler(
+                model_name, getattr(diffusers, scheduler), **overrides
+            )
+
+        done, runs_done = 0, 0
+        size = sub_batch_size(model_name, height, width)
+        while done < len(missing):
+            batch = missing[done:done + size]
+            runs_total = runs_done + -(-(len(missing) - done) // size)
+            try:
+                generated = _run_pipeline(
+                    pipeline, model_name, prompts, seeds, batch, height, width, settings,
+                    on_step, runs_done, runs_total,
+                )
+            except Exception as e:
+                if not is_out_of_memory(e) or size == 1:
+                    raise
+                free_device_memory()
+                size //= 2
+                _sub_batch_limits[model_name, height, width] = size
+                continue
+            for i, image in zip(batch, generated):
+                images[i] = image
+                if result_cache:
+                    result_cache.put(keys[i], image)
+            done += len(batch)
+            runs_done += 1
+    return images
+
+
+def _run_pipeline(
+        pipeline, model_name, prompts, seeds, batch, height, width, settings,
+        on_step, runs_done, runs_total,
+):
+    import torch
+
+    with metrics.stage("text_encode"):
+        embedding_kwargs = prompt_embedding_kwargs(
+            pipeline, model_name, [prompts[i] for i in batch]
+        )
+
+    # One generator per sample keeps every image identical to an unbatched run
+    rngs = [torch.Generator(device=get_device()).manual_seed(seeds[i]) for i in batch]
+    step_started = time.perf_counter()
+
+    def callback(pipe, step, timestep, tensors):
+        nonlocal step_started
+        now = time.perf_counter()
+        metrics.observe_stage("denoise_step", now - step_started)
+        step_started = now
+        if on_step is not None:
+            # Steps are counted across sub-batches, so progress keeps moving forward
+            steps = len(pipe.scheduler.timesteps)
+            latents = tensors["latents"]
+            on_step(
+                runs_done * steps + step + 1,
+                runs_total * steps,
+                {i: latents[j] for j, i in enumerate(batch)},
+            )
+            step_started = time.perf_counter()
+        return tensors
+
+    generated = pipeline(
+        height=height,
+        width=width,
+        num_inference_steps=settings["steps"],
+        guidance_scale=settings["guidance_scale"],
+        generator=rngs,
+        callback_on_step_end=callback,
+        callback_on_step_end_tensor_inputs=["latents"],
+        **embedding_kwargs,
+    ).images
+    # Everything after the last step: the VAE decode and conversion to PIL images
+    metrics.observe_stage("vae_decode", time.perf_counter() - step_started)
+    return generated
+
+
+def generate_image(model_name: str, prompt: str, height: int, width: int, **settings):
+    return generate_images(model_name, [prompt], height, width, **settings)[0]
+
+
+def generate_variants(
+        model_name: str, prompt: str, height: int, width: int, seeds, **settings
+):
+    """One image per seed for the same prompt, in one batched run."""
+    return generate_images(
+        model_name, [prompt] * len(seeds), height, width, seeds=seeds, **settings
+    )
+
+
+def generate_image_stream(
+        model_name: str, prompt: str, height: int, width: int, seeds=None,
+        preview_every=PREVIEW_EVERY, **settings,
+):
+    """Yield progress events while generating, ending with a done/failed/cancelled event.
+
+    Progress events are ``{"type": "progress", "step", "total", "preview"}`` where
+    ``preview`` is a latent-resolution image or None. The done event carries
+    ``image`` and, with ``seeds``, all ``images`` in seed order. Closing the iterator
+    cancels the run at the next step.
+    """
+    seeds = seeds or [SEED]
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def on_step(step, total, latents):
+        if cancelled.is_set():
+            raise GenerationCancelled()
+        preview = None
+        if preview_every and step % preview_every == 0 and step < total:
+            # The first sample of the running sub-batch
+            preview = latent_to_image(next(iter(latents.values())), model_name)
+        events.put({"type": "progress", "step": step, "total": total, "preview": preview})
+
+    def run():
+        try:
+            images = generate_images(
+                model_name, [prompt] * len(seeds), height, width,
+                on_step=on_step, seeds=seeds, **settings,
+            )
+            events.put({"type": "done", "image": images[0], "images": images})
+        except GenerationCancelled:
+            events.put({"type": "cancelled"})
+        except Exception as e:
+            events.put({"type": "failed", "error": repr(e)})
+
+    threading.Thread(target=run, name="generation-stream", daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            yield event
+            if event["type"] != "progress":
+                return
+    finally:
+        cancelled.set()
@@ -0,0 +1,42 @@
+"""The request to generate images, shared by generation_service.py and the job API of app.py.
+
+Its bounds are the ones the Streamlit pages offer, so a request the UI cannot
+make is rejected with a 422 before it reaches the batcher or the job queue.
+"""
+from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional
+
+import config
+
+MODEL_NAMES = ["SD V1.5", "SD Pokemon", "SD Dogs"]
+
+MIN_SIDE = 128
+MAX_SIDE = 1024
+# Latents are an eighth of the image's size
+SIDE_MULTIPLE = 8
+MAX_STEPS = 100
+MAX_GUIDANCE_SCALE = 20.0
+MAX_VARIANTS = config.get_int("MAX_VARIANTS", 8)
+MAX_PROMPT_LENGTH = config.get_int("MAX_PROMPT_LENGTH", 1000)
+
+ModelName = Literal[tuple(MODEL_NAMES)]
+Side = Annotated[int, Field(ge=MIN_SIDE, le=MAX_SIDE, multiple_of=SIDE_MULTIPLE)]
+# Any seed torch.Generator.manual_seed takes
+Seed = Annotated[int, Field(ge=0, lt=2**63)]
+
+
+class GenerateRequest(BaseModel):
+    model_name: ModelName
+    prompt: str = Field(min_length=1, max_length=MAX_PROMPT_LENGTH)
+    height: Side = 512
+    width: Side = 512
+    # Variants of the prompt: num_images consecutive seeds, or these seeds
+    num_images: int = Field(1, ge=1, le=MAX_VARIANTS)
+    seeds: Optional[List[Seed]] = Field(None, max_length=MAX_VARIANTS)
+    # Default to the model's preset
+    sampler: Optional[str] = None
+    steps: Optional[int] = Field(None, ge=1, le=MAX_STEPS)
+    guidance_scale: Optional[float] = Field(None, ge=0, le=MAX_GUIDANCE_SCALE)
+
+    class Config:
+        protected_namespaces = ()
@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import io
+import json
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
+
+import config
+import metrics
+from batcher import MicroBatcher, FINISHED_STATUSES
+from encoding import encode_image
+from generation_request import GenerateRequest
+
+MAX_BATCH_SIZE = config.get_int("GENERATION_MAX_BATCH_SIZE", 4)
+BATCH_WINDOW_MS = config.get_float("GENERATION_BATCH_WINDOW_MS", 50)
+PRELOAD = config.get_bool("GENERATION_PRELOAD", True)
+EVENT_POLL_INTERVAL = 0.1
+
+
+def run_batch(model_name, prompts, seeds, height, width, progress, **settings):
+    # Imported lazily so the job API is up before torch and the models load
+    from generation import generate_images, latent_to_image, PREVIEW_EVERY
+
+    def on_step(step, total, latents):
+        previews = None
+        if PREVIEW_EVERY and step % PREVIEW_EVERY == 0 and step < total:
+            previews = {i: latent_to_image(latent, model_name) for i, latent in latents.items()}
+        progress(step, total, previews)
+
+    with metrics.trace(
+            "batch", model=model_name, size=len(prompts), height=height, width=width, **settings
+    ):
+        with metrics.profiled("batch"):
+            return generate_images(
+                model_name, prompts, height, width, on_step=on_step, seeds=seeds, **settings
+            )
+
+
+batcher = MicroBatcher(
+    run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait=BATCH_WINDOW_MS / 1000
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PRELOAD:
+        from generation import preload_models
+
+        preload_models()
+    batcher.start()
+    yield
+    batcher.stop(timeout=5)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.RequestMetricsMiddleware)
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    seeds: List[int]
+    sampler: str
+    steps: int
+    guidance_scale: float
+    error: Optional[str] = None
+    batch_size: Optional[int] = None
+    step: int = 0
+    total_steps: Optional[int] = None
+
+
+def job_response(job):
+    return JobResponse(
+        job_id=job.id,
+        status=job.status,
+        seeds=job.seeds,
+        **job.options,
+        error=job.error,
+        batch_size=job.batch_size,
+        step=job.step,
+        total_steps=job.total_steps,
+    )
+
+
+def encode_preview(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=70)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+async def job_events(job):
+    # Server-sent events: "progress" whenever the step or preview changes, then one
+    # final event named after the job's status
+    last_step, last_preview = None, None
+    while job.status not in FINISHED_STATUSES:
+        if job.step != last_step:
+            last_step = job.step
+            data = job_response(job).model_dump()
+            preview = job.preview
+            if preview is not None and preview is not last_preview:
+                last_preview = preview
+                data["preview"] = encode_preview(preview)
+            yield f"event: progress\ndata: {json.dumps(data)}\n\n"
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+    yield f"event: {job.status}\ndata: {job_response(job).model_dump_json()}\n\n"
+
+
+@app.post("/generate", response_model=JobResponse)
+def submit_job(request: GenerateRequest):
+    from generation import variant_seeds, sampler_settings
+
+    try:
+        seeds = variant_seeds(request.num_images, request.seeds)
+        settings = sampler_settings(
+            request.model_name, request.sampler, request.steps, request.guidance_scale
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    job = batcher.submit(
+        request.model_name, request.prompt, request.height, request.width, seeds, settings
+    )
+    return job_response(job)
+
+
+@app.get("/generate/samplers")
+def get_samplers():
+    from generation import SAMPLERS, MODEL_PRESETS
+
+    return {"samplers": list(SAMPLERS), "presets": MODEL_PRESETS}
+
+
+@app.get("/generate/stats")
+def get_stats():
+    from generation import embedding_cache, result_cache, get_model_manager
+
+    return {
+        **batcher.stats(),
+        "models": get_model_manager().stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "result_cache": result_cache.stats() if result_cache else None,
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/generate/{job_id}", response_model=JobResponse)
+def get_job(job_id: str):
+    job = batcher.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+
+@app.delete("/generate/{job_id}", response_model=JobResponse)
+def cancel_job(job_id: str):
+    job = batcher.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+
+@app.get("/generate/{job_id}/events")
+def get_job_events(job_id: str):
+    job = batcher.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/generate/{job_id}/result")
+def get_job_result(job_id: str, index: int = 0):
+    job = batcher.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if not 0 <= index < len(job.result):
+        raise HTTPException(status_code=404, detail="No such image in this job")
+    return Response(encode_image(job.result[index]), media_type="image/png")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, port=config.get_int("GENERATION_PORT", 8001))
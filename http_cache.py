@@ -0,0 +1,97 @@
+"""Conditional and range responses for content-addressed blobs.
+
+A blob never changes once stored, so its digest is a strong ETag and responses
+can be cached for as long as the client likes.
+"""
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# Images are behind auth, so only the user's own cache may keep them
+IMMUTABLE = "private, max-age=31536000, immutable"
+CHUNK_SIZE = 64 * 1024
+
+
+def blob_etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def etag_matches(header, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def parse_range(header, length: int):
+    """(start, end) inclusive for a single-range ``bytes=`` header.
+
+    Returns None when the whole blob should be sent (no header, several ranges or
+    another unit) and raises ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    if not first:
+        # Suffix range: the last N bytes
+        try:
+            suffix = int(last)
+        except ValueError:
+            return None
+        if suffix < 0:
+            return None
+        if suffix == 0 or length == 0:
+            raise ValueError("Range not satisfiable")
+        return max(0, length - suffix), length - 1
+    try:
+        start = int(first)
+        end = int(last) if last else length - 1
+    except ValueError:
+        return None
+    if start >= length or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, length - 1)
+
+
+def iter_blob_range(store, digest: str, start: int, end: int):
+    with store.open(digest) as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining and (chunk := f.read(min(CHUNK_SIZE, remaining))):
+            remaining -= len(chunk)
+            yield chunk
+
+
+def blob_response(request: Request, store, digest: str, content_type: str, length: int):
+    """Serve a blob with a strong ETag, 304s, single byte ranges and HEAD."""
+    etag = blob_etag(digest)
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE, "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    # A stale If-Range (another ETag, or a date we cannot compare) asks for the whole blob
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), length)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{length}"
+            return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        # Served straight from disk; servers supporting pathsend hand the file to the kernel
+        return FileResponse(store.path(digest), media_type=content_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=206, headers=headers, media_type=content_type)
+    return StreamingResponse(
+        iter_blob_range(store, digest, start, end),
+        status_code=206,
+        headers=headers,
+        media_type=content_type,
+    )
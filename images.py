@@ -0,0 +1,39 @@
+"""Gallery images for blobs already in the blob store; shared by app.py, worker.py and migrate.py."""
+import metrics
+from db import Image, ImageRendition, blob_store
+from thumbnails import make_renditions, RENDITION_CONTENT_TYPE
+
+
+def add_renditions(image: Image):
+    """Set the content type of ``image`` from its blob and store its renditions;
+    raises PIL.UnidentifiedImageError if the blob is not an image."""
+    with blob_store.open(image.sha256) as f, metrics.stage("renditions"):
+        image.content_type, renditions = make_renditions(f)
+    for max_side, rendition in renditions.items():
+        rendition_sha256, rendition_size = blob_store.put(rendition)
+        image.renditions.append(
+            ImageRendition(
+                max_side=max_side,
+                content_type=RENDITION_CONTENT_TYPE,
+                sha256=rendition_sha256,
+                size=rendition_size,
+            )
+        )
+
+
+def build_image(
+        user_id: int, filename: str, prompt: str, sha256: str, size: int, created_at=None
+):
+    # An unsaved Image for a stored blob, with its renditions
+    db_image = Image(
+        filename=filename,
+        sha256=sha256,
+        size=size,
+        prompt=prompt,
+        owner_id=user_id,
+    )
+    if created_at is not None:
+        # Imports keep the original dates
+        db_image.created_at = created_at
+    add_renditions(db_image)
+    return db_image
@@ -0,0 +1,189 @@
+"""The persistent generation job queue: jobs are rows of ``generation_jobs``, run by worker.py.
+
+A worker claims a job with a lease of ``JOB_LEASE_SECONDS``, renews it while it
+runs and writes the images into the gallery together with marking the job done.
+A job whose lease runs out (its worker crashed or hung) is claimed again by the
+next worker, up to ``JOB_MAX_ATTEMPTS`` claims, and so is a job whose run failed.
+
+On PostgreSQL a claim locks its candidate rows with ``FOR UPDATE SKIP LOCKED``, so
+concurrent workers pass over each other's. SQLite has no row locks; there the
+claiming UPDATE only applies while the job's attempt count is still the one that
+was read (compare and swap), and a worker losing the race tries the next job.
+Every later write of the worker is guarded by that attempt count as well, so a
+worker whose lease was taken over can no longer touch the job.
+"""
+import datetime
+
+from sqlalchemy import and_, or_
+
+import config
+from db import GenerationJob
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+LEASE_SECONDS = config.get_float("JOB_LEASE_SECONDS", 60)
+MAX_ATTEMPTS = config.get_int("JOB_MAX_ATTEMPTS", 3)
+# Jobs read per claim; more of them only help SQLite workers racing for the same rows
+CLAIM_CANDIDATES = 4
+
+
+def submit(db, owner_id, model_name, prompt, height, width, seeds, settings):
+    job = GenerationJob(
+        owner_id=owner_id,
+        status=QUEUED,
+        model_name=model_name,
+        prompt=prompt,
+        height=height,
+        width=width,
+        seeds=list(seeds),
+        attempts=0,
+        step=0,
+        **settings,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def expire(db, now):
+    # Leases that ran out on the last attempt: the job fails instead of being retried
+    return db.query(GenerationJob).filter(
+        GenerationJob.status == RUNNING,
+        GenerationJob.lease_expires_at < now,
+        GenerationJob.attempts >= MAX_ATTEMPTS,
+    ).update(
+        {
+            GenerationJob.status: FAILED,
+            GenerationJob.error: f"Worker lost {MAX_ATTEMPTS} times",
+            GenerationJob.worker: None,
+            GenerationJob.finished_at: now,
+        },
+        synchronize_session=False,
+    )
+
+
+def claim(db, worker: str, lease_seconds=LEASE_SECONDS):
+    """Claim the oldest queued (or abandoned) job for ``worker``; None when there is none."""
+    now = datetime.datetime.utcnow()
+    expire(db, now)
+    db.commit()
+
+    claimable = and_(
+        or_(
+            GenerationJob.status == QUEUED,
+            and_(GenerationJob.status == RUNNING, GenerationJob.lease_expires_at < now),
+        ),
+        GenerationJob.attempts < MAX_ATTEMPTS,
+    )
+    candidates = (
+        db.query(GenerationJob.id, GenerationJob.attempts)
+        .filter(claimable)
+        .order_by(GenerationJob.created_at, GenerationJob.id)
+        .limit(CLAIM_CANDIDATES)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for job_id, attempts in candidates:
+        claimed = db.query(GenerationJob).filter(
+            GenerationJob.id == job_id, GenerationJob.attempts == attempts, claimable
+        ).update(
+            {
+                GenerationJob.status: RUNNING,
+                GenerationJob.worker: worker,
+                GenerationJob.attempts: attempts + 1,
+                GenerationJob.lease_expires_at: now + datetime.timedelta(seconds=lease_seconds),
+                GenerationJob.started_at: now,
+                GenerationJob.step: 0,
+                GenerationJob.total_steps: None,
+            },
+            synchronize_session=False,
+        )
+        if claimed:
+            db.commit()
+            return db.get(GenerationJob, job_id)
+    db.commit()
+    return None
+
+
+def _held(db, job, worker):
+    # The job while ``worker`` still holds the lease of this attempt
+    return db.query(GenerationJob).filter(
+        GenerationJob.id == job.id,
+        GenerationJob.status == RUNNING,
+        GenerationJob.worker == worker,
+        GenerationJob.attempts == job.attempts,
+    )
+
+
+def renew(db, job, worker: str, step=None, total_steps=None, lease_seconds=LEASE_SECONDS) -> bool:
+    """Extend the lease and record progress; False once the job was cancelled or taken over."""
+    values = {
+        GenerationJob.lease_expires_at: datetime.datetime.utcnow()
+        + datetime.timedelta(seconds=lease_seconds)
+    }
+    if step is not None:
+        values.update({GenerationJob.step: step, GenerationJob.total_steps: total_steps})
+    renewed = _held(db, job, worker).update(values, synchronize_session=False)
+    db.commit()
+    return bool(renewed)
+
+
+def finish(db, job, worker: str, image_ids, total_steps=None) -> bool:
+    """Mark the job done with its images, in the caller's transaction; False if the lease is gone."""
+    return bool(
+        _held(db, job, worker).update(
+            {
+                GenerationJob.status: DONE,
+                GenerationJob.image_ids: list(image_ids),
+                # No steps at all when every image came from the result cache
+                GenerationJob.step: total_steps or 0,
+                GenerationJob.total_steps: total_steps,
+                GenerationJob.error: None,
+                GenerationJob.worker: None,
+                GenerationJob.lease_expires_at: None,
+                GenerationJob.finished_at: datetime.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+    )
+
+
+def fail(db, job, worker: str, error: str) -> bool:
+    """Queue the job for another attempt, or fail it after the last one."""
+    retry = job.attempts < MAX_ATTEMPTS
+    failed = _held(db, job, worker).update(
+        {
+            GenerationJob.status: QUEUED if retry else FAILED,
+            GenerationJob.error: error,
+            GenerationJob.worker: None,
+            GenerationJob.lease_expires_at: None,
+            GenerationJob.finished_at: None if retry else datetime.datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+    return bool(failed)
+
+
+def cancel(db, job_id: int, owner_id: int) -> bool:
+    """Cancel a job that has not finished; its worker gives up at the next lease renewal."""
+    cancelled = db.query(GenerationJob).filter(
+        GenerationJob.id == job_id,
+        GenerationJob.owner_id == owner_id,
+        GenerationJob.status.in_((QUEUED, RUNNING)),
+    ).update(
+        {
+            GenerationJob.status: CANCELLED,
+            GenerationJob.worker: None,
+            GenerationJob.lease_expires_at: None,
+            GenerationJob.finished_at: datetime.datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+    return bool(cancelled)
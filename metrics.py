@@ -0,0 +1,302 @@
+"""Request and stage timings in the Prometheus text format, plus optional traces and profiles.
+
+Every process keeps its own registry. The API and the generation service serve
+it at ``GET /metrics``; other processes (the Streamlit app) can serve it on
+``METRICS_PORT``. With ``TRACE_LOG`` set, each request or generation batch writes
+one JSON line with the stages it went through, and ``PROFILE_SAMPLE_RATE`` runs
+that fraction of the generation batches under cProfile (or the torch profiler,
+``PROFILER = "torch"``), saving the profiles to ``PROFILE_DIR``. Requests are not
+profiled: cProfile sees only the event loop's thread, not the threadpool where
+sync endpoints do their work.
+"""
+import contextlib
+import contextvars
+import cProfile
+import http.server
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import config
+
+TRACE_LOG = config.get("TRACE_LOG")
+PROFILE_SAMPLE_RATE = config.get_float("PROFILE_SAMPLE_RATE", 0.0)
+PROFILE_DIR = config.get("PROFILE_DIR", "gallery/profiles")
+PROFILER = config.get("PROFILER", "cprofile")
+
+# Prometheus' defaults, stretched to cover a whole generation run
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value) -> str:
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_series(self, key, value):
+        yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket (not cumulative) counts, then the sum and the total count
+                series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def _render_series(self, key, series):
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.label_names, key, [("le", "+Inf")])
+        yield f"{self.name}_bucket{labels} {series[-1]}"
+        labels = _format_labels(self.label_names, key)
+        yield f"{self.name}_sum{labels} {_format_value(series[-2])}"
+        yield f"{self.name}_count{labels} {series[-1]}"
+
+
+registry = []
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"]
+)
+http_request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response.",
+    ["method", "route", "status"],
+)
+stage_seconds = Histogram(
+    "stage_duration_seconds", "Time spent in each stage of request handling and generation.", ["stage"]
+)
+generated_images = Counter(
+    "generation_images_total", "Images requested from generate_images by source.", ["model", "source"]
+)
+
+gc_reclaimed = Counter(
+    "blob_gc_reclaimed_total", "Deleted images and unreferenced blobs removed by blob_gc.", ["kind"]
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+# The trace being collected in this context, if any; a list of (stage, seconds)
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def observe_stage(name: str, seconds: float):
+    stage_seconds.observe(seconds, stage=name)
+    stages = _current_trace.get()
+    if stages is not None:
+        stages.append((name, round(seconds, 6)))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def _trace_logger():
+    trace_logger = logging.getLogger(f"{__name__}.trace")
+    if TRACE_LOG and not trace_logger.handlers:
+        handler = logging.FileHandler(TRACE_LOG)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger.addHandler(handler)
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.propagate = False
+    return trace_logger
+
+
+@contextlib.contextmanager
+def trace(kind: str, **fields):
+    """Collect the stages run inside the block and log them as one JSON line.
+
+    Yields a dict the caller can add fields to. Does nothing unless TRACE_LOG is set.
+    """
+    if not TRACE_LOG:
+        yield fields
+        return
+    stages = []
+    token = _current_trace.set(stages)
+    started = time.time()
+    try:
+        yield fields
+    finally:
+        _current_trace.reset(token)
+        record = {
+            "kind": kind,
+            "start": round(started, 3),
+            "seconds": round(time.time() - started, 6),
+            **fields,
+            "stages": stages,
+        }
+        _trace_logger().info(json.dumps(record, default=str))
+
+
+# cProfile and the torch profiler each allow one active capture per process
+_profile_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profiled(name: str, profiler=None):
+    """Profile a sampled fraction of the blocks, skipping any that overlap a capture."""
+    profiler = profiler or PROFILER
+    if not PROFILE_SAMPLE_RATE or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    if not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}-{int(time.time() * 1000)}-{os.getpid()}")
+        if profiler == "torch":
+            import torch
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities, record_shapes=True) as capture:
+                yield
+            capture.export_chrome_trace(f"{path}.json")
+        else:
+            capture = cProfile.Profile()
+            capture.enable()
+            try:
+                yield
+            finally:
+                capture.disable()
+                capture.dump_stats(f"{path}.prof")
+    finally:
+        _profile_lock.release()
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing each request by route template and status.
+
+    Pure ASGI rather than BaseHTTPMiddleware, so streamed and file responses are
+    timed to their last byte and are not buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        with trace("request", method=scope["method"], path=scope["path"]) as fields:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                seconds = time.perf_counter() - started
+                # The router stores the matched route in the scope; templates keep cardinality low
+                route = scope.get("route")
+                labels = {
+                    "method": scope["method"],
+                    "route": getattr(route, "path", "unmatched"),
+                    "status": status,
+                }
+                http_requests.inc(**labels)
+                http_request_seconds.observe(seconds, **labels)
+                fields.update(route=labels["route"], status=status)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = "0.0.0.0"):
+    """Serve /metrics from a daemon thread, for processes without an HTTP API of their own."""
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
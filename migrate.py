@@ -0,0 +1,105 @@
+"""Bring a database created by an earlier version up to the current schema.
+
+    python migrate.py
+
+Creates the missing tables, adds the columns that later versions gave existing
+tables (with their indexes) and moves image bytes still held in the old
+``images.data`` column into the blob store, one row at a time, before dropping
+the column. Each step only does what is still missing, so an interrupted run
+can simply be started again. The API and workers refuse to start until it ran.
+"""
+import logging
+
+from sqlalchemy import inspect, text
+
+from db import Base, Image, SessionLocal, blob_store, create_tables, engine
+from images import add_renditions
+
+# Rows moved to the blob store per transaction
+BATCH_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns():
+    for table in Base.metadata.sorted_tables:
+        inspector = inspect(engine)
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        with engine.begin() as connection:
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                logger.info("Adding %s.%s %s", table.name, column.name, column_type)
+                connection.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+        if missing:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+
+
+def move_image_data():
+    """Copy ``images.data`` of every row without a blob into the blob store."""
+    moved = 0
+    while True:
+        with engine.connect() as connection:
+            ids = connection.execute(
+                text(
+                    "SELECT id FROM images WHERE sha256 IS NULL AND data IS NOT NULL "
+                    "ORDER BY id LIMIT :limit"
+                ),
+                {"limit": BATCH_SIZE},
+            ).scalars().all()
+        if not ids:
+            return moved
+
+        db = SessionLocal()
+        try:
+            for image_id in ids:
+                # One row's bytes in memory at a time
+                data = db.execute(
+                    text("SELECT data FROM images WHERE id = :id"), {"id": image_id}
+                ).scalar_one()
+                sha256, size = blob_store.put(bytes(data))
+                image = db.get(Image, image_id)
+                image.sha256 = sha256
+                image.size = size
+                add_renditions(image)
+            db.commit()
+        finally:
+            db.close()
+        moved += len(ids)
+        logger.info("Moved %d images to the blob store", moved)
+
+
+def drop_image_data():
+    columns = {column["name"] for column in inspect(engine).get_columns("images")}
+    if "data" not in columns:
+        return
+    with engine.connect() as connection:
+        left = connection.execute(
+            text("SELECT count(*) FROM images WHERE sha256 IS NULL AND data IS NOT NULL")
+        ).scalar_one()
+    if left:
+        raise RuntimeError(f"{left} images still have their bytes only in images.data")
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE images DROP COLUMN data"))
+    logger.info("Dropped images.data")
+
+
+def migrate():
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    if "data" in {column["name"] for column in inspect(engine).get_columns("images")}:
+        move_image_data()
+        drop_image_data()
+    # Last, so the search index is built over the migrated rows
+    create_tables()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrate()
+    print("Database is up to date")
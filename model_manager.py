@@ -0,0 +1,184 @@
+import collections
+import contextlib
+import gc
+import threading
+import time
+
+
+def pipeline_nbytes(pipeline) -> int:
+    import torch
+
+    total = 0
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            total += sum(p.element_size() * p.nelement() for p in component.parameters())
+            total += sum(b.element_size() * b.nelement() for b in component.buffers())
+    return total
+
+
+class ManagedModel:
+    def __init__(self, name: str):
+        self.name = name
+        self.pipeline = None
+        self.nbytes = 0
+        self.on_device = False
+        self.in_use = 0
+        self.scheduler_config = None
+        self.schedulers = {}
+        self.lock = threading.Lock()
+
+
+class ModelManager:
+    """Keeps pipelines on the device within a memory budget.
+
+    Least-recently-used pipelines that are not running are either dropped or, with
+    ``offload=True``, moved to CPU memory so they come back without a reload. Room
+    is made before a load, for the size the model had last time, else its entry in
+    ``size_estimates``, else the largest model loaded so far.
+    """
+
+    def __init__(
+            self, loader, device, budget_bytes=None, offload=False, on_evict=None,
+            size_estimates=None,
+    ):
+        self.loader = loader
+        self.device = device
+        self.budget_bytes = budget_bytes
+        self.size_estimates = dict(size_estimates or {})
+        # Offloading to CPU only frees anything when the models live elsewhere
+        self.offload = offload and device != "cpu"
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._models = collections.OrderedDict()
+        self._known_sizes = {}
+        self._events = collections.deque(maxlen=100)
+        self._totals = collections.Counter()
+
+    @contextlib.contextmanager
+    def acquire(self, name: str):
+        """Yield the pipeline for ``name`` with exclusive use; it cannot be evicted meanwhile."""
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is None:
+                entry = self._models[name] = ManagedModel(name)
+            entry.in_use += 1
+            self._models.move_to_end(name)
+        try:
+            with entry.lock:
+                if entry.pipeline is None:
+                    with self._lock:
+                        self._make_room(name, self._expected_size(name))
+                    self._load(entry)
+                elif not entry.on_device:
+                    with self._lock:
+                        self._make_room(name, entry.nbytes)
+                    started = time.perf_counter()
+                    entry.pipeline.to(self.device)
+                    entry.on_device = True
+                    self._record(name, "restore", time.perf_counter() - started)
+                with self._lock:
+                    self._make_room(name, 0)
+                yield entry.pipeline
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+
+    def get_scheduler(self, name: str, scheduler_cls, **overrides):
+        # Schedulers are rebuilt from the model's original config once, then reused
+        entry = self._models[name]
+        key = scheduler_cls, tuple(sorted(overrides.items()))
+        if key not in entry.schedulers:
+            entry.schedulers[key] = scheduler_cls.from_config(
+                entry.scheduler_config, **overrides
+            )
+        return entry.schedulers[key]
+
+    def preload(self, names, warmup=None):
+        for name in names:
+            with self.acquire(name) as pipeline:
+                if warmup is not None:
+                    started = time.perf_counter()
+                    warmup(name, pipeline)
+                    self._record(name, "warmup", time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "device": self.device,
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": self._resident_bytes(),
+                "models": {
+                    name: {
+                        "loaded": entry.pipeline is not None,
+                        "on_device": entry.on_device,
+                        "nbytes": entry.nbytes,
+                        "in_use": entry.in_use,
+                    }
+                    for name, entry in self._models.items()
+                },
+                "totals": dict(self._totals),
+                "events": list(self._events),
+            }
+
+    def _load(self, entry: ManagedModel):
+        started = time.perf_counter()
+        pipeline = self.loader(entry.name)
+        if pipeline is None:
+            raise ValueError(f"Unknown model: {entry.name}")
+        entry.pipeline = pipeline
+        entry.nbytes = pipeline_nbytes(pipeline)
+        entry.on_device = True
+        entry.scheduler_config = pipeline.scheduler.config
+        entry.schedulers = {}
+        with self._lock:
+            self._known_sizes[entry.name] = entry.nbytes
+        self._record(entry.name, "load", time.perf_counter() - started)
+
+    def _expected_size(self, name: str) -> int:
+        # Called with self._lock held
+        if name in self._known_sizes:
+            return self._known_sizes[name]
+        if name in self.size_estimates:
+            return self.size_estimates[name]
+        return max(self._known_sizes.values(), default=0)
+
+    def _resident_bytes(self) -> int:
+        return sum(e.nbytes for e in self._models.values() if e.on_device)
+
+    def _make_room(self, name: str, needed: int):
+        # Called with self._lock held; walks from the least recently used model
+        if self.budget_bytes is None:
+            return
+        for other in list(self._models.values()):
+            if self._resident_bytes() + needed <= self.budget_bytes:
+                return
+            if other.name == name or other.in_use or not other.on_device:
+                continue
+            self._evict(other)
+
+    def _evict(self, entry: ManagedModel):
+        started = time.perf_counter()
+        if self.offload:
+            entry.pipeline.to("cpu")
+            event = "offload"
+        else:
+            entry.pipeline = None
+            entry.schedulers = {}
+            event = "evict"
+            if self.on_evict is not None:
+                self.on_evict(entry.name)
+        entry.on_device = False
+        gc.collect()
+        if self.device == "cuda":
+            import torch
+
+            torch.cuda.empty_cache()
+        self._record(entry.name, event, time.perf_counter() - started, locked=True)
+
+    def _record(self, name: str, event: str, seconds: float, locked=False):
+        with contextlib.nullcontext() if locked else self._lock:
+            self._events.append(
+                {"model": name, "event": event, "seconds": round(seconds, 4), "at": time.time()}
+            )
+            self._totals[f"{event}s"] += 1
+            self._totals[f"{event}_seconds"] += seconds
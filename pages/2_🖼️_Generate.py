@@ -1,41 +1,188 @@
 import streamlit as st
 from utils import (
-    generate_image,
+    API_URL,
+    GENERATION_URL,
+    generate_image_stream_remote,
     apply_adjustments,
+    make_preview,
+    auth_headers,
+    encoded_images,
     image_to_bytes,
+    output_options,
     ui_tab_txt2img,
+    ui_sampler_settings,
+    OUTPUT_FORMATS,
+    OUTPUT_FORMAT,
+    OUTPUT_QUALITY,
 )
+from encoding import FORMATS, image_content_id
+from generation import (
+    generate_image_stream,
+    preload_models,
+    variant_seeds,
+    MAX_VARIANTS,
+)
+from PIL import Image as PILImage
+import contextlib
 import io
 import requests
+import metrics
 
 st.set_page_config(page_title="Home", layout="wide")
-API_URL = st.secrets["API_URL"]
 
 
-def save_to_gallery_api(image, user_id, prompt):
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format="PNG")
-    img_byte_arr = img_byte_arr.getvalue()
+@st.cache_resource
+def preload_once():
+    # Runs once per Streamlit process, the first time anyone opens the page
+    if not GENERATION_URL:
+        preload_models()
+
+
+def encoded_key(params, options):
+    return st.session_state.generated_image_id, params, options
+
+
+def render_full_resolution(params, options):
+    # Sliders only touch the preview; the full-size image is adjusted and encoded
+    # on demand, once per (image, adjustments, format)
+    return encoded_images().get_or_encode(
+        encoded_key(params, options),
+        lambda: image_to_bytes(
+            apply_adjustments(st.session_state.generated_image, *params), options
+        ),
+    )
+
+
+def use_image(image, prompt):
+    st.session_state.generated_image = image
+    st.session_state.preview_image = make_preview(image)
+    st.session_state.generated_image_id = image_content_id(image)
+    st.session_state.prompt = prompt
+
+
+def pick_variant(index):
+    variant = st.session_state.variants[index]
+    use_image(variant["image"], variant["prompt"])
+    st.session_state.picked_variant = index
+
+
+def parse_seeds(text):
+    # "10, 42 7" -> [10, 42, 7]; empty means consecutive seeds
+    return [int(seed) for seed in text.replace(",", " ").split()]
 
-    files = {"file": ("image.png", img_byte_arr, "image/png")}
+
+def save_to_gallery_api(img_byte_arr, options, user_id, prompt):
+    _, content_type, extension = FORMATS[options[0]]
+    files = {"file": (f"image.{extension}", img_byte_arr, content_type)}
     data = {"prompt": prompt}
-    response = requests.post(f"{API_URL}/images/{user_id}", files=files, data=data)
+    with metrics.stage("gallery_upload"):
+        response = requests.post(
+            f"{API_URL}/images/{user_id}", files=files, data=data, headers=auth_headers()
+        )
 
     if response.status_code != 200:
         st.error("Failed to save image to gallery")
 
 
+def submit_job(user_id, model_name, prompt, height, width, seeds, settings):
+    response = requests.post(
+        f"{API_URL}/images/{user_id}/jobs",
+        json={
+            "model_name": model_name,
+            "prompt": prompt,
+            "height": height,
+            "width": width,
+            "seeds": seeds,
+            **settings,
+        },
+        headers=auth_headers(),
+    )
+    if response.status_code != 200:
+        st.error("Failed to queue the job")
+        return
+    st.success(f"Queued job {response.json()['id']}, its images will be saved to your gallery.")
+
+
+def cancel_job(job_id):
+    response = requests.delete(f"{API_URL}/job/{job_id}", headers=auth_headers())
+    if response.status_code not in (200, 409):
+        st.error("Failed to cancel the job")
+
+
+def open_job(job):
+    # The job's images are in the gallery already, show them as variants to pick from
+    images = []
+    for image_id in job["image_ids"]:
+        response = requests.get(f"{API_URL}/image/{image_id}", headers=auth_headers())
+        if response.status_code != 200:
+            st.error("Failed to load the job's images")
+            return
+        images.append(PILImage.open(io.BytesIO(response.content)))
+    st.session_state.variants = [
+        {"seed": seed, "prompt": job["prompt"], "image": image}
+        for seed, image in zip(job["seeds"], images)
+    ]
+    st.session_state.picked_variant = 0
+    use_image(images[0], job["prompt"])
+    st.session_state.adjusted_image = None
+
+
+def background_jobs(user_id):
+    # Jobs run by worker.py outlive the page, reloading it finds them here
+    if not st.toggle("Show background jobs"):
+        return
+    response = requests.get(
+        f"{API_URL}/images/{user_id}/jobs", params={"limit": 10}, headers=auth_headers()
+    )
+    if response.status_code != 200:
+        st.error("Failed to fetch background jobs")
+        return
+    jobs = response.json()
+    if not jobs:
+        st.info("No background jobs yet.")
+    for job in jobs:
+        cols = st.columns([4, 2, 1])
+        cols[0].write(
+            f"**{job['prompt']}** ({len(job['seeds'])} × {job['width']}x{job['height']}, "
+            f"{job['sampler']}, {job['steps']} steps)"
+        )
+        if job["status"] == "running" and job["total_steps"]:
+            cols[1].progress(
+                job["step"] / job["total_steps"],
+                text=f"Step {job['step']}/{job['total_steps']}",
+            )
+        elif job["status"] == "failed":
+            cols[1].write(f"failed: {job['error']}")
+        else:
+            cols[1].write(job["status"])
+        if job["status"] in ("queued", "running"):
+            cols[2].button(
+                "Cancel", key=f"cancel_job_{job['id']}", on_click=cancel_job, args=(job["id"],)
+            )
+        elif job["status"] == "done":
+            cols[2].button("Open", key=f"open_job_{job['id']}", on_click=open_job, args=(job,))
+    st.button("Refresh", key="refresh_jobs")
+
+
 def home_page():
     if not st.session_state.logged_in:
         st.warning("Please log in to access this page.")
         st.stop()
+    preload_once()
     # Initialize session state variables
     if "generated_image" not in st.session_state:
         st.session_state.generated_image = None
+    if "preview_image" not in st.session_state:
+        st.session_state.preview_image = None
     if "adjusted_image" not in st.session_state:
         st.session_state.adjusted_image = None
+    if "generated_image_id" not in st.session_state:
+        st.session_state.generated_image_id = None
     if "active_tab" not in st.session_state:
         st.session_state.active_tab = "Text to Image"
+    if "variants" not in st.session_state:
+        st.session_state.variants = []
+        st.session_state.picked_variant = 0
 
     st.title("Home")
 
@@ -59,12 +206,10 @@ def home_page():
                 "Saturation", 0.0, 2.0, 1.0, 0.1, key="saturation_slider"
             )
 
-            if st.session_state.generated_image:
+            params = (brightness, contrast, saturation)
+            if st.session_state.preview_image:
                 adjusted_image = apply_adjustments(
-                    st.session_state.generated_image.copy(),
-                    brightness,
-                    contrast,
-                    saturation,
+                    st.session_state.preview_image, *params
                 )
                 st.session_state.adjusted_image = adjusted_image
                 image_placeholder.image(adjusted_image)
@@ -74,32 +219,138 @@ def home_page():
     with tabs[0]:
         st.session_state.active_tab = "Text to Image"
         model_name, prompt, height, width = ui_tab_txt2img()
+        settings = ui_sampler_settings(model_name)
+        variant_cols = st.columns(2)
+        with variant_cols[0]:
+            num_images = st.number_input("Variants", 1, MAX_VARIANTS, 1)
+        with variant_cols[1]:
+            seeds_text = st.text_input(
+                "Seeds", placeholder="e.g. 10, 42, 7 (overrides Variants)"
+            )
+        try:
+            seeds = variant_seeds(num_images, parse_seeds(seeds_text))
+        except ValueError:
+            st.error(f"Seeds must be 1 to {MAX_VARIANTS} whole numbers.")
+            seeds = None
 
         if st.button(
-            "Generate", key="txt2img", type="primary", use_container_width=True
+            "Generate",
+            key="txt2img",
+            type="primary",
+            use_container_width=True,
+            disabled=seeds is None,
         ):
-            with st.spinner("Generating image..."):
-                generated_image = generate_image(model_name, prompt, height, width)
-                st.session_state.generated_image = generated_image
-                st.session_state.adjusted_image = generated_image.copy()
-                st.session_state.prompt = prompt
-                image_placeholder.image(generated_image)
+            # Any click while this runs (Cancel included) reruns the script, which closes
+            # the event stream and cancels the generation
+            st.button("Cancel", use_container_width=True)
+            progress_bar = st.progress(0.0, text="Generating image...")
+            stream = (
+                generate_image_stream_remote if GENERATION_URL else generate_image_stream
+            )
+            generated_images = None
+            with contextlib.closing(
+                    stream(model_name, prompt, height, width, seeds, **settings)
+            ) as events:
+                for event in events:
+                    if event["type"] == "progress":
+                        progress_bar.progress(
+                            event["step"] / event["total"],
+                            text=f"Step {event['step']}/{event['total']}",
+                        )
+                        if event["preview"] is not None:
+                            image_placeholder.image(
+                                event["preview"].resize((width, height), PILImage.BILINEAR)
+                            )
+                    elif event["type"] == "done":
+                        generated_images = event["images"]
+                    else:
+                        st.error(f"Generation {event['type']}: {event.get('error')}")
+            progress_bar.empty()
+
+            if generated_images is not None:
+                st.session_state.variants = [
+                    {"seed": seed, "prompt": prompt, "image": image}
+                    for seed, image in zip(seeds, generated_images)
+                ]
+                st.session_state.picked_variant = 0
+                use_image(generated_images[0], prompt)
+                st.session_state.adjusted_image = apply_adjustments(
+                    st.session_state.preview_image, *params
+                )
+                image_placeholder.image(st.session_state.adjusted_image)
+
+        # Runs on a generation worker (worker.py), survives leaving the page
+        if st.button(
+            "Run in background",
+            key="queue_job",
+            use_container_width=True,
+            disabled=seeds is None,
+        ):
+            submit_job(
+                st.session_state.current_user["id"],
+                model_name, prompt, height, width, seeds, settings,
+            )
+        background_jobs(st.session_state.current_user["id"])
+
+        variants = st.session_state.variants
+        if len(variants) > 1:
+            # Pick the variant to adjust and save; the others stay until the next run
+            grid = st.columns(min(len(variants), 4))
+            for i, variant in enumerate(variants):
+                with grid[i % len(grid)]:
+                    st.image(make_preview(variant["image"], 256), use_column_width=True)
+                    picked = i == st.session_state.picked_variant
+                    st.button(
+                        f"Seed {variant['seed']}" + (" ✓" if picked else ""),
+                        key=f"variant_{i}",
+                        on_click=pick_variant,
+                        args=(i,),
+                        disabled=picked,
+                        use_container_width=True,
+                    )
 
     with tabs[1]:
         st.session_state.active_tab = "Save"
-        if st.session_state.adjusted_image is None:
+        if st.session_state.generated_image is None:
             st.warning("No image generated yet. Please generate an image first.")
         else:
+            format_cols = st.columns(2)
+            with format_cols[0]:
+                output_format = st.selectbox(
+                    "Format",
+                    options=list(OUTPUT_FORMATS),
+                    index=list(OUTPUT_FORMATS).index(OUTPUT_FORMAT),
+                )
+            with format_cols[1]:
+                quality = st.slider(
+                    "Quality",
+                    1,
+                    100,
+                    OUTPUT_QUALITY,
+                    disabled=output_format in ("PNG", "WebP (lossless)"),
+                )
+            options = output_options(output_format, quality)
+            _, mime, extension = FORMATS[options[0]]
+
             col1, col2 = st.columns(2)
 
             with col1:
-                st.download_button(
-                    label="Download Image",
-                    data=image_to_bytes(st.session_state.adjusted_image),
-                    file_name="generated_image.png",
-                    mime="image/png",
-                    use_container_width=True,
-                )
+                rendered = encoded_images().get(encoded_key(params, options))
+                if rendered is not None:
+                    st.download_button(
+                        label="Download Image",
+                        data=rendered,
+                        file_name=f"generated_image.{extension}",
+                        mime=mime,
+                        use_container_width=True,
+                    )
+                else:
+                    st.button(
+                        "Prepare Download",
+                        on_click=render_full_resolution,
+                        args=(params, options),
+                        use_container_width=True,
+                    )
 
             with col2:
                 if st.button("Save to Gallery", use_container_width=True):
@@ -107,7 +358,8 @@ def home_page():
                     #     st.session_state.adjusted_image, st.session_state.prompt
                     # )
                     save_to_gallery_api(
-                        st.session_state.adjusted_image,
+                        render_full_resolution(params, options),
+                        options,
                         st.session_state.current_user["id"],
                         st.session_state.prompt,
                     )
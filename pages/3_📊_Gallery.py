@@ -1,11 +1,102 @@
 import streamlit as st
-from PIL import Image
-import io
 import math
-import requests
-from datetime import datetime
+from datetime import datetime, time
+import config
+from bundle import iter_records
+from encoding import EncodedImageCache
+from utils import API_URL, api_session, auth_headers, logout
 
-API_URL = st.secrets["API_URL"]
+THUMBNAIL_SIZE = 512
+# Pages whose ETags a session remembers, to revalidate them when they come back
+REMEMBERED_PAGES = 32
+
+
+@st.cache_resource
+def thumbnail_cache():
+    # Keyed by ETag (the blob digest), so entries are valid for every session of the process
+    return EncodedImageCache(config.get_int("GALLERY_CACHE_MB", 64) * 1024 * 1024)
+
+
+def fetch_thumbnail(image_id):
+    response = api_session().get(
+        f"{API_URL}/image/{image_id}",
+        params={"size": THUMBNAIL_SIZE},
+        headers=auth_headers(),
+    )
+    if response.status_code != 200:
+        return None
+    thumbnail_cache().put(response.headers["ETag"], response.content)
+    return response.content
+
+
+def read_bundle_images(records):
+    cache = thumbnail_cache()
+    images = []
+    for header, payload in records:
+        if header.get("not_modified"):
+            # Evicted since the request went out, fetch this one on its own
+            payload = cache.get(header["etag"]) or fetch_thumbnail(header["id"])
+        elif payload:
+            cache.put(header["etag"], payload)
+        images.append({**header, "data": payload})
+    return images
+
+
+def fetch_bundle(user_id, params, page_key):
+    """(page, images) of one bundle request, sending the page's cached ETags as have."""
+    page_etags = st.session_state.setdefault("gallery_etags", {})
+    have = [etag for etag in page_etags.get(page_key, ()) if thumbnail_cache().get(etag)]
+    response = api_session().get(
+        f"{API_URL}/images/{user_id}/bundle",
+        params={"size": THUMBNAIL_SIZE, "have": have, **params},
+        headers=auth_headers(),
+        stream=True,
+    )
+    if not check_response(response):
+        return None, []
+
+    response.raw.decode_content = True
+    records = iter_records(response.raw)
+    page, _ = next(records)
+    images = read_bundle_images(records)
+
+    page_etags.pop(page_key, None)
+    page_etags[page_key] = [image["etag"] for image in images if image["data"]]
+    while len(page_etags) > REMEMBERED_PAGES:
+        page_etags.pop(next(iter(page_etags)))
+    return page, images
+
+
+def fetch_search_page(user_id, query, limit, offset, page_key):
+    # The ranked ids come from the search index, their thumbnails from one bundle
+    response = api_session().get(
+        f"{API_URL}/images/{user_id}/search",
+        params={"q": query, "limit": limit, "offset": offset},
+        headers=auth_headers(),
+    )
+    if not check_response(response):
+        return None, []
+    hits = response.json()
+    page = {
+        "total": hits["total"],
+        # Back to offset 0 is the first page's own (empty) cursor, so its cache entry is found
+        "prev": ({"offset": offset - limit} if offset > limit else {}) if offset else None,
+        "next": {"offset": hits["next_offset"]} if hits["next_offset"] else None,
+    }
+    if not hits["items"]:
+        return page, []
+    _, images = fetch_bundle(
+        user_id, {"ids": [hit["id"] for hit in hits["items"]]}, page_key
+    )
+    return page, images
+
+
+def check_response(response):
+    if response.status_code == 401:
+        logout()
+        st.warning("Your session has expired. Please log in again.")
+        st.stop()
+    return response.status_code == 200
 
 
 def gallery():
@@ -15,74 +106,116 @@ def gallery():
 
     st.title("Gallery")
 
-    # Fetch images for the current user
-    user_id = st.session_state.current_user["id"]
-    response = requests.get(f"{API_URL}/images/{user_id}")
-    if response.status_code != 200:
-        st.error("Failed to fetch images")
-        return
-
-    images = response.json()
-
-    if not images:
-        st.warning("No images in the gallery.")
-        return
-
     # Sidebar
     with st.sidebar:
         st.header("Gallery Controls")
 
+        # Search by prompt, best matches first
+        query = st.text_input("Search prompts", placeholder="e.g. dog in a park").strip()
+
         # Layout selection
         layout = st.selectbox("Select layout", ["3x3", "3x2"])
         rows, cols = (3, 3) if layout == "3x3" else (3, 2)
         items_per_page = rows * cols
 
         # Sorting
-        sort_option = st.selectbox("Sort by", ["Newest", "Oldest"])
+        sort_option = st.selectbox("Sort by", ["Newest", "Oldest"], disabled=bool(query))
 
-        # Sort images based on 'created_at' if available, otherwise use 'id'
-        if images and "created_at" in images[0]:
-            images.sort(
-                key=lambda x: datetime.fromisoformat(x["created_at"]),
-                reverse=(sort_option == "Newest"),
-            )
-        else:
-            st.warning("'created_at' field not available. Sorting by ID instead.")
-            images.sort(key=lambda x: x["id"], reverse=(sort_option == "Newest"))
+    # Start over from the first page whenever the layout, the order or the search changes
+    view = (items_per_page, sort_option, query)
+    if st.session_state.get("gallery_view") != view:
+        st.session_state.gallery_view = view
+        st.session_state.gallery_cursor = {}
+        st.session_state.gallery_page = 1
+
+    # Fetch one page of images and their metadata, leaving out the images of
+    # this page that are still cached from an earlier visit
+    user_id = st.session_state.current_user["id"]
+    cursor = st.session_state.gallery_cursor
+    page_key = (user_id, view, tuple(sorted(cursor.items())))
+    if query:
+        result, images = fetch_search_page(
+            user_id, query, items_per_page, cursor.get("offset", 0), page_key
+        )
+    else:
+        result, images = fetch_bundle(
+            user_id,
+            {"limit": items_per_page, "order": sort_option.lower(), **cursor},
+            page_key,
+        )
+        if result is not None:
+            result["prev"] = {"before": result["prev_cursor"]} if result["prev_cursor"] else None
+            result["next"] = {"after": result["next_cursor"]} if result["next_cursor"] else None
+    if result is None:
+        st.error("Failed to fetch images")
+        return
 
-        # Pagination variables
-        total_pages = math.ceil(len(images) / items_per_page)
+    if not images and st.session_state.gallery_cursor:
+        # The page ran dry (e.g. after deletes), go back to the first one
+        st.session_state.gallery_cursor = {}
+        st.session_state.gallery_page = 1
+        st.rerun()
 
-        # Page selection
-        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1)
+    if "gallery_deleted" in st.session_state:
+        st.success(st.session_state.pop("gallery_deleted"))
 
-        st.write(f"Page {page} of {total_pages}")
+    if not images:
+        st.warning("No images match your search." if query else "No images in the gallery.")
+        return
+
+    with st.sidebar:
+        total_pages = max(1, math.ceil(result["total"] / items_per_page))
+        st.write(f"Page {st.session_state.gallery_page} of {total_pages}")
 
         # Navigation buttons
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("Previous") and page > 1:
-                page -= 1
+            st.button(
+                "Previous",
+                on_click=change_page,
+                args=(result["prev"], -1),
+                disabled=result["prev"] is None,
+            )
         with col2:
-            if st.button("Next") and page < total_pages:
-                page += 1
+            st.button(
+                "Next",
+                on_click=change_page,
+                args=(result["next"], 1),
+                disabled=result["next"] is None,
+            )
 
-    # Calculate start and end indices for current page
-    start = (page - 1) * items_per_page
-    end = start + items_per_page
+        # Bulk delete: the images ticked on this page, or everything before a date
+        st.header("Delete")
+        selected = [
+            image["id"] for image in images if st.session_state.get(f"select_{image['id']}")
+        ]
+        st.button(
+            f"Delete selected ({len(selected)})",
+            on_click=delete_images,
+            args=(user_id, {"ids": selected}),
+            disabled=not selected,
+        )
+        older_than = st.date_input("Delete images older than", value=None)
+        st.button(
+            "Delete older images",
+            on_click=delete_images,
+            args=(
+                user_id,
+                {"older_than": older_than and datetime.combine(older_than, time()).isoformat()},
+            ),
+            disabled=older_than is None,
+        )
 
     # Display images and options in a grid layout
-    for i in range(start, min(end, len(images)), cols):
+    for i in range(0, len(images), cols):
         row = st.columns(cols)
         for j in range(cols):
             if i + j < len(images):
                 image = images[i + j]
                 with row[j]:
-                    # Fetch and display the image
-                    image_response = requests.get(f"{API_URL}/image/{image['id']}")
-                    if image_response.status_code == 200:
-                        img = Image.open(io.BytesIO(image_response.content))
-                        st.image(img, use_column_width=True)
+                    # Display the thumbnail that came with the page
+                    if image["data"]:
+                        st.image(image["data"], use_column_width=True)
 
                         # Display prompt with expansion option
                         prompt = image.get("prompt", "No prompt available")
@@ -99,18 +232,33 @@ def gallery():
                                 unsafe_allow_html=True,
                             )
 
-                        if st.button(f"Delete", key=f"delete_{image['id']}"):
-                            delete_image(image["id"])
-                            st.success(f"Deleted {image['filename']}")
-                            st.rerun()
+                        select, delete = st.columns(2)
+                        select.checkbox("Select", key=f"select_{image['id']}")
+                        delete.button(
+                            "Delete",
+                            key=f"delete_{image['id']}",
+                            on_click=delete_images,
+                            args=(user_id, {"ids": [image["id"]]}),
+                        )
                     else:
                         st.error(f"Failed to load image {image['filename']}")
 
 
-def delete_image(image_id):
-    response = requests.delete(f"{API_URL}/image/{image_id}")
+def change_page(cursor, step):
+    st.session_state.gallery_cursor = cursor
+    st.session_state.gallery_page += step
+
+
+def delete_images(user_id, request):
+    # Deleting only marks the images, the API reclaims their storage in the background
+    response = api_session().post(
+        f"{API_URL}/images/{user_id}/delete", json=request, headers=auth_headers()
+    )
     if response.status_code != 200:
-        st.error("Failed to delete image")
+        st.error("Failed to delete images")
+        return
+    deleted = response.json()["deleted"]
+    st.session_state.gallery_deleted = f"Deleted {deleted} image{'s' if deleted != 1 else ''}"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from PIL import Image as PILImage
+
+
+def result_key(params: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class ResultCache:
+    """Disk-backed LRU of generated images, keyed by a hash of every generation parameter.
+
+    ``max_bytes`` covers the whole directory, so worker processes sharing it
+    share the budget. Each process keeps a running total of what it has seen
+    and written, and rescans the directory only once that passes the budget or
+    it has written the ``1 - LOW_WATER`` share of it since the last scan; going
+    over evicts down to ``LOW_WATER`` of the budget. A put therefore costs a
+    full scan only now and then, and the directory overshoots by at most what
+    the other processes wrote since their last scan. Hits refresh an entry's
+    modification time, which orders eviction across processes.
+    """
+
+    LOW_WATER = 0.9
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes = collections.OrderedDict()
+        self._bytes = 0
+        self._unscanned = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.png")
+
+    def _scan(self):
+        # Called with self._lock held (or before the cache is shared)
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".png"):
+                try:
+                    stat = os.stat(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    # Evicted by another process since the listing
+                    continue
+                entries.append((stat.st_mtime, name[: -len(".png")], stat.st_size))
+        self._sizes = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._bytes = sum(self._sizes.values())
+        self._unscanned = 0
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            image = PILImage.open(path)
+            image.load()
+            os.utime(path)
+        except (OSError, SyntaxError, ValueError) as e:
+            # Missing, evicted by another process meanwhile, or truncated: all misses
+            if not isinstance(e, FileNotFoundError):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self.misses += 1
+                if key in self._sizes:
+                    self._bytes -= self._sizes.pop(key)
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return image
+
+    def put(self, key: str, image):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format="PNG")
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if key in self._sizes:
+                self._bytes -= self._sizes.pop(key)
+            self._sizes[key] = size
+            self._bytes += size
+            self._unscanned += size
+            evicted = []
+            if (
+                    self._bytes > self.max_bytes
+                    or self._unscanned > self.max_bytes * (1 - self.LOW_WATER)
+            ):
+                # Other processes write here too, count what is actually on disk
+                self._scan()
+            if self._bytes > self.max_bytes:
+                while self._bytes > self.max_bytes * self.LOW_WATER and self._sizes:
+                    old_key, old_size = self._sizes.popitem(last=False)
+                    self._bytes -= old_size
+                    evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self.path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._sizes),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,13 @@
+"""The from-scratch Stable Diffusion modules of notebook/SD_from_scratch.ipynb.
+
+Parameter names and module layout match the notebook, so its state dicts load
+unchanged. Attention goes through :func:`sd_scratch.attention.attention`, which
+avoids materialising full attention matrices, and the VAE can decode and
+encode in tiles.
+"""
+from sd_scratch.attention import set_attention_backend, get_attention_backend
+from sd_scratch.clip import text_encoder
+from sd_scratch.vae import VAE
+from sd_scratch.unet import UNet
+
+__all__ = ["set_attention_backend", "get_attention_backend", "text_encoder", "VAE", "UNet"]
@@ -0,0 +1,72 @@
+import torch
+
+# "sdpa" uses torch's fused scaled_dot_product_attention (flash / memory-efficient
+# kernels where available), "sliced" computes the softmax over chunks of queries so
+# only [slice_size, keys] scores exist at a time, "naive" materialises the full matrix
+# like the notebook did. All three give the same result up to float rounding.
+BACKENDS = ("sdpa", "sliced", "naive")
+
+_settings = {
+    "backend": "sdpa" if hasattr(torch.nn.functional, "scaled_dot_product_attention") else "sliced",
+    "slice_size": 1024,
+}
+
+
+def set_attention_backend(backend: str, slice_size: int = None):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown attention backend: {backend}")
+    _settings["backend"] = backend
+    if slice_size is not None:
+        _settings["slice_size"] = slice_size
+
+
+def get_attention_backend():
+    return dict(_settings)
+
+
+def _causal_mask(lq, lk, device):
+    return torch.ones(lq, lk, dtype=torch.bool, device=device).triu(1)
+
+
+def _naive(q, k, v, causal):
+    scores = q @ k.transpose(-1, -2) * q.shape[-1] ** -0.5
+    if causal:
+        scores = scores.masked_fill(_causal_mask(q.shape[-2], k.shape[-2], q.device), -float("inf"))
+    return scores.softmax(dim=-1) @ v
+
+
+def _sliced(q, k, v, causal, slice_size):
+    out = torch.empty_like(q)
+    scale = q.shape[-1] ** -0.5
+    kt = k.transpose(-1, -2)
+    for start in range(0, q.shape[-2], slice_size):
+        end = min(start + slice_size, q.shape[-2])
+        scores = q[..., start:end, :] @ kt * scale
+        if causal:
+            mask = torch.ones(end - start, k.shape[-2], dtype=torch.bool, device=q.device)
+            mask = mask.triu(start + 1)
+            scores = scores.masked_fill(mask, -float("inf"))
+        out[..., start:end, :] = scores.softmax(dim=-1) @ v
+    return out
+
+
+def attention(q, k, v, causal=False):
+    """softmax(q k^T / sqrt(d)) v over [..., length, head_dim] tensors."""
+    backend = _settings["backend"]
+    if backend == "sdpa":
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, is_causal=causal)
+    if backend == "sliced":
+        return _sliced(q, k, v, causal, _settings["slice_size"])
+    return _naive(q, k, v, causal)
+
+
+def split_heads(x, heads: int):
+    # [b, len, dim] -> [b, heads, len, dim // heads]
+    b, length, dim = x.shape
+    return x.reshape(b, length, heads, dim // heads).transpose(1, 2)
+
+
+def merge_heads(x):
+    # [b, heads, len, head_dim] -> [b, len, heads * head_dim]
+    b, heads, length, head_dim = x.shape
+    return x.transpose(1, 2).reshape(b, length, heads * head_dim)
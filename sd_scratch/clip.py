@@ -0,0 +1,89 @@
+import torch
+
+from sd_scratch.attention import attention, split_heads, merge_heads
+
+
+class Embed(torch.nn.Module):
+
+    def __init__(self, vocab_size=49408, dim=768, max_length=77):
+        super().__init__()
+
+        self.embed = torch.nn.Embedding(vocab_size, dim)
+        self.pos_embed = torch.nn.Embedding(max_length, dim)
+
+        self.register_buffer('pos_ids', torch.arange(max_length).unsqueeze(dim=0))
+
+    def forward(self, input_ids):
+        #input_ids -> [b, 77]
+
+        #[b, 77, 768] + [1, 77, 768]
+        return self.embed(input_ids) + self.pos_embed(self.pos_ids[:, :input_ids.shape[1]])
+
+
+class Atten(torch.nn.Module):
+
+    def __init__(self, dim=768, heads=12):
+        super().__init__()
+        self.heads = heads
+        self.q = torch.nn.Linear(dim, dim)
+        self.k = torch.nn.Linear(dim, dim)
+        self.v = torch.nn.Linear(dim, dim)
+        self.out = torch.nn.Linear(dim, dim)
+
+    def forward(self, x):
+        #x -> [b, 77, 768]
+
+        #[b, 77, 768] -> [b, 12, 77, 64]
+        q = split_heads(self.q(x), self.heads)
+        k = split_heads(self.k(x), self.heads)
+        v = split_heads(self.v(x), self.heads)
+
+        #causal: each token only attends to the ones before it
+        #[b, 12, 77, 64] -> [b, 77, 768]
+        atten = merge_heads(attention(q, k, v, causal=True))
+
+        return self.out(atten)
+
+
+class ClipEncoder(torch.nn.Module):
+
+    def __init__(self, dim=768, heads=12):
+        super().__init__()
+
+        self.s1 = torch.nn.Sequential(
+            torch.nn.LayerNorm(dim),
+            Atten(dim, heads),
+        )
+
+        self.s2 = torch.nn.Sequential(
+            torch.nn.LayerNorm(dim),
+            torch.nn.Linear(dim, dim * 4),
+        )
+
+        self.s3 = torch.nn.Linear(dim * 4, dim)
+
+    def forward(self, x):
+        #x -> [2, 77, 768]
+
+        #[2, 77, 768]
+        x = x + self.s1(x)
+
+        res = x
+
+        #[2, 77, 768] -> [2, 77, 3072]
+        x = self.s2(x)
+
+        #quick gelu
+        x = x * (x * 1.702).sigmoid()
+
+        #[2, 77, 3072] -> [2, 77, 768]
+        return res + self.s3(x)
+
+
+def text_encoder(layers=12, vocab_size=49408, dim=768, heads=12, max_length=77):
+    # Same layout as the notebook's Sequential, so its state dicts load unchanged
+    return torch.nn.Sequential(
+        Embed(vocab_size, dim, max_length),
+        *[ClipEncoder(dim, heads) for _ in range(layers)],
+        torch.nn.LayerNorm(dim),
+    )
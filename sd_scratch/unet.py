@@ -0,0 +1,311 @@
+import math
+
+import torch
+
+from sd_scratch.attention import attention, split_heads, merge_heads
+
+
+class Resnet(torch.nn.Module):
+
+    def __init__(self, dim_in, dim_out, dim_time=1280):
+        super().__init__()
+
+        self.time = torch.nn.Sequential(
+            torch.nn.SiLU(),
+            torch.nn.Linear(dim_time, dim_out),
+            torch.nn.Unflatten(dim=1, unflattened_size=(dim_out, 1, 1)),
+        )
+
+        self.s0 = torch.nn.Sequential(
+            torch.nn.GroupNorm(num_groups=32, num_channels=dim_in, eps=1e-05, affine=True),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(dim_in, dim_out, kernel_size=3, stride=1, padding=1),
+        )
+
+        self.s1 = torch.nn.Sequential(
+            torch.nn.GroupNorm(num_groups=32, num_channels=dim_out, eps=1e-05, affine=True),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(dim_out, dim_out, kernel_size=3, stride=1, padding=1),
+        )
+
+        self.res = None
+        if dim_in != dim_out:
+            self.res = torch.nn.Conv2d(dim_in, dim_out, kernel_size=1, stride=1, padding=0)
+
+    def forward(self, x, time):
+        #x -> [1, 320, 64, 64]
+        #time -> [1, 1280]
+
+        res = x
+
+        #[1, 320, 64, 64] + [1, 640, 1, 1] -> [1, 640, 64, 64]
+        x = self.s1(self.s0(x) + self.time(time))
+
+        if self.res:
+            res = self.res(res)
+
+        return res + x
+
+
+class CrossAttention(torch.nn.Module):
+
+    def __init__(self, dim_q, dim_kv, heads=8):
+        #dim_q -> 320
+        #dim_kv -> 768
+
+        super().__init__()
+
+        self.dim_q = dim_q
+        self.heads = heads
+
+        self.q = torch.nn.Linear(dim_q, dim_q, bias=False)
+        self.k = torch.nn.Linear(dim_kv, dim_q, bias=False)
+        self.v = torch.nn.Linear(dim_kv, dim_q, bias=False)
+
+        self.out = torch.nn.Linear(dim_q, dim_q)
+
+    def forward(self, q, kv):
+        #q -> [1, 4096, 320]
+        #kv -> [1, 77, 768]
+
+        #[1, 4096, 320] -> [1, 8, 4096, 40]
+        q = split_heads(self.q(q), self.heads)
+        #[1, 77, 768] -> [1, 8, 77, 40]
+        k = split_heads(self.k(kv), self.heads)
+        v = split_heads(self.v(kv), self.heads)
+
+        #[1, 8, 4096, 40] -> [1, 4096, 320]
+        atten = merge_heads(attention(q, k, v))
+
+        return self.out(atten)
+
+
+class Transformer(torch.nn.Module):
+
+    def __init__(self, dim, dim_kv=768, heads=8):
+        super().__init__()
+
+        self.dim = dim
+
+        #in
+        self.norm_in = torch.nn.GroupNorm(num_groups=32, num_channels=dim, eps=1e-6, affine=True)
+        self.cnn_in = torch.nn.Conv2d(dim, dim, kernel_size=1, stride=1, padding=0)
+
+        #atten
+        self.norm_atten0 = torch.nn.LayerNorm(dim, elementwise_affine=True)
+        self.atten1 = CrossAttention(dim, dim, heads)
+        self.norm_atten1 = torch.nn.LayerNorm(dim, elementwise_affine=True)
+        self.atten2 = CrossAttention(dim, dim_kv, heads)
+
+        #act
+        self.norm_act = torch.nn.LayerNorm(dim, elementwise_affine=True)
+        self.fc0 = torch.nn.Linear(dim, dim * 8)
+        self.act = torch.nn.GELU()
+        self.fc1 = torch.nn.Linear(dim * 4, dim)
+
+        #out
+        self.cnn_out = torch.nn.Conv2d(dim, dim, kernel_size=1, stride=1, padding=0)
+
+    def forward(self, q, kv):
+        #q -> [1, 320, 64, 64]
+        #kv -> [1, 77, 768]
+        b, _, h, w = q.shape
+        res1 = q
+
+        #----in----
+        #[1, 320, 64, 64] -> [1, 4096, 320]
+        q = self.cnn_in(self.norm_in(q))
+        q = q.permute(0, 2, 3, 1).reshape(b, h * w, self.dim)
+
+        #----atten----
+        q = self.atten1(q=self.norm_atten0(q), kv=self.norm_atten0(q)) + q
+        q = self.atten2(q=self.norm_atten1(q), kv=kv) + q
+
+        #----act----
+        res2 = q
+
+        #[1, 4096, 320] -> [1, 4096, 2560], gated: [1, 4096, 1280]
+        q = self.fc0(self.norm_act(q))
+        d = q.shape[2] // 2
+        q = q[:, :, :d] * self.act(q[:, :, d:])
+
+        #[1, 4096, 1280] -> [1, 4096, 320]
+        q = self.fc1(q) + res2
+
+        #----out----
+        #[1, 4096, 320] -> [1, 320, 64, 64]
+        q = q.reshape(b, h, w, self.dim).permute(0, 3, 1, 2).contiguous()
+
+        return self.cnn_out(q) + res1
+
+
+class DownBlock(torch.nn.Module):
+
+    def __init__(self, dim_in, dim_out, dim_kv=768, dim_time=1280, heads=8):
+        super().__init__()
+
+        self.tf0 = Transformer(dim_out, dim_kv, heads)
+        self.res0 = Resnet(dim_in, dim_out, dim_time)
+
+        self.tf1 = Transformer(dim_out, dim_kv, heads)
+        self.res1 = Resnet(dim_out, dim_out, dim_time)
+
+        self.out = torch.nn.Conv2d(dim_out, dim_out, kernel_size=3, stride=2, padding=1)
+
+    def forward(self, out_vae, out_encoder, time):
+        outs = []
+
+        out_vae = self.res0(out_vae, time)
+        out_vae = self.tf0(out_vae, out_encoder)
+        outs.append(out_vae)
+
+        out_vae = self.res1(out_vae, time)
+        out_vae = self.tf1(out_vae, out_encoder)
+        outs.append(out_vae)
+
+        out_vae = self.out(out_vae)
+        outs.append(out_vae)
+
+        return out_vae, outs
+
+
+class UpBlock(torch.nn.Module):
+
+    def __init__(self, dim_in, dim_out, dim_prev, add_up, dim_kv=768, dim_time=1280, heads=8):
+        super().__init__()
+
+        self.res0 = Resnet(dim_out + dim_prev, dim_out, dim_time)
+        self.res1 = Resnet(dim_out + dim_out, dim_out, dim_time)
+        self.res2 = Resnet(dim_in + dim_out, dim_out, dim_time)
+
+        self.tf0 = Transformer(dim_out, dim_kv, heads)
+        self.tf1 = Transformer(dim_out, dim_kv, heads)
+        self.tf2 = Transformer(dim_out, dim_kv, heads)
+
+        self.out = None
+        if add_up:
+            self.out = torch.nn.Sequential(
+                torch.nn.Upsample(scale_factor=2, mode='nearest'),
+                torch.nn.Conv2d(dim_out, dim_out, kernel_size=3, padding=1),
+            )
+
+    def forward(self, out_vae, out_encoder, time, out_down):
+        out_vae = self.res0(torch.cat([out_vae, out_down.pop()], dim=1), time)
+        out_vae = self.tf0(out_vae, out_encoder)
+
+        out_vae = self.res1(torch.cat([out_vae, out_down.pop()], dim=1), time)
+        out_vae = self.tf1(out_vae, out_encoder)
+
+        out_vae = self.res2(torch.cat([out_vae, out_down.pop()], dim=1), time)
+        out_vae = self.tf2(out_vae, out_encoder)
+
+        if self.out:
+            out_vae = self.out(out_vae)
+
+        return out_vae
+
+
+class UNet(torch.nn.Module):
+    """The notebook's UNet; the defaults are SD 1.x sizes, smaller ``dims`` give toy models."""
+
+    def __init__(self, dims=(320, 640, 1280), dim_kv=768, dim_time=1280, heads=8, latent_channels=4):
+        super().__init__()
+        d0, d1, d2 = dims
+        self.dim_time_embed = d0
+        blocks = dict(dim_kv=dim_kv, dim_time=dim_time, heads=heads)
+
+        #in
+        self.in_vae = torch.nn.Conv2d(latent_channels, d0, kernel_size=3, padding=1)
+
+        self.in_time = torch.nn.Sequential(
+            torch.nn.Linear(d0, dim_time),
+            torch.nn.SiLU(),
+            torch.nn.Linear(dim_time, dim_time),
+        )
+
+        #down
+        self.down_block0 = DownBlock(d0, d0, **blocks)
+        self.down_block1 = DownBlock(d0, d1, **blocks)
+        self.down_block2 = DownBlock(d1, d2, **blocks)
+
+        self.down_res0 = Resnet(d2, d2, dim_time)
+        self.down_res1 = Resnet(d2, d2, dim_time)
+
+        #mid
+        self.mid_res0 = Resnet(d2, d2, dim_time)
+        self.mid_tf = Transformer(d2, dim_kv, heads)
+        self.mid_res1 = Resnet(d2, d2, dim_time)
+
+        #up
+        self.up_res0 = Resnet(d2 * 2, d2, dim_time)
+        self.up_res1 = Resnet(d2 * 2, d2, dim_time)
+        self.up_res2 = Resnet(d2 * 2, d2, dim_time)
+
+        self.up_in = torch.nn.Sequential(
+            torch.nn.Upsample(scale_factor=2, mode='nearest'),
+            torch.nn.Conv2d(d2, d2, kernel_size=3, padding=1),
+        )
+
+        self.up_block0 = UpBlock(d1, d2, d2, True, **blocks)
+        self.up_block1 = UpBlock(d0, d1, d2, True, **blocks)
+        self.up_block2 = UpBlock(d0, d0, d1, False, **blocks)
+
+        #out
+        self.out = torch.nn.Sequential(
+            torch.nn.GroupNorm(num_channels=d0, num_groups=32, eps=1e-5),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(d0, latent_channels, kernel_size=3, padding=1),
+        )
+
+    def get_time_embed(self, t):
+        #[1] -> [1, 320] sinusoidal embedding
+        half = self.dim_time_embed // 2
+        e = torch.arange(half) * -math.log(10000) / half
+        e = e.exp().to(t.device) * t
+        return torch.cat([e.cos(), e.sin()]).unsqueeze(dim=0)
+
+    def forward(self, out_vae, out_encoder, time):
+        #out_vae -> [1, 4, 64, 64]
+        #out_encoder -> [1, 77, 768]
+        #time -> [1]
+
+        #----in----
+        out_vae = self.in_vae(out_vae)
+        time = self.in_time(self.get_time_embed(time))
+
+        #----down----
+        out_down = [out_vae]
+
+        out_vae, out = self.down_block0(out_vae=out_vae, out_encoder=out_encoder, time=time)
+        out_down.extend(out)
+
+        out_vae, out = self.down_block1(out_vae=out_vae, out_encoder=out_encoder, time=time)
+        out_down.extend(out)
+
+        out_vae, out = self.down_block2(out_vae=out_vae, out_encoder=out_encoder, time=time)
+        out_down.extend(out)
+
+        out_vae = self.down_res0(out_vae, time)
+        out_down.append(out_vae)
+
+        out_vae = self.down_res1(out_vae, time)
+        out_down.append(out_vae)
+
+        #----mid----
+        out_vae = self.mid_res0(out_vae, time)
+        out_vae = self.mid_tf(out_vae, out_encoder)
+        out_vae = self.mid_res1(out_vae, time)
+
+        #----up----
+        out_vae = self.up_res0(torch.cat([out_vae, out_down.pop()], dim=1), time)
+        out_vae = self.up_res1(torch.cat([out_vae, out_down.pop()], dim=1), time)
+        out_vae = self.up_res2(torch.cat([out_vae, out_down.pop()], dim=1), time)
+
+        out_vae = self.up_in(out_vae)
+
+        out_vae = self.up_block0(out_vae=out_vae, out_encoder=out_encoder, time=time, out_down=out_down)
+        out_vae = self.up_block1(out_vae=out_vae, out_encoder=out_encoder, time=time, out_down=out_down)
+        out_vae = self.up_block2(out_vae=out_vae, out_encoder=out_encoder, time=time, out_down=out_down)
+
+        #----out----
+        return self.out(out_vae)
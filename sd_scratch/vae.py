@@ -0,0 +1,240 @@
+import math
+
+import torch
+
+from sd_scratch.attention import attention
+
+
+class Resnet(torch.nn.Module):
+
+    def __init__(self, dim_in, dim_out):
+        super().__init__()
+
+        self.s = torch.nn.Sequential(
+            torch.nn.GroupNorm(num_groups=32, num_channels=dim_in, eps=1e-6, affine=True),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(dim_in, dim_out, kernel_size=3, stride=1, padding=1),
+            torch.nn.GroupNorm(num_groups=32, num_channels=dim_out, eps=1e-6, affine=True),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(dim_out, dim_out, kernel_size=3, stride=1, padding=1),
+        )
+
+        self.res = None
+        if dim_in != dim_out:
+            self.res = torch.nn.Conv2d(dim_in, dim_out, kernel_size=1, stride=1, padding=0)
+
+    def forward(self, x):
+        #x -> [1, 128, 10, 10]
+
+        res = x
+        if self.res:
+            #[1, 128, 10, 10] -> [1, 256, 10, 10]
+            res = self.res(x)
+
+        #[1, 128, 10, 10] -> [1, 256, 10, 10]
+        return res + self.s(x)
+
+
+class Atten(torch.nn.Module):
+
+    def __init__(self, dim=512):
+        super().__init__()
+        self.norm = torch.nn.GroupNorm(num_channels=dim, num_groups=32, eps=1e-6, affine=True)
+
+        self.q = torch.nn.Linear(dim, dim)
+        self.k = torch.nn.Linear(dim, dim)
+        self.v = torch.nn.Linear(dim, dim)
+        self.out = torch.nn.Linear(dim, dim)
+
+    def forward(self, x):
+        #x -> [1, 512, 64, 64]
+        b, c, h, w = x.shape
+        res = x
+
+        #[1, 512, 64, 64] -> [1, 4096, 512]
+        x = self.norm(x).flatten(start_dim=2).transpose(1, 2)
+
+        #single head: [1, 4096, 512] -> [1, 1, 4096, 512]
+        q = self.q(x).unsqueeze(1)
+        k = self.k(x).unsqueeze(1)
+        v = self.v(x).unsqueeze(1)
+
+        #[1, 1, 4096, 512] -> [1, 4096, 512]
+        atten = self.out(attention(q, k, v).squeeze(1))
+
+        #[1, 4096, 512] -> [1, 512, 64, 64]
+        atten = atten.transpose(1, 2).reshape(b, c, h, w)
+
+        return atten + res
+
+
+class Pad(torch.nn.Module):
+
+    def forward(self, x):
+        return torch.nn.functional.pad(x, (0, 1, 0, 1), mode='constant', value=0)
+
+
+def _tile_starts(size, tile, overlap):
+    # As few tiles as cover ``size`` with at least ``overlap`` shared, spread evenly
+    if size <= tile:
+        return [0]
+    count = math.ceil((size - overlap) / (tile - overlap))
+    return [round(i * (size - tile) / (count - 1)) for i in range(count)]
+
+
+def _ramp(length, overlap, fade_in, fade_out):
+    # Weights rising over the overlap on sides shared with a neighbouring tile
+    weight = torch.ones(length)
+    if overlap > 0:
+        edge = torch.linspace(0, 1, overlap + 2)[1:-1]
+        if fade_in:
+            weight[:overlap] = edge
+        if fade_out:
+            weight[-overlap:] = edge.flip(0)
+    return weight
+
+
+def tiled(fn, x, grid, tile, overlap, in_scale, out_scale, out_channels):
+    """Run ``fn`` over overlapping tiles of ``x`` and blend the outputs linearly.
+
+    Tiles are laid out on a ``grid`` of (h, w) cells, ``tile`` cells square and
+    ``overlap`` cells apart; a cell is ``in_scale`` pixels of ``x`` and ``out_scale``
+    pixels of the output. Peak memory follows the tile size, not the input size.
+    """
+    if overlap < 0 or tile <= overlap:
+        # _tile_starts steps by tile - overlap, which has to be positive
+        raise ValueError(
+            f"The tile size ({tile} cells) must be larger than the overlap ({overlap} cells)"
+        )
+    h, w = grid
+    out = weights = None
+    for y in _tile_starts(h, tile, overlap):
+        for x0 in _tile_starts(w, tile, overlap):
+            th, tw = min(tile, h), min(tile, w)
+            part = fn(x[:, :, y * in_scale:(y + th) * in_scale, x0 * in_scale:(x0 + tw) * in_scale])
+            if out is None:
+                out = part.new_zeros(x.shape[0], out_channels, h * out_scale, w * out_scale)
+                weights = part.new_zeros(1, 1, h * out_scale, w * out_scale)
+            weight = (
+                _ramp(th * out_scale, overlap * out_scale, y > 0, y + th < h)[:, None]
+                * _ramp(tw * out_scale, overlap * out_scale, x0 > 0, x0 + tw < w)[None, :]
+            ).to(part)
+            region = (
+                slice(None),
+                slice(None),
+                slice(y * out_scale, (y + th) * out_scale),
+                slice(x0 * out_scale, (x0 + tw) * out_scale),
+            )
+            out[region] += part * weight
+            weights[region] += weight
+            del part
+    return out.div_(weights)
+
+
+class VAE(torch.nn.Module):
+
+    def __init__(self, dims=(128, 256, 512, 512), latent_channels=4):
+        super().__init__()
+        self.latent_channels = latent_channels
+        top = dims[-1]
+
+        down = []
+        dim_prev = dims[0]
+        for i, dim in enumerate(dims):
+            layers = [Resnet(dim_prev, dim), Resnet(dim, dim)]
+            if i != len(dims) - 1:
+                layers.append(torch.nn.Sequential(
+                    Pad(),
+                    torch.nn.Conv2d(dim, dim, 3, stride=2, padding=0),
+                ))
+            down.append(torch.nn.Sequential(*layers))
+            dim_prev = dim
+
+        self.encoder = torch.nn.Sequential(
+            #in
+            torch.nn.Conv2d(3, dims[0], kernel_size=3, stride=1, padding=1),
+
+            #down
+            *down,
+
+            #mid
+            torch.nn.Sequential(Resnet(top, top), Atten(top), Resnet(top, top)),
+
+            #out
+            torch.nn.Sequential(
+                torch.nn.GroupNorm(num_channels=top, num_groups=32, eps=1e-6),
+                torch.nn.SiLU(),
+                torch.nn.Conv2d(top, latent_channels * 2, 3, padding=1),
+            ),
+
+            torch.nn.Conv2d(latent_channels * 2, latent_channels * 2, 1),
+        )
+
+        up = []
+        dim_prev = top
+        for i, dim in enumerate(reversed(dims)):
+            layers = [Resnet(dim_prev, dim), Resnet(dim, dim), Resnet(dim, dim)]
+            if i != len(dims) - 1:
+                layers += [
+                    torch.nn.Upsample(scale_factor=2.0, mode='nearest'),
+                    torch.nn.Conv2d(dim, dim, kernel_size=3, padding=1),
+                ]
+            up.append(torch.nn.Sequential(*layers))
+            dim_prev = dim
+
+        self.decoder = torch.nn.Sequential(
+            torch.nn.Conv2d(latent_channels, latent_channels, 1),
+
+            #in
+            torch.nn.Conv2d(latent_channels, top, kernel_size=3, stride=1, padding=1),
+
+            #middle
+            torch.nn.Sequential(Resnet(top, top), Atten(top), Resnet(top, top)),
+
+            #up
+            *up,
+
+            #out
+            torch.nn.Sequential(
+                torch.nn.GroupNorm(num_channels=dims[0], num_groups=32, eps=1e-6),
+                torch.nn.SiLU(),
+                torch.nn.Conv2d(dims[0], 3, 3, padding=1),
+            ),
+        )
+        self.scale = 2 ** (len(dims) - 1)
+
+    def sample(self, h):
+        #h -> [1, 8, 64, 64] -> mean, logvar: [1, 4, 64, 64]
+        mean = h[:, :self.latent_channels]
+        logvar = h[:, self.latent_channels:]
+        std = logvar.exp()**0.5
+
+        return mean + std * torch.randn(mean.shape, device=mean.device)
+
+    def encode(self, x, tile_size=None, overlap=128):
+        """[b, 3, H, W] -> latent moments [b, 8, H / 8, W / 8].
+
+        With ``tile_size`` (in pixels) the image is encoded in overlapping tiles.
+        """
+        if tile_size is None or max(x.shape[-2:]) <= tile_size:
+            return self.encoder(x)
+        s = self.scale
+        grid = (x.shape[-2] // s, x.shape[-1] // s)
+        return tiled(
+            self.encoder, x, grid, tile_size // s, overlap // s, s, 1, self.latent_channels * 2
+        )
+
+    def decode(self, z, tile_size=None, overlap=16):
+        """[b, 4, h, w] -> [b, 3, h * 8, w * 8].
+
+        With ``tile_size`` (in latent pixels, e.g. 64 for 512px tiles) the latent is
+        decoded in overlapping tiles blended linearly across the overlap, so a 1024px
+        image needs about as much memory as a 512px one.
+        """
+        if tile_size is None or max(z.shape[-2:]) <= tile_size:
+            return self.decoder(z)
+        return tiled(self.decoder, z, z.shape[-2:], tile_size, overlap, 1, self.scale, 3)
+
+    def forward(self, x):
+        #[1, 3, 512, 512] -> [1, 8, 64, 64] -> [1, 4, 64, 64] -> [1, 3, 512, 512]
+        return self.decoder(self.sample(self.encoder(x)))
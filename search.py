@@ -0,0 +1,156 @@
+"""Full-text search over image prompts.
+
+PostgreSQL uses GIN expression indexes on ``images`` (a tsvector, plus trigrams
+when pg_trgm can be enabled, to rank near misses). SQLite uses an FTS5 table
+kept in sync by triggers. Either way the index follows every insert and delete
+without application code. Other databases fall back to an unindexed LIKE scan.
+"""
+import logging
+import re
+
+from sqlalchemy import text, Integer, String, DateTime, Float
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+TEXT_SEARCH_CONFIG = "english"
+
+# Set by create_search_index: "postgresql", "postgresql+trgm", "sqlite-fts5" or "like"
+backend = None
+
+_POSTGRES_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS ix_images_prompt_tsv ON images "
+    f"USING gin (to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(prompt, '')))",
+]
+_POSTGRES_TRIGRAM = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_images_prompt_trgm ON images USING gin (prompt gin_trgm_ops)",
+]
+
+_SQLITE_FTS = [
+    # External content: the table holds only the index, prompts stay in images
+    "CREATE VIRTUAL TABLE images_fts USING fts5("
+    "prompt, content='images', content_rowid='id', tokenize='porter unicode61')",
+    "INSERT INTO images_fts(images_fts) VALUES ('rebuild')",
+]
+_SQLITE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+        INSERT INTO images_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF prompt ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+        INSERT INTO images_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END""",
+]
+
+# The index expression, spelled exactly as in ix_images_prompt_tsv so the planner uses it
+_TSVECTOR = f"to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(i.prompt, ''))"
+
+_RESULT_COLUMNS = dict(
+    id=Integer, filename=String, prompt=String, created_at=DateTime, rank=Float
+)
+
+
+def create_search_index(engine):
+    """Create the search index (idempotent) and pick the matching query backend."""
+    global backend
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        with engine.begin() as connection:
+            for statement in _POSTGRES_INDEXES:
+                connection.execute(text(statement))
+        backend = "postgresql"
+        try:
+            with engine.begin() as connection:
+                for statement in _POSTGRES_TRIGRAM:
+                    connection.execute(text(statement))
+            backend = "postgresql+trgm"
+        except DBAPIError as e:
+            # Creating an extension needs privileges the app user may not have
+            logger.warning("pg_trgm unavailable, searching without trigrams: %s", e.orig)
+    elif dialect == "sqlite":
+        try:
+            with engine.begin() as connection:
+                exists = connection.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = 'images_fts'")
+                ).first()
+                if not exists:
+                    for statement in _SQLITE_FTS:
+                        connection.execute(text(statement))
+                for statement in _SQLITE_TRIGGERS:
+                    connection.execute(text(statement))
+            backend = "sqlite-fts5"
+        except DBAPIError as e:
+            logger.warning("FTS5 unavailable, searching with LIKE: %s", e.orig)
+            backend = "like"
+    else:
+        backend = "like"
+    return backend
+
+
+def query_terms(query: str):
+    # Words only: user input never reaches the tsquery or FTS5 query syntax
+    return re.findall(r"\w+", query.lower())
+
+
+def _postgres_search(terms, query, trigram):
+    # Every word must match, the last one as a prefix so results follow typing
+    tsquery = " & ".join(terms[:-1] + [terms[-1] + ":*"])
+    params = {"tsquery": tsquery, "query": query}
+    match = f"{_TSVECTOR} @@ to_tsquery('{TEXT_SEARCH_CONFIG}', :tsquery)"
+    rank = f"ts_rank_cd({_TSVECTOR}, to_tsquery('{TEXT_SEARCH_CONFIG}', :tsquery))"
+    if trigram:
+        # Near misses ("pikachoo") rank below real matches
+        match = f"({match} OR :query <% i.prompt)"
+        rank = f"{rank} + word_similarity(:query, i.prompt) / 10"
+    return match, rank, "images i", params
+
+
+def _sqlite_search(terms):
+    fts_query = " ".join(f'"{term}"' for term in terms) + "*"
+    # bm25 is lower for better matches, negated so that higher ranks first everywhere
+    return (
+        "images_fts MATCH :fts_query",
+        "-bm25(images_fts)",
+        # CROSS JOIN pins the FTS table as the outer loop; left to itself SQLite may walk
+        # the user's images and run the full-text query once per row
+        "images_fts CROSS JOIN images i ON images_fts.rowid = i.id",
+        {"fts_query": fts_query},
+    )
+
+
+def _like_search(terms):
+    params = {f"term{n}": f"%{term}%" for n, term in enumerate(terms)}
+    match = " AND ".join(f"lower(i.prompt) LIKE :term{n}" for n in range(len(terms)))
+    return match, "0.0", "images i", params
+
+
+def search_images(db, user_id: int, query: str, limit: int, offset: int = 0):
+    """A page of the user's images matching ``query``, highest rank first, and the match count."""
+    terms = query_terms(query)
+    if not terms:
+        return [], 0
+    if backend and backend.startswith("postgresql"):
+        match, rank, source, params = _postgres_search(
+            terms, query, backend == "postgresql+trgm"
+        )
+    elif backend == "sqlite-fts5":
+        match, rank, source, params = _sqlite_search(terms)
+    else:
+        match, rank, source, params = _like_search(terms)
+    params.update(user_id=user_id, limit=limit, offset=offset)
+
+    where = f"FROM {source} WHERE i.owner_id = :user_id AND i.deleted_at IS NULL AND {match}"
+    rows = db.execute(
+        text(
+            f"SELECT i.id, i.filename, i.prompt, i.created_at, {rank} AS rank {where} "
+            "ORDER BY rank DESC, i.created_at DESC, i.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        ).columns(**_RESULT_COLUMNS),
+        params,
+    ).all()
+    total = db.execute(text(f"SELECT count(*) {where}"), params).scalar()
+    return rows, total
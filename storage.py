@@ -0,0 +1,156 @@
+import abc
+import hashlib
+import os
+import tempfile
+import time
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobWriter(abc.ABC):
+    """Incrementally writes a blob; its address is only known once commit() is called."""
+
+    @abc.abstractmethod
+    def write(self, chunk: bytes):
+        pass
+
+    @abc.abstractmethod
+    def commit(self):
+        pass
+
+    @abc.abstractmethod
+    def abort(self):
+        pass
+
+
+class BlobStore(abc.ABC):
+    """Content-addressed blob storage. Blobs are keyed by their SHA-256 hex digest."""
+
+    @abc.abstractmethod
+    def open_writer(self, max_bytes=None) -> BlobWriter:
+        pass
+
+    def put(self, data: bytes):
+        writer = self.open_writer()
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    @abc.abstractmethod
+    def exists(self, digest: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def path(self, digest: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def open(self, digest: str):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, digest: str, min_age=None) -> bool:
+        """Delete a blob unless it was written less than ``min_age`` seconds ago; True if it went."""
+
+    @abc.abstractmethod
+    def iter_digests(self, min_age=None):
+        """Yield the digest of every blob last written at least ``min_age`` seconds ago."""
+
+
+class LocalBlobWriter(BlobWriter):
+    def __init__(self, store, max_bytes=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        tmp_dir = os.path.join(store.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise BlobTooLarge(f"Blob exceeds {self.max_bytes} bytes")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        digest = self._hash.hexdigest()
+        target = self.store.path(digest)
+        try:
+            # A deduplicated write counts as a fresh one, so the garbage collector
+            # leaves the blob alone until the row referring to it is committed
+            os.utime(target)
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Atomic, so a concurrent reader never sees a partial blob
+            os.replace(self._tmp_path, target)
+        return digest, self.size
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        # Fan out on the first two bytes so no directory grows too large
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def open_writer(self, max_bytes=None) -> BlobWriter:
+        return LocalBlobWriter(self, max_bytes)
+
+    def open(self, digest: str):
+        return open(self.path(digest), "rb")
+
+    def delete(self, digest: str, min_age=None) -> bool:
+        path = self.path(digest)
+        try:
+            if min_age and time.time() - os.stat(path).st_mtime < min_age:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def iter_digests(self, min_age=None):
+        cutoff = time.time() - (min_age or 0)
+        for directory, subdirectories, files in os.walk(self.root):
+            # Writes in progress
+            if directory == self.root and "tmp" in subdirectories:
+                subdirectories.remove("tmp")
+            for name in files:
+                try:
+                    if os.stat(os.path.join(directory, name)).st_mtime <= cutoff:
+                        yield name
+                except FileNotFoundError:
+                    pass
+
+
+BLOB_STORES = {
+    "local": LocalBlobStore,
+}
+
+
+def create_blob_store(backend: str, **options) -> BlobStore:
+    if backend not in BLOB_STORES:
+        raise ValueError(f"Unknown blob store backend: {backend}")
+    return BLOB_STORES[backend](**options)
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read when the modules are imported, so they go in before any of them
+_workdir = tempfile.mkdtemp(prefix="sd_tests_")
+os.environ.update(
+    CONFIG_FILE=os.path.join(_workdir, "none.toml"),
+    DATABASE_URL=f"sqlite:///{_workdir}/test.sqlite",
+    BLOB_STORE_PATH=os.path.join(_workdir, "blobs"),
+    RESULT_CACHE_PATH=os.path.join(_workdir, "result_cache"),
+    RESULT_CACHE_MB="0",
+    AUTH_SECRET="test-secret",
+    BCRYPT_ROUNDS="4",
+    BLOB_GC_INTERVAL_SECONDS="0",
+    GENERATION_PRELOAD="false",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db():
+    from db import Base, SessionLocal, create_tables, engine
+
+    create_tables()
+    session = SessionLocal()
+    yield session
+    session.close()
+    # Every test starts from empty tables
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+
+@pytest.fixture
+def user(db):
+    from db import User
+
+    user = User(username="alice", hashed_password="-", email="alice@example.com")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def client(user):
+    # The app is imported here, after the settings above are in place
+    from fastapi.testclient import TestClient
+
+    from app import app
+    from auth import issue_token
+
+    client = TestClient(app)
+    client.headers["Authorization"] = f"Bearer {issue_token(user.id, user.username)[0]}"
+    return client
@@ -0,0 +1,26 @@
+import pytest
+from fastapi import HTTPException
+
+from auth import issue_token, verify_token
+
+
+def test_a_valid_token():
+    token, _ = issue_token(7, "alice")
+    user = verify_token(token)
+    assert (user.id, user.username) == (7, "alice")
+
+
+@pytest.mark.parametrize(
+    "tamper",
+    [
+        lambda token: token[:-2] + "xx",
+        lambda token: token[:-2] + "é",
+        lambda token: "é" + token,
+        lambda token: token.replace(".", ""),
+    ],
+)
+def test_a_tampered_token_is_a_401(tamper):
+    token, _ = issue_token(7, "alice")
+    with pytest.raises(HTTPException) as e:
+        verify_token(tamper(token))
+    assert e.value.status_code == 401
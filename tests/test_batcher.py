@@ -0,0 +1,173 @@
+import threading
+import time
+
+import pytest
+
+from batcher import MicroBatcher
+
+TIMEOUT = 5
+
+
+class StubPipeline:
+    """Records each batch and returns the prompt and seed of every image as its "image"."""
+
+    def __init__(self, error=None, steps=1, gate=None):
+        self.calls = []
+        self.error = error
+        self.steps = steps
+        self.gate = gate
+
+    def __call__(self, model_name, prompts, seeds, height, width, progress, **options):
+        self.calls.append({"model": model_name, "prompts": prompts, "seeds": seeds, **options})
+        for step in range(1, self.steps + 1):
+            if self.gate:
+                self.gate.wait(TIMEOUT)
+            progress(step, self.steps)
+        if self.error:
+            raise self.error
+        return [(prompt, seed) for prompt, seed in zip(prompts, seeds)]
+
+
+@pytest.fixture
+def batcher():
+    batchers = []
+
+    def make(pipeline, **options):
+        batcher = MicroBatcher(pipeline, **options)
+        batchers.append(batcher)
+        return batcher
+
+    yield make
+    for batcher in batchers:
+        batcher.stop(timeout=TIMEOUT)
+
+
+def wait(*jobs):
+    for job in jobs:
+        assert job.done.wait(TIMEOUT), f"job {job.prompt!r} did not finish"
+
+
+def test_groups_jobs_by_key(batcher):
+    pipeline = StubPipeline()
+    b = batcher(pipeline, max_batch_size=8, max_wait=0.05)
+    jobs = [
+        b.submit("A", "a1", 64, 64, [1]),
+        b.submit("B", "b1", 64, 64, [1]),
+        b.submit("A", "a2", 64, 64, [2]),
+        b.submit("A", "a3", 128, 128, [3]),
+        b.submit("A", "a4", 64, 64, [4], {"sampler": "Euler"}),
+    ]
+    b.start()
+    wait(*jobs)
+
+    batches = sorted((call["model"], tuple(call["prompts"])) for call in pipeline.calls)
+    assert batches == [("A", ("a1", "a2")), ("A", ("a3",)), ("A", ("a4",)), ("B", ("b1",))]
+    assert [call for call in pipeline.calls if call["prompts"] == ["a4"]][0]["sampler"] == "Euler"
+    assert [job.result for job in jobs] == [
+        [("a1", 1)], [("b1", 1)], [("a2", 2)], [("a3", 3)], [("a4", 4)]
+    ]
+    assert all(job.status == "done" for job in jobs)
+
+
+def test_flushes_a_partial_batch_when_the_window_closes(batcher):
+    pipeline = StubPipeline()
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.2)
+    b.start()
+    started = time.monotonic()
+    job = b.submit("A", "alone", 64, 64, [1])
+    wait(job)
+
+    assert time.monotonic() - started >= 0.2
+    assert job.status == "done"
+    assert job.batch_size == 1
+
+
+def test_splits_at_the_max_batch_size(batcher):
+    pipeline = StubPipeline()
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.05)
+    jobs = [b.submit("A", f"p{i}", 64, 64, [i]) for i in range(6)]
+    # Variants count as images: 3 + 2 do not fit in one batch of 4
+    variants = [b.submit("B", "v1", 64, 64, [1, 2, 3]), b.submit("B", "v2", 64, 64, [4, 5])]
+    b.start()
+    wait(*jobs, *variants)
+
+    sizes = [(call["model"], len(call["seeds"])) for call in pipeline.calls]
+    assert sorted(sizes) == [("A", 2), ("A", 4), ("B", 2), ("B", 3)]
+    assert variants[0].result == [("v1", 1), ("v1", 2), ("v1", 3)]
+    assert b.stats()["images"] == 11
+
+
+def test_cancelling_a_queued_job(batcher):
+    pipeline = StubPipeline()
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.05)
+    cancelled = b.submit("A", "cancelled", 64, 64, [1])
+    kept = b.submit("A", "kept", 64, 64, [2])
+    b.cancel(cancelled.id)
+    assert cancelled.done.is_set()
+    assert cancelled.status == "cancelled"
+
+    b.start()
+    wait(kept)
+    assert [call["prompts"] for call in pipeline.calls] == [["kept"]]
+    assert kept.status == "done"
+
+
+def test_cancelling_the_oldest_job_inside_the_window(batcher):
+    pipeline = StubPipeline()
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.2)
+    b.start()
+    cancelled = b.submit("A", "cancelled", 64, 64, [1])
+    other = b.submit("B", "other", 64, 64, [2])
+    time.sleep(0.05)
+    b.cancel(cancelled.id)
+    wait(other)
+    later = b.submit("A", "later", 64, 64, [3])
+    wait(later)
+
+    assert cancelled.status == "cancelled"
+    assert [call["prompts"] for call in pipeline.calls] == [["other"], ["later"]]
+    assert b._thread.is_alive()
+
+
+def test_cancelling_every_job_of_a_running_batch_stops_it(batcher):
+    gate = threading.Event()
+    pipeline = StubPipeline(steps=3, gate=gate)
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.01)
+    b.start()
+    job = b.submit("A", "running", 64, 64, [1])
+    while job.status != "running":
+        time.sleep(0.01)
+    b.cancel(job.id)
+    gate.set()
+    wait(job)
+
+    assert job.status == "cancelled"
+    assert job.result is None
+
+
+def test_an_exception_fails_every_job_of_the_batch(batcher):
+    pipeline = StubPipeline(error=RuntimeError("out of memory"))
+    b = batcher(pipeline, max_batch_size=4, max_wait=0.05)
+    jobs = [b.submit("A", f"p{i}", 64, 64, [i]) for i in range(3)]
+    b.start()
+    wait(*jobs)
+
+    assert len(pipeline.calls) == 1
+    for job in jobs:
+        assert job.status == "failed"
+        assert "out of memory" in job.error
+        assert job.result is None
+
+
+def test_a_failed_batch_does_not_stop_the_next_one(batcher):
+    pipeline = StubPipeline(error=ValueError("bad"))
+    b = batcher(pipeline, max_batch_size=1, max_wait=0.01)
+    b.start()
+    failed = b.submit("A", "first", 64, 64, [1])
+    wait(failed)
+    pipeline.error = None
+    ok = b.submit("A", "second", 64, 64, [2])
+    wait(ok)
+
+    assert failed.status == "failed"
+    assert ok.result == [("second", 2)]
@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from db_stats import PoolMonitor
+
+
+@pytest.fixture
+def monitor():
+    monitor = PoolMonitor()
+    monitor.attach(create_engine("sqlite://"))
+    yield monitor
+    monitor.engine.dispose()
+
+
+def test_in_lists_of_any_length_are_one_statement(monitor):
+    with monitor.engine.connect() as connection:
+        for n in range(1, 4):
+            ids = bindparam("ids", list(range(n)), expanding=True)
+            connection.execute(text("SELECT 1 WHERE 1 IN :ids").bindparams(ids))
+    statements = monitor.stats()["slowest_statements"]
+    assert [(s["statement"], s["count"]) for s in statements] == [("SELECT 1 WHERE 1 IN (...)", 3)]
+
+
+def test_a_failed_statement_leaves_no_start_time_behind(monitor):
+    with monitor.engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing"))
+        connection.execute(text("SELECT 1"))
+        assert connection.info["query_started"] == []
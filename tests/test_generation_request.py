@@ -0,0 +1,53 @@
+import pytest
+from pydantic import ValidationError
+
+from generation_request import GenerateRequest, MAX_PROMPT_LENGTH, MAX_STEPS, MAX_VARIANTS
+
+
+def request(**fields):
+    return GenerateRequest(**{"model_name": "SD V1.5", "prompt": "a dog", **fields})
+
+
+def test_defaults():
+    assert (request().height, request().width, request().num_images) == (512, 512, 1)
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"height": 120},
+        {"width": 1032},
+        {"height": 500},
+        {"num_images": 0},
+        {"num_images": MAX_VARIANTS + 1},
+        {"seeds": list(range(MAX_VARIANTS + 1))},
+        {"seeds": [-1]},
+        {"steps": 0},
+        {"steps": MAX_STEPS + 1},
+        {"guidance_scale": -0.5},
+        {"guidance_scale": 100},
+        {"prompt": ""},
+        {"prompt": "a" * (MAX_PROMPT_LENGTH + 1)},
+    ],
+)
+def test_rejects_what_the_ui_cannot_send(fields):
+    with pytest.raises(ValidationError):
+        request(**fields)
+
+
+def test_accepts_the_bounds():
+    request(height=128, width=1024, num_images=MAX_VARIANTS, steps=MAX_STEPS, guidance_scale=0)
+    request(seeds=list(range(MAX_VARIANTS)), prompt="a" * MAX_PROMPT_LENGTH)
+
+
+def test_job_api_rejects_out_of_bounds_requests(client, user):
+    response = client.post(
+        f"/images/{user.id}/jobs",
+        json={"model_name": "SD V1.5", "prompt": "a dog", "height": 500},
+    )
+    assert response.status_code == 422
+
+
+def test_rejects_an_unknown_model():
+    with pytest.raises(ValidationError):
+        request(model_name="SD V9")
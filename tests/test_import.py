@@ -0,0 +1,63 @@
+import io
+import json
+import zipfile
+
+from PIL import Image as PILImage
+
+
+def png():
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (8, 8), "red").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def archive(*records, members=()):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+        zf.writestr("manifest.jsonl", "".join(json.dumps(record) + "\n" for record in records))
+    return buffer.getvalue()
+
+
+def test_malformed_records_are_reported_as_failed(client, user):
+    data = archive(
+        {"file": "images/1.png", "prompt": "a dog"},
+        ["images/1.png"],
+        "images/1.png",
+        7,
+        {"file": "images/2.png", "sha256": 5},
+        {"prompt": "no file"},
+        members=[("images/1.png", png())],
+    )
+    response = client.post(f"/images/{user.id}/import", files={"file": ("g.zip", data)})
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result["imported"] == 1
+    assert sorted(result["failed"]) == ["<invalid manifest record>"] * 4 + ["images/2.png"]
+
+
+def test_an_oversized_archive_is_refused_while_streaming(client, user, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, "MAX_IMPORT_BYTES", 1024)
+    data = archive(members=[("images/1.png", b"x" * 4096)])
+
+    def chunks():
+        # No Content-Length, so only the count taken while reading can catch it
+        yield b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"g.zip\"\r\n\r\n"
+        yield data
+        yield b"\r\n--b--\r\n"
+
+    response = client.post(
+        f"/images/{user.id}/import",
+        content=chunks(),
+        headers={"Content-Type": "multipart/form-data; boundary=b"},
+    )
+    assert response.status_code == 413
+
+
+def test_a_body_that_is_not_multipart(client, user):
+    response = client.post(f"/images/{user.id}/import", content=b"PK")
+    assert response.status_code == 400
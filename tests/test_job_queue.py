@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+import job_queue
+from db import GenerationJob, SessionLocal
+
+SETTINGS = {"sampler": "Euler", "steps": 20, "guidance_scale": 7.5}
+
+
+@pytest.fixture
+def submit(db, user):
+    def submit(prompt="a dog"):
+        return job_queue.submit(db, user.id, "SD V1.5", prompt, 512, 512, [10], SETTINGS).id
+
+    return submit
+
+
+def claim(worker, **kwargs):
+    # Each worker has its own session, like worker.py, and keeps the job it got detached
+    db = SessionLocal()
+    try:
+        return job_queue.claim(db, worker, **kwargs)
+    finally:
+        db.close()
+
+
+def call(fn, *args, **kwargs):
+    db = SessionLocal()
+    try:
+        result = fn(db, *args, **kwargs)
+        db.commit()
+        return result
+    finally:
+        db.close()
+
+
+def status(job_id):
+    db = SessionLocal()
+    try:
+        return db.get(GenerationJob, job_id)
+    finally:
+        db.close()
+
+
+def test_claims_the_oldest_job_first(submit):
+    first, second = submit("first"), submit("second")
+
+    job = claim("w1")
+    assert (job.id, job.status, job.worker, job.attempts) == (first, job_queue.RUNNING, "w1", 1)
+    assert claim("w2").id == second
+    assert claim("w3") is None
+
+
+def test_finish_records_the_images(submit):
+    submit()
+    job = claim("w1")
+    assert call(job_queue.renew, job, "w1", step=5, total_steps=20)
+    assert status(job.id).step == 5
+
+    assert call(job_queue.finish, job, "w1", [7], total_steps=20)
+    done = status(job.id)
+    assert (done.status, done.image_ids, done.step, done.worker) == (job_queue.DONE, [7], 20, None)
+    assert claim("w2") is None
+
+
+def test_an_expired_lease_is_taken_over(submit):
+    submit()
+    lost = claim("w1", lease_seconds=-1)
+
+    job = claim("w2")
+    assert (job.id, job.worker, job.attempts) == (lost.id, "w2", 2)
+    # The first worker can no longer touch the job
+    assert not call(job_queue.renew, lost, "w1")
+    assert not call(job_queue.finish, lost, "w1", [1])
+    assert not call(job_queue.fail, lost, "w1", "boom")
+    assert status(job.id).worker == "w2"
+
+
+def test_a_job_fails_once_its_attempts_are_used_up(submit):
+    job_id = submit()
+    for attempt in range(1, job_queue.MAX_ATTEMPTS + 1):
+        assert claim(f"w{attempt}", lease_seconds=-1).attempts == attempt
+
+    assert claim("last") is None
+    job = status(job_id)
+    assert job.status == job_queue.FAILED
+    assert "Worker lost" in job.error
+    assert job.finished_at is not None
+
+
+def test_a_failed_run_is_retried_until_the_last_attempt(submit):
+    job_id = submit()
+    for attempt in range(1, job_queue.MAX_ATTEMPTS):
+        job = claim("w1")
+        assert call(job_queue.fail, job, "w1", f"error {attempt}")
+        assert status(job_id).status == job_queue.QUEUED
+
+    job = claim("w1")
+    assert job.attempts == job_queue.MAX_ATTEMPTS
+    assert call(job_queue.fail, job, "w1", "last error")
+    job = status(job_id)
+    assert (job.status, job.error) == (job_queue.FAILED, "last error")
+    assert claim("w1") is None
+
+
+def test_cancel_stops_the_worker(db, user, submit):
+    job_id = submit()
+    job = claim("w1")
+
+    assert not job_queue.cancel(db, job_id, user.id + 1)
+    assert job_queue.cancel(db, job_id, user.id)
+    assert status(job_id).status == job_queue.CANCELLED
+    assert not call(job_queue.renew, job, "w1")
+    assert not call(job_queue.finish, job, "w1", [1])
+    # Finished jobs stay as they are
+    assert not job_queue.cancel(db, job_id, user.id)
+    assert claim("w2") is None
+
+
+def test_concurrent_workers_claim_distinct_jobs(submit):
+    job_ids = {submit(f"job {i}") for i in range(12)}
+    claimed, lock = [], threading.Lock()
+
+    def work(worker):
+        while (job := claim(worker)) is not None:
+            with lock:
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(job_ids)
+    assert all(status(job_id).attempts == 1 for job_id in job_ids)
@@ -0,0 +1,70 @@
+import pytest
+
+import model_manager
+from model_manager import ModelManager
+
+MB = 1024 * 1024
+
+
+class FakePipeline:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.scheduler = type("Scheduler", (), {"config": {}})()
+
+    def to(self, device):
+        return self
+
+
+@pytest.fixture(autouse=True)
+def fake_sizes(monkeypatch):
+    monkeypatch.setattr(model_manager, "pipeline_nbytes", lambda pipeline: pipeline.nbytes)
+
+
+class StubLoader:
+    """Loads fake pipelines, recording what is resident while each loads, plus the model itself."""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.peaks = []
+        self.manager = None
+
+    def __call__(self, name):
+        self.peaks.append(self.manager._resident_bytes() + self.sizes[name])
+        return FakePipeline(self.sizes[name])
+
+
+def make_manager(sizes, **options):
+    loader = StubLoader(sizes)
+    loader.manager = ModelManager(loader, "cpu", **options)
+    return loader.manager, loader.peaks
+
+
+def test_first_loads_evict_for_the_largest_known_size():
+    sizes = {"a": 4 * MB, "b": 4 * MB, "c": 4 * MB}
+    manager, peaks = make_manager(sizes, budget_bytes=8 * MB)
+    for name in sizes:
+        with manager.acquire(name):
+            pass
+
+    assert max(peaks) <= 8 * MB
+    assert [n for n, m in manager.stats()["models"].items() if m["on_device"]] == ["b", "c"]
+
+
+def test_size_estimates_make_room_before_the_first_load():
+    manager, peaks = make_manager(
+        {"small": 2 * MB, "big": 6 * MB}, budget_bytes=7 * MB, size_estimates={"big": 6 * MB}
+    )
+    with manager.acquire("small"):
+        pass
+    with manager.acquire("big"):
+        pass
+
+    assert peaks == [2 * MB, 6 * MB]
+
+
+def test_models_in_use_are_not_evicted():
+    manager, _ = make_manager({"a": 4 * MB, "b": 4 * MB}, budget_bytes=6 * MB)
+    with manager.acquire("a"):
+        with manager.acquire("b"):
+            models = manager.stats()["models"]
+            assert models["a"]["on_device"] and models["b"]["on_device"]
@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+from db import Image
+
+START = datetime.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def images(db, user):
+    # Pairs of images share a timestamp, so the id has to break the ties
+    rows = [
+        Image(
+            filename=f"{i}.png",
+            prompt=f"image {i}",
+            owner_id=user.id,
+            created_at=START + datetime.timedelta(minutes=i // 2),
+        )
+        for i in range(7)
+    ]
+    db.add_all(rows)
+    db.commit()
+    return [row.id for row in rows]
+
+
+def walk(client, user_id, order, direction="after", cursor=None):
+    pages = []
+    while True:
+        params = {"limit": 3, "order": order}
+        if cursor:
+            params[direction] = cursor
+        page = client.get(f"/images/{user_id}", params=params).json()
+        pages.append([item["id"] for item in page["items"]])
+        cursor = page["next_cursor" if direction == "after" else "prev_cursor"]
+        if not cursor:
+            return pages, page
+
+
+def test_newest_first_pages_cover_every_image_once(client, user, images):
+    pages, last = walk(client, user.id, "newest")
+    assert pages == [images[6:3:-1], images[3:0:-1], images[:1]]
+    assert last["total"] == 7
+
+
+def test_oldest_first(client, user, images):
+    pages, _ = walk(client, user.id, "oldest")
+    assert pages == [images[0:3], images[3:6], images[6:]]
+
+
+def test_before_walks_back_to_the_first_page(client, user, images):
+    _, last = walk(client, user.id, "oldest")
+    pages, first = walk(client, user.id, "oldest", "before", last["prev_cursor"])
+    assert pages == [images[3:6], images[0:3]]
+    assert first["prev_cursor"] is None
+    assert first["next_cursor"] is not None
+
+
+def test_first_page_has_no_prev_cursor(client, user, images):
+    page = client.get(f"/images/{user.id}", params={"limit": 3}).json()
+    assert page["prev_cursor"] is None
+
+
+def test_deleted_images_are_skipped(client, db, user, images):
+    db.get(Image, images[5]).deleted_at = datetime.datetime.utcnow()
+    db.commit()
+    pages, last = walk(client, user.id, "newest")
+    assert [i for page in pages for i in page] == [images[i] for i in (6, 4, 3, 2, 1, 0)]
+    assert last["total"] == 6
+
+
+def test_invalid_cursor(client, user, images):
+    response = client.get(f"/images/{user.id}", params={"after": "bm90IGEgY3Vyc29y"})
+    assert response.status_code == 400
+
+
+def test_before_and_after_together(client, user, images):
+    page = client.get(f"/images/{user.id}", params={"limit": 3}).json()
+    cursor = page["next_cursor"]
+    response = client.get(f"/images/{user.id}", params={"before": cursor, "after": cursor})
+    assert response.status_code == 400
+
+
+def test_bundle_ids_are_bounded_like_the_page_size(client, user, images):
+    response = client.get(f"/images/{user.id}/bundle", params={"ids": list(range(101))})
+    assert response.status_code == 422
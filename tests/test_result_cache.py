@@ -0,0 +1,44 @@
+import os
+
+from PIL import Image as PILImage
+
+from result_cache import ResultCache
+
+
+def image():
+    return PILImage.new("RGB", (16, 16), "blue")
+
+
+def test_a_hit_returns_the_image(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    cache.put("a", image())
+    assert cache.get("a").size == (16, 16)
+    assert cache.stats()["hits"] == 1
+
+
+def test_missing_and_corrupt_entries_are_misses(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    cache.put("a", image())
+    with open(cache.path("a"), "r+b") as f:
+        f.truncate(20)
+
+    assert cache.get("a") is None
+    assert not os.path.exists(cache.path("a"))
+    assert cache.get("never stored") is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_processes_sharing_the_directory_share_the_budget(tmp_path):
+    ResultCache(str(tmp_path), max_bytes=1 << 20).put("probe", image())
+    size = os.path.getsize(os.path.join(tmp_path, "probe.png"))
+    os.remove(os.path.join(tmp_path, "probe.png"))
+    first, second = (ResultCache(str(tmp_path), max_bytes=10 * size) for _ in range(2))
+    most = 0
+    for i in range(30):
+        first.put(f"first{i}", image())
+        second.put(f"second{i}", image())
+        most = max(most, len(os.listdir(tmp_path)))
+
+    # Twenty without a shared budget; the overshoot is what the other process wrote
+    # since its last rescan
+    assert most <= 12
@@ -0,0 +1,62 @@
+import io
+
+from PIL import Image as PILImage
+
+
+def png():
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (64, 64), "green").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_upload(client, user):
+    response = client.post(
+        f"/images/{user.id}", files={"file": ("a.png", png())}, data={"prompt": "a dog"}
+    )
+    assert response.status_code == 200
+    assert client.get(f"/images/{user.id}").json()["items"][0]["prompt"] == "a dog"
+
+
+def test_a_truncated_image_is_refused(client, user):
+    response = client.post(
+        f"/images/{user.id}", files={"file": ("a.png", png()[:-40])}, data={"prompt": "a dog"}
+    )
+    assert response.status_code == 400
+
+
+def test_an_oversized_upload_is_refused_while_streaming(client, user, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, "MAX_UPLOAD_BYTES", 1024)
+
+    def chunks():
+        # No Content-Length, so only the count taken while reading can catch it
+        yield b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.png\"\r\n\r\n"
+        yield b"x" * 4096
+        yield b"\r\n--b--\r\n"
+
+    response = client.post(
+        f"/images/{user.id}",
+        content=chunks(),
+        headers={"Content-Type": "multipart/form-data; boundary=b"},
+    )
+    assert response.status_code == 413
+
+
+def test_an_oversized_content_length_is_refused_up_front(client, user, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, "MAX_UPLOAD_BYTES", 1024)
+    response = client.post(
+        f"/images/{user.id}", files={"file": ("a.png", b"x" * 4096)}, data={"prompt": "a dog"}
+    )
+    assert response.status_code == 413
+
+
+def test_a_size_below_one_is_refused(client, user):
+    client.post(f"/images/{user.id}", files={"file": ("a.png", png())}, data={"prompt": "a dog"})
+    image_id = client.get(f"/images/{user.id}").json()["items"][0]["id"]
+    for size in (0, -5):
+        assert client.get(f"/image/{image_id}", params={"size": size}).status_code == 422
+        response = client.get(f"/images/{user.id}/bundle", params={"size": size})
+        assert response.status_code == 422
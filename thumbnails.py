@@ -0,0 +1,28 @@
+import io
+from PIL import Image as PILImage
+
+RENDITION_SIZES = (256, 512)
+RENDITION_FORMAT = "WEBP"
+RENDITION_CONTENT_TYPE = "image/webp"
+RENDITION_QUALITY = 80
+
+
+def make_renditions(file, sizes=RENDITION_SIZES):
+    """Return the content type of the image in ``file`` and {max_side: webp_bytes}
+    for every size smaller than it."""
+    source = PILImage.open(file)
+    source.load()
+    content_type = PILImage.MIME.get(source.format, "application/octet-stream")
+    if source.mode not in ("RGB", "RGBA"):
+        source = source.convert("RGBA" if "A" in source.getbands() else "RGB")
+
+    renditions = {}
+    for size in sorted(sizes):
+        if max(source.size) <= size:
+            break
+        image = source.copy()
+        image.thumbnail((size, size), PILImage.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=RENDITION_FORMAT, quality=RENDITION_QUALITY, method=4)
+        renditions[size] = buffer.getvalue()
+    return content_type, renditions
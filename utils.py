@@ -1,29 +1,66 @@
-from PIL import ImageEnhance
+from PIL import Image as PILImage
 import streamlit as st
-import torch
-import diffusers
-from diffusers import StableDiffusionPipeline, DiffusionPipeline, AutoencoderKL
+import base64
 import io
 import os
 import json
-import bcrypt
-from sqlalchemy import (
-    create_engine,
-    Column,
-    Integer,
-    String,
-    LargeBinary,
-    ForeignKey,
-    Date,
-    DateTime,
-)
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
 import requests
 import datetime
-from sqlalchemy.orm import Session
+import config
+import metrics
+from adjustments import adjust, make_preview
+from encoding import EncodedImageCache, encode_image, encode_options
+from generation import (
+    PRESET_PROMPTS,
+    MODEL_NAMES,
+    MODEL_PRESETS,
+    MAX_STEPS,
+    MAX_GUIDANCE_SCALE,
+)
+from generation_request import MAX_PROMPT_LENGTH, MAX_SIDE, MIN_SIDE
+
+API_URL = config.require("API_URL")
+# When set, the Home page submits jobs to generation_service.py instead of running locally
+GENERATION_URL = config.get("GENERATION_URL")
+
+# Save/download format choices: label -> (format, lossless)
+OUTPUT_FORMATS = {
+    "PNG": ("png", False),
+    "WebP": ("webp", False),
+    "WebP (lossless)": ("webp", True),
+    "JPEG": ("jpeg", False),
+}
+OUTPUT_FORMAT = config.get("OUTPUT_FORMAT", "PNG")
+OUTPUT_QUALITY = config.get_int("OUTPUT_QUALITY", 90)
+PNG_COMPRESS_LEVEL = config.get_int("PNG_COMPRESS_LEVEL", 6)
+
+
+@st.cache_resource
+def api_session():
+    # One pooled session per Streamlit process, so reruns reuse keep-alive connections
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
-API_URL = st.secrets["API_URL"]
+@st.cache_resource
+def encoded_images():
+    # One per Streamlit process, shared by all sessions and keyed by image content
+    return EncodedImageCache(config.get_int("ENCODED_CACHE_MB", 64) * 1024 * 1024)
+
+
+@st.cache_resource
+def metrics_server():
+    # Streamlit has no routes of its own, so stage timings of this process get a port
+    port = config.get_int("METRICS_PORT")
+    return metrics.serve(port) if port else None
+
+
+def output_options(label=OUTPUT_FORMAT, quality=OUTPUT_QUALITY):
+    fmt, lossless = OUTPUT_FORMATS[label]
+    return encode_options(fmt, quality, lossless, PNG_COMPRESS_LEVEL)
 
 
 def signup(username, password, email, date_of_birth):
@@ -48,104 +85,115 @@ def signup(username, password, email, date_of_birth):
     return False
 
 
-def login(username: str, password: str, db: Session):
-    user = db.query(User).filter(User.username == username).first()
-    if user and bcrypt.checkpw(
-        password.encode("utf-8"), user.hashed_password.encode("utf-8")
-    ):
-        return user
+def login(username: str, password: str):
+    response = api_session().post(
+        f"{API_URL}/login", json={"username": username, "password": password}
+    )
+    if response.status_code == 200:
+        return response.json()
     return None
 
 
+def auth_headers():
+    return {"Authorization": f"Bearer {st.session_state.access_token}"}
+
+
 def init_session_state():
+    metrics_server()
     if "logged_in" not in st.session_state:
         st.session_state.logged_in = False
     if "current_user" not in st.session_state:
         st.session_state.current_user = None
+    if "access_token" not in st.session_state:
+        st.session_state.access_token = None
 
 
 def logout():
     st.session_state.logged_in = False
     st.session_state.current_user = None
+    st.session_state.access_token = None
+
+
+def iter_sse(response):
+    # Minimal text/event-stream parser: yields (event, data) per blank-line separated block
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+def generate_image_stream_remote(
+        model_name: str, prompt: str, height: int, width: int, seeds=None, **settings
+):
+    """Same events as generation.generate_image_stream, from the generation service."""
+    session = api_session()
+    response = session.post(
+        f"{GENERATION_URL}/generate",
+        json={
+            "model_name": model_name,
+            "prompt": prompt,
+            "height": height,
+            "width": width,
+            "seeds": seeds,
+            **settings,
+        },
+    )
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
 
-
-device = (
-    "cuda"
-    if torch.cuda.is_available()
-    else "mps" if torch.backends.mps.is_available() else "cpu"
-)
-
-
-@st.cache_resource
-def build_pipeline(model_name: str):
-    if model_name == "SD V1.5":
-        return StableDiffusionPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5",
-            torch_dtype=torch.float16,
-            use_safetensors=False,
-        ).to(device)
-    elif model_name == "SD Pokemon":
-        return StableDiffusionPipeline.from_pretrained(
-            "lambdalabs/sd-pokemon-diffusers",
-            torch_dtype=torch.float16,
-            use_safetensors=False,
-        ).to(device)
-    elif model_name == "SD Dogs":
-        vae = AutoencoderKL.from_pretrained(
-            "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
-        )
-        pipe = DiffusionPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            vae=vae,
-            torch_dtype=torch.float16,
-            variant="fp16",
-            use_safetensors=True,
-        )
-        pipe.load_lora_weights("whydelete/husky_lora")
-        return pipe.to(device)
-    else:
-        return None
-
-
-def generate_image(model_name: str, prompt: str, height: int, width: int):
-    pipeline = build_pipeline(model_name)
-    pipeline.scheduler = diffusers.PNDMScheduler.from_config(pipeline.scheduler.config)
-
-    rng = torch.Generator(device=device).manual_seed(10)
-    images = pipeline(
-        prompt=[prompt],
-        height=height,
-        width=width,
-        num_inference_steps=20,
-        guidance_scale=7.5,
-        negative_prompt=[
-            "lowres, bad anatomy, extra digit, fewer digits, cropped, worst quality, low quality"
-        ],
-        generator=rng,
-    ).images
-
-    return images[0]
+    finished = False
+    try:
+        with session.get(
+                f"{GENERATION_URL}/generate/{job_id}/events", stream=True
+        ) as events:
+            events.raise_for_status()
+            for event, data in iter_sse(events):
+                job = json.loads(data)
+                if event == "progress":
+                    preview = job.get("preview")
+                    yield {
+                        "type": "progress",
+                        "step": job["step"],
+                        "total": job["total_steps"],
+                        "preview": PILImage.open(io.BytesIO(base64.b64decode(preview)))
+                        if preview
+                        else None,
+                    }
+                    continue
+                finished = True
+                if event == "done":
+                    images = []
+                    for index in range(len(job["seeds"])):
+                        result = session.get(
+                            f"{GENERATION_URL}/generate/{job_id}/result",
+                            params={"index": index},
+                        )
+                        result.raise_for_status()
+                        images.append(PILImage.open(io.BytesIO(result.content)))
+                    yield {"type": "done", "image": images[0], "images": images}
+                else:
+                    yield {"type": event, "error": job.get("error")}
+                return
+    finally:
+        if not finished:
+            # Abandoned partway (closed by the caller or the stream dropped): free the worker
+            session.delete(f"{GENERATION_URL}/generate/{job_id}")
 
 
 def apply_adjustments(image, brightness, contrast, saturation):
-    enhancer = ImageEnhance.Brightness(image)
-    image = enhancer.enhance(brightness)
+    return adjust(image, brightness, contrast, saturation)
 
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(contrast)
 
-    enhancer = ImageEnhance.Color(image)
-    image = enhancer.enhance(saturation)
-
-    return image
-
-
-def image_to_bytes(image):
+def image_to_bytes(image, options=None):
     if image is None:
         return None
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format="PNG")
-    return img_byte_arr.getvalue()
+    return encode_image(image, options or output_options("PNG"))
 
 
 def save_to_gallery(image, prompt):
@@ -166,73 +214,46 @@ def save_to_gallery(image, prompt):
 
 
 def ui_tab_txt2img():
-    prompt_dict = {
-        "Dog": "A playful dog running in a park",
-        "Cat": "A cat lounging in a sunbeam",
-        "Pokemon": "A Pikachu on the grass",
-    }
+    prompt_dict = PRESET_PROMPTS
     cols = st.columns(2)
     with cols[0]:
         category = st.selectbox("Category", options=list(prompt_dict.keys()))
-        prompt = st.text_area("Prompt", value=prompt_dict[category], height=150)
+        prompt = st.text_area(
+            "Prompt", value=prompt_dict[category], height=150, max_chars=MAX_PROMPT_LENGTH
+        )
     with cols[1]:
         model_name = st.selectbox(
             "Model Selection",
-            options=[
-                "SD V1.5",
-                "SD Pokemon",
-                "SD Dogs",
-            ],
+            options=MODEL_NAMES,
         )
-        height = st.slider("Height", min_value=128, max_value=1024, value=512, step=128)
-        width = st.slider("Width", min_value=128, max_value=1024, value=512, step=128)
+        height = st.slider("Height", min_value=MIN_SIDE, max_value=MAX_SIDE, value=512, step=128)
+        width = st.slider("Width", min_value=MIN_SIDE, max_value=MAX_SIDE, value=512, step=128)
 
     return model_name, prompt, height, width
 
 
-DATABASE_URL = st.secrets["DATABASE_URL"]
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-Base = declarative_base()
-
-
-class User(Base):
-    __tablename__ = "users"
-
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, index=True)
-    hashed_password = Column(String)
-    email = Column(String)
-    date_of_birth = Column(Date)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
-
-    images = relationship("Image", back_populates="owner")
-
-
-class Image(Base):
-    __tablename__ = "images"
-
-    id = Column(Integer, primary_key=True, index=True)
-    filename = Column(String)
-    data = Column(LargeBinary)
-    prompt = Column(String)
-    owner_id = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
-
-    owner = relationship("User", back_populates="images")
-
-
-def create_tables():
-    Base.metadata.create_all(bind=engine)
-
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-create_tables()
+def ui_sampler_settings(model_name):
+    # Keyed by model, so switching models starts from that model's preset
+    preset = MODEL_PRESETS[model_name]
+    cols = st.columns(3)
+    with cols[0]:
+        sampler = st.selectbox(
+            "Sampler",
+            options=preset["samplers"],
+            index=preset["samplers"].index(preset["sampler"]),
+            key=f"sampler_{model_name}",
+        )
+    with cols[1]:
+        steps = st.slider(
+            "Steps", 1, MAX_STEPS, preset["steps"], key=f"steps_{model_name}"
+        )
+    with cols[2]:
+        guidance_scale = st.slider(
+            "Guidance",
+            0.0,
+            MAX_GUIDANCE_SCALE,
+            float(preset["guidance_scale"]),
+            0.5,
+            key=f"guidance_{model_name}",
+        )
+    return {"sampler": sampler, "steps": steps, "guidance_scale": guidance_scale}
@@ -0,0 +1,209 @@
+"""Generation worker: runs the jobs of the job queue and saves their images to the gallery.
+
+    python worker.py [--processes 2]
+
+Each process loads the models in ``PRELOAD_MODELS`` once, then claims one job at a
+time (all variants of a job run as one batch) and writes the images into the
+``images`` table of the job's owner, so a result survives the browser that asked
+for it. A heartbeat thread renews the job's lease with the latest progress; when
+a renewal finds the job cancelled or taken over, the run stops at the next step.
+Scale inference by running more processes, or more workers against the same
+database; every process holds its own copy of the models. SIGTERM and Ctrl-C let
+running jobs finish, a crashed process is restarted and its job retried once its
+lease runs out.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+
+import config
+import job_queue
+import metrics
+from db import SessionLocal, blob_store, create_tables
+from encoding import encode_image
+from images import build_image
+
+WORKER_PROCESSES = config.get_int("WORKER_PROCESSES", 1)
+POLL_INTERVAL = config.get_float("WORKER_POLL_SECONDS", 1)
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Heartbeat:
+    """Renews a job's lease on a thread, reporting the progress ``on_step`` last saw."""
+
+    def __init__(self, job, worker, interval=job_queue.LEASE_SECONDS / 3):
+        self.job = job
+        self.worker = worker
+        self.interval = interval
+        self.step, self.total_steps = None, None
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def on_step(self, step, total, latents):
+        if self.lost.is_set():
+            raise LeaseLost()
+        self.step, self.total_steps = step, total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            db = SessionLocal()
+            try:
+                if not job_queue.renew(db, self.job, self.worker, self.step, self.total_steps):
+                    self.lost.set()
+                    return
+            except Exception:
+                # The lease lasts a few intervals, the next renewal may get through
+                logger.exception("Could not renew the lease of job %d", self.job.id)
+            finally:
+                db.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def save_results(job, worker, images, total_steps=None):
+    db = SessionLocal()
+    try:
+        db_images = []
+        for seed, image in zip(job.seeds, images):
+            sha256, size = blob_store.put(encode_image(image))
+            db_image = build_image(job.owner_id, f"job_{job.id}_{seed}.png", job.prompt, sha256, size)
+            db_images.append(db_image)
+        db.add_all(db_images)
+        db.flush()
+        # The images and the job's completion commit together, or not at all
+        image_ids = [db_image.id for db_image in db_images]
+        if not job_queue.finish(db, job, worker, image_ids, total_steps):
+            raise LeaseLost()
+        db.commit()
+    except BaseException:
+        # The blobs stay behind for blob_gc, another image may share them by now
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def run_job(job, worker):
+    from generation import generate_images
+
+    settings = {
+        "sampler": job.sampler,
+        "steps": job.steps,
+        "guidance_scale": job.guidance_scale,
+    }
+    with metrics.trace(
+            "job", job=job.id, attempt=job.attempts, model=job.model_name,
+            size=len(job.seeds), height=job.height, width=job.width, **settings,
+    ):
+        with Heartbeat(job, worker) as heartbeat:
+            images = generate_images(
+                job.model_name, [job.prompt] * len(job.seeds), job.height, job.width,
+                on_step=heartbeat.on_step, seeds=job.seeds, **settings,
+            )
+        save_results(job, worker, images, heartbeat.total_steps)
+
+
+def process(job, worker):
+    logger.info("Running job %d (attempt %d)", job.id, job.attempts)
+    try:
+        run_job(job, worker)
+    except LeaseLost:
+        logger.info("Job %d was cancelled or taken over", job.id)
+        return
+    except Exception as e:
+        logger.exception("Job %d failed", job.id)
+        db = SessionLocal()
+        try:
+            job_queue.fail(db, job, worker, repr(e))
+        finally:
+            db.close()
+        return
+    logger.info("Job %d done", job.id)
+
+
+def work(stop: threading.Event):
+    """Claim and run jobs until ``stop`` is set."""
+    from generation import preload_models
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    preload_models()
+    logger.info("Worker %s ready", worker)
+    while not stop.is_set():
+        db = SessionLocal()
+        try:
+            job = job_queue.claim(db, worker)
+        finally:
+            db.close()
+        if job is None:
+            stop.wait(POLL_INTERVAL)
+        else:
+            process(job, worker)
+
+
+def work_process():
+    # SIGTERM (and Ctrl-C, which reaches the whole process group) ends the
+    # process after the job it is running
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [{multiprocessing.current_process().name}] %(message)s",
+    )
+    work(stop)
+
+
+def supervise(processes: int):
+    context = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    def start(name):
+        child = context.Process(target=work_process, name=name)
+        child.start()
+        return child
+
+    children = [start(f"worker-{i}") for i in range(processes)]
+    while not stopping.wait(POLL_INTERVAL):
+        for i, child in enumerate(children):
+            if not child.is_alive():
+                logger.warning("%s exited with %s, restarting it", child.name, child.exitcode)
+                children[i] = start(child.name)
+    for child in children:
+        child.terminate()
+    for child in children:
+        child.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    create_tables()
+    if args.processes > 1:
+        supervise(args.processes)
+    else:
+        work_process()
+
+
+if __name__ == "__main__":
+    main()